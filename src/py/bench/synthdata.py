@@ -0,0 +1,168 @@
+import os
+import datetime
+import numpy as np
+import pandas as pd
+import pytz
+
+from proc import gps
+from proc import detectors
+
+default_start_time = 1211094000  # 2008-05-18 00:00 US/Pacific
+default_center = (37.6, -122.39)  # lat, long
+# section point layout of the corridor the estimator is configured for:
+# detectors at the ends and on the measured segments, two on-ramps, one off-ramp
+road_vds_ids = [400001, 400002, 400003, None, None, None, 400004]
+road_on_ramps = [0, 0, 1, 0, 1, 0, 0]
+road_off_ramps = [0, 0, 0, 0, 0, 1, 0]
+free_speed = 27.0  # m/s
+cong_speed = 8.0  # m/s
+gps_noise = 3.0  # standard deviation of GPS position error, in meters
+
+
+def _xy_to_lat_long(x, y, center):
+    lat = center[0] + np.degrees(y / gps.earth_rad)
+    long = center[1] + np.degrees(x / (gps.earth_rad * np.cos(np.radians(center[0]))))
+    return lat, long
+
+
+def make_road_xy(n_points=len(road_vds_ids), spacing=500.0, rng=None):
+    """
+    :return: (n_points, 2) array of x, y of a gently curving corridor
+    """
+    rng = rng if rng is not None else np.random.RandomState(0)
+    headings = np.deg2rad(50.0) + np.cumsum(rng.uniform(-0.15, 0.15, n_points - 1))
+    steps = spacing * np.column_stack((np.cos(headings), np.sin(headings)))
+    xy = np.vstack(([0.0, 0.0], np.cumsum(steps, axis=0)))
+    return xy - xy.mean(axis=0)
+
+
+def write_road(fname, road_xy, center=default_center):
+    """
+    Write a road section CSV as read by proc.road.RoadSection
+    :param road_xy: x, y of the section's points, laid out as road_vds_ids
+    :return: list of the section's detector ids
+    """
+    assert(len(road_xy) == len(road_vds_ids))
+    lat, long = _xy_to_lat_long(road_xy[:, 0], road_xy[:, 1], center)
+    section = pd.DataFrame({'lat': lat, 'long': long, 'vds_id': road_vds_ids,
+                            'on_ramp': road_on_ramps, 'off_ramp': road_off_ramps},
+                           columns=['lat', 'long', 'vds_id', 'on_ramp', 'off_ramp'])
+    section.to_csv(fname, index=False, float_format='%.6f')
+    return [vds_id for vds_id in road_vds_ids if vds_id is not None]
+
+
+def congestion_level(times, start_time=default_start_time):
+    """
+    :return: array in [0, 1] of how congested the corridor is at times,
+    peaking in the morning and evening rush hours
+    """
+    hours = ((np.asarray(times) - start_time) % 86400) / 3600.0
+    return np.clip(np.exp(-0.5 * ((hours - 8.0) / 1.0)**2) +
+                   np.exp(-0.5 * ((hours - 17.5) / 1.2)**2), 0.0, 1.0)
+
+
+def _road_positions(road_xy, arc_lens):
+    seg_vecs = np.diff(road_xy, axis=0)
+    seg_lens = np.sqrt(np.sum(np.square(seg_vecs), 1))
+    seg_starts = np.concatenate(([0.0], np.cumsum(seg_lens)))
+    seg_idxs = np.clip(np.searchsorted(seg_starts, arc_lens, side='right') - 1, 0, len(seg_lens) - 1)
+    frac = (arc_lens - seg_starts[seg_idxs]) / seg_lens[seg_idxs]
+    return road_xy[seg_idxs] + frac[:, np.newaxis] * seg_vecs[seg_idxs]
+
+
+def make_cab_trace(road_xy, n_fixes, start_time, duration, rng, on_road_frac=0.4):
+    """
+    Simulate one cab alternating between trips along the corridor and
+    driving elsewhere
+    :return: DataFrame with columns x, y (meters), occupancy, time
+    """
+    times = np.sort(rng.randint(start_time, start_time + duration, n_fixes))
+    road_len = np.sum(np.sqrt(np.sum(np.square(np.diff(road_xy, axis=0)), 1)))
+    # a new trip starts whenever the cab has been idle for a while
+    trip_ids = np.cumsum(np.concatenate(([1], np.diff(times) > 600)))
+    n_trips = trip_ids[-1] + 1
+    trip_on_road = rng.rand(n_trips) < on_road_frac
+    trip_start_pos = rng.uniform(0.0, road_len, n_trips)
+    trip_start_times = np.full(n_trips, times[0])
+    first_fix = np.concatenate(([True], trip_ids[1:] != trip_ids[:-1]))
+    trip_start_times[trip_ids[first_fix]] = times[first_fix]
+    speeds = free_speed - (free_speed - cong_speed) * congestion_level(times, start_time)
+    speeds = speeds * rng.uniform(0.9, 1.1, n_fixes)
+    elapsed = times - trip_start_times[trip_ids]
+    arc_lens = (trip_start_pos[trip_ids] + speeds * elapsed) % road_len
+    xy = _road_positions(road_xy, arc_lens)
+    off_road = np.invert(trip_on_road[trip_ids])
+    extent = np.abs(road_xy).max() * 3.0
+    xy[off_road] = rng.uniform(-extent, extent, (np.sum(off_road), 2))
+    xy += rng.normal(0.0, gps_noise, xy.shape)
+    return pd.DataFrame({'x': xy[:, 0], 'y': xy[:, 1],
+                         'occupancy': rng.randint(0, 2, n_fixes), 'time': times})
+
+
+def write_cabs(dirname, road_xy, n_cabs, n_fixes, start_time, duration, rng,
+               center=default_center):
+    """
+    Write _cabs.txt and new_<id>.txt traces as read by proc.cabdata.CabData
+    """
+    os.makedirs(dirname, exist_ok=True)
+    cab_ids = ["cab{:05d}".format(cab_num) for cab_num in range(n_cabs)]
+    with open(os.path.join(dirname, "_cabs.txt"), 'w') as fout:
+        for cab_id in cab_ids:
+            fout.write('<cab id="{}" updates="{}"/>\n'.format(cab_id, n_fixes))
+    for cab_id in cab_ids:
+        trace = make_cab_trace(road_xy, n_fixes, start_time, duration, rng)
+        lat, long = _xy_to_lat_long(trace['x'].values, trace['y'].values, center)
+        trace = pd.DataFrame({'lat': lat, 'long': long, 'occupancy': trace['occupancy'],
+                              'time': trace['time']}, columns=['lat', 'long', 'occupancy', 'time'])
+        # cabspotting files list the newest fix first
+        trace.iloc[::-1].to_csv(os.path.join(dirname, "new_{}.txt".format(cab_id)), sep=' ',
+                                header=False, index=False, float_format='%.5f')
+    return cab_ids
+
+
+def write_detector(dirname, vds_id, start_time, duration, rng):
+    """
+    Write pems_vds_<vds_id>.csv of 5-minute data as read by
+    proc.detectors.StatDetector
+    """
+    timezone = pytz.timezone('US/Pacific')
+    first = datetime.datetime.fromtimestamp(start_time, timezone).replace(tzinfo=None)
+    n_rows = duration // 300 + 2
+    local_times = [first + datetime.timedelta(minutes=5 * i) for i in range(n_rows)]
+    unix_times = start_time + 300 * np.arange(n_rows)
+    cong = congestion_level(unix_times, start_time)
+    speed_mph = (free_speed - (free_speed - cong_speed) * cong) / detectors.mph_to_mps
+    speed_mph = speed_mph * rng.uniform(0.95, 1.05, n_rows)
+    hours = ((unix_times - start_time) % 86400) / 3600.0
+    demand = 0.3 + 0.7 * np.clip(np.sin(np.pi * (hours - 5.0) / 17.0), 0.0, None)
+    flow = np.round(demand * (1.0 - 0.4 * cong) * 500.0 * rng.uniform(0.9, 1.1, n_rows))
+    data = pd.DataFrame({'5 Minutes': [t.strftime(detectors.pems_time_format) for t in local_times],
+                         'Flow (Veh/5 Minutes)': flow.astype(np.int64),
+                         '# Lane Points': 20, '% Observed': 100,
+                         'Speed (mph)': np.round(speed_mph, 1)},
+                        columns=['5 Minutes', 'Flow (Veh/5 Minutes)', '# Lane Points',
+                                 '% Observed', 'Speed (mph)'])
+    data.to_csv(os.path.join(dirname, "pems_vds_{}.csv".format(vds_id)), index=False)
+
+
+def generate(dirname, n_cabs, n_fixes, n_days=1, start_time=default_start_time, seed=0):
+    """
+    Write a complete synthetic data set to dirname: cabspotting traces in
+    cabs/, a road section in road.csv and detector data in vds/
+    :param n_cabs: number of cabs
+    :param n_fixes: number of GPS fixes per cab
+    :param n_days: days covered by traces and detector data
+    :return: dict of paths of the data set's parts
+    """
+    rng = np.random.RandomState(seed)
+    duration = n_days * 86400
+    paths = {'datadir': os.path.join(dirname, 'cabs'),
+             'road': os.path.join(dirname, 'road.csv'),
+             'vdsdir': os.path.join(dirname, 'vds')}
+    os.makedirs(paths['vdsdir'], exist_ok=True)
+    road_xy = make_road_xy(rng=rng)
+    vds_ids = write_road(paths['road'], road_xy)
+    for vds_id in vds_ids:
+        write_detector(paths['vdsdir'], vds_id, start_time, duration, rng)
+    write_cabs(paths['datadir'], road_xy, n_cabs, n_fixes, start_time, duration, rng)
+    return paths
@@ -0,0 +1,177 @@
+import argparse
+import os
+import json
+import glob
+import time
+import shutil
+import logging
+import platform
+import subprocess
+import numpy as np
+import pandas as pd
+
+import bench.synthdata
+import proc.cabdata
+import proc.road
+import proc.estimator
+import proc.speedcube
+import proc.output
+
+stage_names = ['generate', 'ingestion', 'detector_load', 'calc_xy', 'calc_deltas',
+               'assign_road_segments', 'speed_cube', 'estimator_loop', 'fit_fds']
+estimation_start_hour = 6  # start of the estimated horizon, so it includes the morning peak
+
+
+def args_setup():
+    args_parser = argparse.ArgumentParser(
+        description="Time each processing stage on synthetic data sets of several sizes")
+    args_parser.add_argument('workdir', help="Directory where synthetic data sets are written")
+    args_parser.add_argument('--cabs', type=int, nargs='+', default=[10, 50, 200],
+                             help="Number of cabs of each data set size")
+    args_parser.add_argument('--fixes', type=int, default=2000, help="Number of GPS fixes per cab")
+    args_parser.add_argument('--days', type=int, default=1, help="Days covered by each data set")
+    args_parser.add_argument('--horizon', type=int, default=4 * 3600,
+                             help="Seconds estimated in the estimator loop stage")
+    args_parser.add_argument('--workers', type=int, default=1,
+                             help="Number of threads reading cab trace files")
+    args_parser.add_argument('--repeat', type=int, default=1,
+                             help="Runs per size; the fastest time of each stage is kept")
+    args_parser.add_argument('--skip-fit', action='store_true', help="Do not time fit_fds")
+    args_parser.add_argument('--output', default="benchmark.json", help="Path of the JSON results")
+    return args_parser.parse_args()
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def clear_saves(paths):
+    """
+    Remove trace saves and detector caches, so every run starts from the raw files
+    """
+    saves = glob.glob(os.path.join(paths['datadir'], "*.cols"))
+    saves += glob.glob(os.path.join(paths['vdsdir'], "*.cols"))
+    for save in saves:
+        shutil.rmtree(save)
+    for fname in glob.glob(os.path.join(paths['datadir'], "*.pickle")):
+        os.remove(fname)
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.times = {}
+        self.skipped = {}  # reason of each stage that was not timed
+
+    def time(self, stage, func, *args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        self.times[stage] = time.perf_counter() - start
+        return result
+
+    def skip(self, stage, reason):
+        self.times.pop(stage, None)
+        self.skipped[stage] = reason
+
+
+def estimate(road_section, cab_data, time_lim, output_fname):
+    estimator = proc.estimator.RoadStateEstimator(road_section, 5, time_lim[0], time_lim[1])
+    with proc.output.EstimateWriter(output_fname, estimator.n_segments,
+                                    road_section.n_ramps) as output_wr:
+        while estimator.time < time_lim[1]:
+            estimator.run_iteration(cab_data)
+            output_wr.write_row(estimator.time, estimator.state,
+                                estimator.speed_buffer.valid_speeds(12))
+
+
+def fit_fds(fname):
+    # imported here, so that the backend is set before pyplot is first imported
+    import matplotlib
+    matplotlib.use('Agg')
+    import proc.fd
+    return proc.fd.fit_fds([fname])
+
+
+def run_pipeline(paths, args, time_lim):
+    """
+    Run every stage once on the data set at paths
+    :return: dict of stage name to seconds, dict of stage name to the reason
+    it was skipped, number of trace rows, and bytes per row of cab traces
+    """
+    clear_saves(paths)
+    timer = StageTimer()
+    cab_data = timer.time('ingestion', proc.cabdata.CabData, paths['datadir'], args.workers)
+    road_section = timer.time('detector_load', proc.road.RoadSection, paths['road'], paths['vdsdir'])
+    timer.time('calc_xy', cab_data.calc_xy, *road_section.center)
+    timer.time('calc_deltas', cab_data.calc_deltas)
+    timer.time('assign_road_segments', cab_data.assign_road_segments, road_section,
+               11.0, np.deg2rad(30.0))
+    speed_cube = timer.time('speed_cube', proc.speedcube.SpeedCube.build, cab_data, 5,
+                            proc.speedcube.estimator_phase(time_lim[0], 5))
+    output_fname = os.path.join(paths['dirname'], 'estimate_{}_{}.csv'.format(*time_lim))
+    timer.time('estimator_loop', estimate, road_section, speed_cube, time_lim, output_fname)
+    if args.skip_fit:
+        timer.skip('fit_fds', "--skip-fit")
+    else:
+        try:
+            timer.time('fit_fds', fit_fds, output_fname)
+        except (ValueError, TypeError) as err:
+            # fits can fail on small data sets with too few free-flow points
+            logging.getLogger("benchmark").warning("fit_fds failed: {}".format(err))
+            timer.skip('fit_fds', "fit failed: {}".format(err))
+    return (timer.times, timer.skipped, cab_data.n_rows(),
+            cab_data.memory_usage().loc['total', 'bytes_per_row'])
+
+
+def min_times(runs):
+    """
+    :return: dict of the fastest time of each stage timed in every run
+    """
+    return {stage: min(run[stage] for run in runs)
+            for stage in stage_names if all(stage in run for run in runs)}
+
+
+def main():
+    args = args_setup()
+    logging.basicConfig(level=logging.WARNING)
+    logger = logging.getLogger("benchmark")
+    logger.setLevel(logging.INFO)
+    start_time = bench.synthdata.default_start_time + estimation_start_hour * 3600
+    time_lim = (start_time, start_time + args.horizon)
+    results = {'revision': git_revision(), 'created': time.time(),
+               'python': platform.python_version(), 'numpy': np.__version__,
+               'pandas': pd.__version__, 'fixes_per_cab': args.fixes, 'days': args.days,
+               'horizon': args.horizon, 'sizes': []}
+    for n_cabs in args.cabs:
+        dirname = os.path.join(args.workdir, "synth_{}x{}_{}d".format(n_cabs, args.fixes, args.days))
+        gen_start = time.perf_counter()
+        paths = bench.synthdata.generate(dirname, n_cabs, args.fixes, args.days)
+        gen_time = time.perf_counter() - gen_start
+        paths['dirname'] = dirname
+        runs = []
+        skipped = {}
+        for i in range(args.repeat):
+            times, run_skipped, n_rows, bytes_per_row = run_pipeline(paths, args, time_lim)
+            runs.append(times)
+            skipped.update(run_skipped)
+        stage_times = min_times(runs)
+        stage_times['generate'] = gen_time
+        results['sizes'].append({'n_cabs': n_cabs, 'n_rows': n_rows,
+                                 'bytes_per_row': float(bytes_per_row),
+                                 'stages': {stage: stage_times[stage] for stage in stage_names
+                                            if stage in stage_times},
+                                 'skipped': {stage: skipped[stage] for stage in stage_names
+                                             if stage in skipped and stage not in stage_times}})
+        logger.info("{} cabs, {} rows: {}".format(
+            n_cabs, n_rows, ", ".join("{}={:.3f}s".format(stage, stage_times[stage])
+                                      for stage in stage_names if stage in stage_times)))
+    with open(args.output, 'w') as fout:
+        json.dump(results, fout, indent=1)
+    logger.info("Results saved to {}".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
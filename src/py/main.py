@@ -1,58 +1,277 @@
 import argparse
 import os
-import csv
-import numpy as np
+import sys
+import time
 import logging
-import pandas as pd
+import importlib
+import multiprocessing
+from collections import OrderedDict
 
-import vis.core
-import proc.cabdata
-import proc.road
-import proc.estimator
-import proc.detectors
+start_time = time.perf_counter()  # start of the import report
+default_time_lims = [(1211094000, 1211439599),  (1211439600, 1211698799),
+                     (1211698800, 1212044399),  (1212044400, 1212303599)]
+estimation_cols = ['time', 'segment', 'speed']
+estimation_timestep = 5  # seconds between estimator iterations
+# modules listed by the import report when loaded, as they take long to import
+heavy_modules = ['numpy', 'pandas', 'scipy', 'matplotlib', 'matplotlib.pyplot',
+                 'mpl_toolkits.basemap', 'geotiler']
 
 
-def args_setup():
-    args_parser = argparse.ArgumentParser()
+def parse_period(period_str):
+    start, end = period_str.split(':')
+    return int(start), int(end)
+
+
+def add_cab_data_args(args_parser):
+    args_parser.add_argument('--workers', type=int, default=1,
+                             help="Number of threads reading cab trace files")
+    args_parser.add_argument('--partition-len', type=int, default=None, metavar='SECONDS',
+                             help="Split cab traces into partitions of this many seconds, e.g. "
+                                  "86400 for days, processed and loaded one at a time. Default "
+                                  "is all traces in memory")
+
+
+def add_estimate_args(args_parser):
     args_parser.add_argument('datadir', help="Path to cabspottingdata")
     args_parser.add_argument('road', help="Path to road section CSV")
     args_parser.add_argument('vdsdir', help="Path to directory containing stationary detector data")
     args_parser.add_argument('outputdir', help="Path to directory where output will be saved")
-    return args_parser.parse_args()
+    add_cab_data_args(args_parser)
+    args_parser.add_argument('--jobs', type=int, default=1,
+                             help="Number of periods estimated in parallel processes")
+    args_parser.add_argument('--trace', type=int, default=0, metavar='N',
+                             help="Save speeds, states and innovations of the last N "
+                                  "iterations of each period to trace_<start>_<end>.npz")
+    args_parser.add_argument('--periods', type=parse_period, nargs='+', default=default_time_lims,
+                             help="Periods to estimate, as start:end unix times")
+
+
+def args_setup(argv=None):
+    import postproc
+    import render
+    args_parser = argparse.ArgumentParser(
+        description="Traffic state estimation from cab traces and detector data",
+        epilog="Without a command, the arguments are those of estimate")
+    args_parser.add_argument('--import-report', action='store_true',
+                             help="Log the time taken to import the modules of the command "
+                                  "and the heavy modules loaded by the end of the run")
+    subparsers = args_parser.add_subparsers(dest='command', metavar='command')
+    preprocess_parser = subparsers.add_parser(
+        'preprocess', help="Read cab traces, calculate their deltas and road segments and save them")
+    preprocess_parser.add_argument('datadir', help="Path to cabspottingdata")
+    preprocess_parser.add_argument('road', nargs='+',
+                                   help="Paths to road section CSVs. With several, all are "
+                                        "assigned in one pass over the cab traces, as pairs of "
+                                        "section and segment per fix, and the segment column is "
+                                        "that of the first. Sections not assigned yet are added "
+                                        "to saved traces")
+    add_cab_data_args(preprocess_parser)
+    add_estimate_args(subparsers.add_parser(
+        'estimate', help="Estimate road states of periods, preprocessing cab traces if needed"))
+    postproc.add_args(subparsers.add_parser(
+        'fit-fd', help="Fit and test fundamental diagrams of estimator output"))
+    render.add_args(subparsers.add_parser(
+        'render', help="Render frames of cab movement over a map"))
+    argv = sys.argv[1:] if argv is None else argv
+    # the arguments of estimate alone, as main.py took before it had commands
+    first_arg = next((arg for arg in argv if arg != '--import-report'), None)
+    if (first_arg is not None and not first_arg.startswith('-') and
+            first_arg not in subparsers.choices):
+        argv = argv[:argv.index(first_arg)] + ['estimate'] + argv[argv.index(first_arg):]
+    args = args_parser.parse_args(argv)
+    if args.command is None:
+        args_parser.error("a command is required")
+    return args
 
 
-def process_cab_data(args, road_section, time_lims=None):
-    cab_data = proc.cabdata.CabData(args.datadir)
+def import_modules(names):
+    """
+    Import the modules of names that are not imported yet, in order
+    :return: list of tuples (name, seconds taken) of the imported modules
+    """
+    import_times = []
+    for name in names:
+        if name in sys.modules:
+            continue
+        import_start = time.perf_counter()
+        importlib.import_module(name)
+        import_times.append((name, time.perf_counter() - import_start))
+    return import_times
+
+
+def log_import_report(import_times, ready_time):
+    logger = logging.getLogger("main")
+    for name, seconds in import_times:
+        logger.info("Imported {} in {:.0f} ms".format(name, seconds * 1000))
+    logger.info("Ready to run in {:.0f} ms. Heavy modules loaded by the end: {}".format(
+        (ready_time - start_time) * 1000,
+        ", ".join(name for name in heavy_modules if name in sys.modules) or "none"))
+
+
+def process_cab_data(args, road_section, time_lims=None, section_set=None):
+    """
+    :param section_set: optional road.SectionSet to assign with
+    CabData.assign_sections, whose first section is road_section
+    """
+    import numpy as np
+    import proc.cabdata
+    if args.partition_len is not None:
+        if section_set is not None:
+            raise ValueError("Several road sections are not supported with --partition-len")
+        return process_partitioned_cab_data(args, road_section, time_lims)
+    cab_data = proc.cabdata.CabData(args.datadir, args.workers)
     if cab_data.delta_data_exists() is False:
         cab_data.calc_xy(*road_section.center)
         cab_data.calc_deltas()
-        cab_data.assign_road_segments(road_section, 11.0, np.deg2rad(30.0), time_lims)
+        if section_set is None:
+            cab_data.assign_road_segments(road_section, 11.0, np.deg2rad(30.0), time_lims)
+        else:
+            section_ids = cab_data.assign_sections(section_set, 11.0, np.deg2rad(30.0), time_lims)
+            cab_data.segments_from_section(section_ids[0])
         cab_data.save_cabtraces()
+    elif section_set is not None:
+        cab_data.assign_sections(section_set, 11.0, np.deg2rad(30.0), time_lims)
+    logging.getLogger("main").info("Memory of cab traces:\n{}".format(cab_data.memory_usage()))
     return cab_data
 
 
-def main():
-    args = args_setup()
+def process_partitioned_cab_data(args, road_section, time_lims=None):
+    import numpy as np
+    import proc.partitions
+    if not proc.partitions.partitions_exist(args.datadir, args.partition_len):
+        proc.partitions.build_partitions(args.datadir, road_section, args.partition_len,
+                                         args.workers, 11.0, np.deg2rad(30.0), time_lims)
+    cab_data = proc.partitions.PartitionedCabData(args.datadir)
+    logging.getLogger("main").info("{} rows of cab traces in {} partitions".format(
+        cab_data.n_rows(), len(cab_data.partitions.index)))
+    return cab_data
+
+
+def load_cab_data(args, columns=None):
+    """
+    :return: CabData or PartitionedCabData of the processed traces of args.datadir
+    """
+    if args.partition_len is not None:
+        import proc.partitions
+        return proc.partitions.PartitionedCabData(args.datadir, columns=columns)
+    import proc.cabdata
+    return proc.cabdata.CabData(args.datadir, columns=columns)
+
+
+def estimate_period(road_section, cab_data, time_lim, outputdir, trace_len=0):
+    import proc.estimator
+    import proc.output
+    import proc.speedcube
+    speed_cube = proc.speedcube.load_or_build(
+        cab_data, estimation_timestep,
+        proc.speedcube.estimator_phase(time_lim[0], estimation_timestep))
+    estimate = proc.estimator.RoadStateEstimator(road_section, estimation_timestep, time_lim[0],
+                                                 time_lim[1])
+    if trace_len > 0:
+        estimate.enable_trace(trace_len)
+    output_fname = os.path.join(outputdir, 'estimate_{}_{}.csv'.format(*time_lim))
+    with proc.output.EstimateWriter(output_fname, estimate.n_segments,
+                                    road_section.n_ramps) as output_wr:
+        while estimate.time < time_lim[1]:
+            estimate.run_iteration(speed_cube)
+            output_wr.write_row(estimate.time, estimate.state,
+                                estimate.speed_buffer.valid_speeds(12))
+    if estimate.trace is not None:
+        estimate.trace.save(os.path.join(outputdir, 'trace_{}_{}.npz'.format(*time_lim)))
+    return output_fname
+
+
+_worker_data = {}
+
+
+def _init_worker(args):
+    # detector tables come from their binary caches and cab trace columns
+    # are memory-mapped from the columnar save, so workers share the page cache
+    import proc.road
     logging.basicConfig(level=logging.INFO)
+    _worker_data['road_section'] = proc.road.RoadSection(args.road, args.vdsdir)
+    _worker_data['cab_data'] = load_cab_data(args, estimation_cols)
+    _worker_data['outputdir'] = args.outputdir
+    _worker_data['trace_len'] = args.trace
+
+
+def _estimate_period_in_worker(time_lim):
+    return estimate_period(_worker_data['road_section'], _worker_data['cab_data'], time_lim,
+                           _worker_data['outputdir'], _worker_data['trace_len'])
+
+
+def estimate_periods_parallel(args, cab_data, time_lims):
+    """
+    Estimate each period in time_lims on a pool of args.jobs processes
+    :return: list of output file names
+    """
+    import proc.colstore
+    import proc.speedcube
+    if args.partition_len is None and not proc.colstore.store_exists(cab_data.cab_traces_store):
+        cab_data.save_cabtraces()
+    # built once here, so that workers memory-map the saved cubes
+    for phase in sorted(set(proc.speedcube.estimator_phase(time_lim[0], estimation_timestep)
+                            for time_lim in time_lims)):
+        proc.speedcube.load_or_build(cab_data, estimation_timestep, phase)
+    with multiprocessing.Pool(processes=args.jobs, initializer=_init_worker,
+                              initargs=(args,)) as pool:
+        return pool.map(_estimate_period_in_worker, time_lims, chunksize=1)
+
+
+def preprocess(args):
+    import proc.road
+    road_sections = [proc.road.RoadSection(fname, None) for fname in args.road]
+    section_set = None
+    if len(road_sections) > 1:
+        section_set = proc.road.SectionSet(road_sections, road_sections[0].center,
+                                           [os.path.basename(fname) for fname in args.road])
+    process_cab_data(args, road_sections[0], None, section_set)
+
+
+def estimate(args):
+    import proc.road
     road_section = proc.road.RoadSection(args.road, args.vdsdir)
     cab_data = process_cab_data(args, road_section, None)
-    time_lims = [(1211094000, 1211439599),  (1211439600, 1211698799),
-                 (1211698800, 1212044399),  (1212044400, 1212303599)]
-    for time_lim in time_lims:
-        estimate = proc.estimator.RoadStateEstimator(road_section, 5, time_lim[0])
-        output_fname = os.path.join(args.outputdir, 'estimate_{}_{}.csv'.format(*time_lim))
-        # map_plotter = vis.core.MapPlotter(cab_data.cab_traces, road_section.extents)
-        # map_plotter.plot_cabs_in_time((1212080400, 1212080400+60*30))
-        with open(output_fname, 'w', newline='') as outputf:
-            output_wr = csv.writer(outputf, dialect='excel')
-            # map_plotter = vis.core.MapPlotter(cab_data.cab_traces, road_section.extents)
-            while estimate.time < time_lim[1]:
-                estimate.run_iteration(cab_data)
-                output_row = np.append(estimate.time, np.append(estimate.state, np.array(estimate.speed_buffer.valid_speeds(12))))
-                output_wr.writerow(output_row)
-                pass
-        # map_plotter.plot_cabs_in_time([estimate.time - estimate.timestep + 1, estimate.time])
-    # vis.core.plot_timestamps(cab_data.cab_traces, 1212991838, 1212995438)
+    if args.jobs > 1:
+        estimate_periods_parallel(args, cab_data, args.periods)
+    else:
+        for time_lim in args.periods:
+            estimate_period(road_section, cab_data, time_lim, args.outputdir, args.trace)
+
+
+def fit_fd(args):
+    import postproc
+    postproc.run(args)
+
+
+def render_frames(args):
+    import render
+    render.run(args)
+
+
+# function of each command and the modules it imports before running.
+# Plotting modules are left to the commands, which set the matplotlib backend first
+commands = OrderedDict([
+    ('preprocess', (preprocess, ['numpy', 'pandas', 'proc.road', 'proc.cabdata',
+                                 'proc.partitions'])),
+    ('estimate', (estimate, ['numpy', 'pandas', 'proc.road', 'proc.cabdata', 'proc.partitions',
+                             'proc.estimator', 'proc.output', 'proc.speedcube'])),
+    ('fit-fd', (fit_fd, ['numpy', 'pandas', 'proc.fd'])),
+    ('render', (render_frames, ['numpy', 'pandas', 'proc.road', 'proc.cabdata'])),
+])
+
+
+def main():
+    args = args_setup()
+    logging.basicConfig(level=logging.INFO)
+    command, modules = commands[args.command]
+    import_times = import_modules(modules)
+    ready_time = time.perf_counter()
+    try:
+        command(args)
+    finally:
+        if args.import_report:
+            log_import_report(import_times, ready_time)
 
 
 if __name__ == "__main__":
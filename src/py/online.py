@@ -0,0 +1,47 @@
+import argparse
+import asyncio
+import logging
+
+import proc.road
+import proc.online
+import proc.output
+
+
+def args_setup():
+    args_parser = argparse.ArgumentParser(
+        description="Estimate road state online from a feed of cab fixes and detector samples")
+    args_parser.add_argument('road', help="Path to road section CSV")
+    args_parser.add_argument('source', help="Feed to read: tcp:<host>:<port>, unix:<path>, "
+                                            "- for standard input, or a file path")
+    args_parser.add_argument('output', help="Path of the CSV estimates are written to")
+    args_parser.add_argument('--timestep', type=int, default=5, help="Seconds between estimates")
+    args_parser.add_argument('--lag', type=int, default=300,
+                             help="Seconds of feed time that data may arrive late. Detector "
+                                  "samples are only interpolated within this window")
+    args_parser.add_argument('--start', type=int, default=None,
+                             help="Unix time of the initial state; default is the first feed time")
+    args_parser.add_argument('--follow', action='store_true',
+                             help="Keep reading a file source as it grows")
+    return args_parser.parse_args()
+
+
+def main():
+    args = args_setup()
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("online")
+    road_section = proc.road.RoadSection(args.road, None)
+    n_segments = len(road_section.segments.index)
+    with proc.output.EstimateWriter(args.output, n_segments, road_section.n_ramps,
+                                    block_rows=1, flush_blocks=True) as output_wr:
+        online_estimator = proc.online.OnlineEstimator(road_section, args.timestep,
+                                                       output_wr.write_row, args.start, args.lag)
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(proc.online.run_online(online_estimator, args.source,
+                                                       args.follow))
+    logger.info("{} estimates written; {} late and {} out of order fixes ignored".format(
+        online_estimator.n_estimates, online_estimator.cab_data.n_late,
+        online_estimator.cab_data.n_out_of_order))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,139 @@
 import argparse
-import proc.fd
+import os
+import logging
+import multiprocessing
 
+fit_table_cols = ['segment', 'n_train', 'n_free', 'v_free', 'q_free_0', 'flow_cap', 'rho_crit',
+                  'v_cong', 'q_cong_0', 'n_test', 'rmse_free', 'rmse_cong', 'error']
 
-def main():
-    args_parser = argparse.ArgumentParser()
+
+def add_args(args_parser):
     args_parser.add_argument('--training', help="Path of CSV(s) of estimator output for training", nargs='+')
     args_parser.add_argument('--test', help="Path of CSV(s) of estimator output for testing", nargs='+')
-    args = args_parser.parse_args()
-    fd_fits = proc.fd.fit_fds(args.training)
-    proc.fd.test_fd(args.test, fd_fits)
+    args_parser.add_argument('--batch', action='store_true',
+                             help="Fit without interaction: write fits and scores to --output, "
+                                  "and plots to --plot-dir instead of showing them")
+    args_parser.add_argument('--output', default="fd_fits.csv",
+                             help="Path of the CSV table of fits and scores in batch mode")
+    args_parser.add_argument('--plot-dir', default=None,
+                             help="Directory where plots are saved in batch mode. Default is no plots")
+    args_parser.add_argument('--jobs', type=int, default=1,
+                             help="Number of segments fitted in parallel processes in batch mode")
+    args_parser.add_argument('--chunksize', type=int, default=100000,
+                             help="Number of CSV rows read at once in batch mode")
+
+
+def args_setup():
+    args_parser = argparse.ArgumentParser()
+    add_args(args_parser)
+    return args_parser.parse_args()
+
+
+def _fit_row(segment_num, fd_fit, train_data, test_data, scores, error=None):
+    import numpy as np
+    row = dict.fromkeys(fit_table_cols)
+    row.update({'segment': segment_num, 'n_train': len(train_data.index), 'error': error})
+    if test_data is not None:
+        row['n_test'] = len(test_data.index)
+    if fd_fit is None:
+        return row
+    row.update({'n_free': int(np.sum(fd_fit['freeflow_filt'])),
+                'v_free': fd_fit['freeflow_fit'][0], 'q_free_0': fd_fit['freeflow_fit'][1],
+                'flow_cap': fd_fit['flow_cap'], 'rho_crit': fd_fit['rho_crit']})
+    if fd_fit['cong_fit'] is not None:
+        row['v_cong'], row['q_cong_0'] = fd_fit['cong_fit']
+    if scores is not None:
+        row['rmse_free'], row['rmse_cong'] = (scores['rmse_free'], scores['rmse_cong'])
+    return row
+
+
+def fit_and_test_segment(task):
+    """
+    :param task: tuple (segment number, training data, test data or None)
+    :return: tuple (table row, fit or None if fitting failed, test scores or None)
+    """
+    import numpy as np
+    import proc.fd
+    segment_num, train_data, test_data = task
+    try:
+        fd_fit = proc.fd.fit_segment(train_data)
+    except (ValueError, TypeError, np.linalg.LinAlgError) as err:
+        logging.getLogger("postproc").warning("Segment {}: fit failed: {}".format(segment_num + 1, err))
+        return _fit_row(segment_num, None, train_data, test_data, None, str(err)), None, None
+    scores = proc.fd.test_segment(test_data, fd_fit) if test_data is not None else None
+    return _fit_row(segment_num, fd_fit, train_data, test_data, scores), fd_fit, scores
+
+
+def plot_segment(task):
+    """
+    Save the training and, if any, validation plot of a fitted segment
+    :param task: tuple (segment number, training data, test data or None, fit,
+    test scores or None, plot directory)
+    """
+    import vis.fd
+    segment_num, train_data, test_data, fd_fit, scores, plot_dir = task
+    vis.fd.plot_fd(train_data['density'], train_data['flow'], fd_fit,
+                   "Segment {} training set".format(segment_num + 1),
+                   os.path.join(plot_dir, "fd_segment_{}_training.png".format(segment_num)))
+    if test_data is not None:
+        vis.fd.plot_test_data(test_data, fd_fit, scores['cong_bins_rho'], scores['cong_bins_q'],
+                              "Segment {} validation set".format(segment_num + 1),
+                              os.path.join(plot_dir, "fd_segment_{}_validation.png".format(segment_num)))
+
+
+def fit_fds_batch(args):
+    """
+    Fit and score every segment, write the table of results to args.output,
+    then render plots if args.plot_dir is set
+    :return: DataFrame of fits and scores, one row per segment
+    """
+    import pandas as pd
+    import proc.fd
+    logger = logging.getLogger("postproc")
+    train = proc.fd.read_estimates(args.training, args.chunksize)
+    test = proc.fd.read_estimates(args.test, args.chunksize) if args.test else None
+    n_segments = len(train.filter(regex="speed_").columns)
+    tasks = [(i, proc.fd.segment_data(train, i),
+              proc.fd.segment_data(test, i) if test is not None else None)
+             for i in range(n_segments)]
+    del train, test
+    pool = multiprocessing.Pool(processes=args.jobs) if args.jobs > 1 else None
+    try:
+        map_func = pool.map if pool is not None else lambda func, items: list(map(func, items))
+        results = map_func(fit_and_test_segment, tasks)
+        table = pd.DataFrame([result[0] for result in results], columns=fit_table_cols)
+        table.to_csv(args.output, index=False)
+        logger.info("{} of {} segments fitted, results saved to {}".format(
+            int(table['error'].isnull().sum()), n_segments, args.output))
+        if args.plot_dir is not None:
+            os.makedirs(args.plot_dir, exist_ok=True)
+            plot_tasks = [task + (fd_fit, scores, args.plot_dir)
+                          for task, (row, fd_fit, scores) in zip(tasks, results) if fd_fit is not None]
+            map_func(plot_segment, plot_tasks)
+            logger.info("Plots saved to {}".format(args.plot_dir))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return table
+
+
+def run(args):
+    if args.batch:
+        # set before pyplot is first imported, so plots render without a display
+        import matplotlib
+        matplotlib.use('Agg')
+        fit_fds_batch(args)
+    else:
+        import proc.fd
+        fd_fits = proc.fd.fit_fds(args.training)
+        proc.fd.test_fd(args.test, fd_fits)
+
+
+def main():
+    args = args_setup()
+    logging.basicConfig(level=logging.INFO)
+    run(args)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
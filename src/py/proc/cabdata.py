@@ -1,104 +1,586 @@
 import os
+import re
+import time
+import logging
 import numpy as np
 import pandas as pd
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 
 from proc import gps
+from proc import colstore
+
+cab_tag_re = re.compile(r'<[^>\n]*?cab id="([^"]*)"[^>\n]*?updates="([0-9]+)"[^>\n]*/>')
+trace_dtypes = {'lat': np.float64, 'long': np.float64, 'occupancy': np.int64, 'time': np.int64}
+trace_file_cols = ['lat', 'long', 'occupancy', 'time']
+delta_cols = ['vx', 'vy', 'speed', 'dir']
+section_assignment_cols = ['row', 'section', 'segment']
+section_dtype = np.int16  # dtype of section ids of section assignments
+# dtypes of the columns of cab_traces. Times are unix seconds, which fit
+# int32 until 2038; lat and long keep the precision of the trace files
+compact_dtypes = {'lat': np.float64, 'long': np.float64, 'occupancy': np.int8, 'time': np.int32,
+                  'x': np.float32, 'y': np.float32, 'vx': np.float32, 'vy': np.float32,
+                  'speed': np.float32, 'dir': np.float32, 'segment': gps.segment_dtype}
+
+
+def to_compact(col, values):
+    """
+    :return: array of values of column col of cab_traces in its compact dtype
+    :raises ValueError: if integer values do not fit the compact dtype
+    """
+    dtype = np.dtype(compact_dtypes[col])
+    values = np.asarray(values)
+    if dtype.kind == 'i' and values.dtype.kind in 'iu' and len(values) > 0:
+        info = np.iinfo(dtype)
+        if values.min() < info.min or values.max() > info.max:
+            raise ValueError("Column {}: values outside the range of {}".format(col, dtype))
+    return values.astype(dtype, copy=False)
+
+
+def compact_cab_traces(cab_traces):
+    """
+    Convert the columns of cab_traces to their compact dtypes, and cab_id to
+    a categorical, where they are not yet
+    :return: cab_traces
+    """
+    for col in cab_traces.columns:
+        if col == 'cab_id':
+            if not isinstance(cab_traces[col].dtype, pd.api.types.CategoricalDtype):
+                cab_traces[col] = pd.Categorical(cab_traces[col])
+        elif col in compact_dtypes and cab_traces[col].dtype != compact_dtypes[col]:
+            values = cab_traces[col].values
+            if col == 'segment':
+                # saved before segments were integers, NaN where not assigned
+                values = np.where(np.isnan(values), -1, values) if values.dtype.kind == 'f' else values
+            cab_traces[col] = to_compact(col, values)
+    return cab_traces
+
+
+def read_cab_list(fname):
+    """
+    :param fname: path of a cabspotting _cabs.txt cab list
+    :return: DataFrame of id and number of updates of each cab
+    """
+    with open(fname, 'r') as fin:
+        contents = fin.read()
+    cab_tags = cab_tag_re.findall(contents)
+    n_lines = sum(1 for line in contents.splitlines() if line.strip())
+    if n_lines > len(cab_tags):
+        warnings.warn("{} lines do not look like tags. Ignored!".format(n_lines - len(cab_tags)))
+    return pd.DataFrame({'id': [tag[0] for tag in cab_tags],
+                         'updates': [int(tag[1]) for tag in cab_tags]},
+                        columns=['id', 'updates'])
+
+
+def write_cab_list(fname, cab_ids, n_updates):
+    """
+    Write a cab list in the format of cabspotting's _cabs.txt
+    """
+    with open(fname, 'w') as fout:
+        for cab_id, n in zip(cab_ids, n_updates):
+            fout.write('<cab id="{}" updates="{}"/>\n'.format(cab_id, n))
+
+
+def read_cabtrace_file(fname):
+    """
+    :param fname: path of a cabspotting new_<id>.txt trace file
+    :return: DataFrame of the file's fixes, sorted by increasing time
+    """
+    data = pd.read_csv(fname, delim_whitespace=True, names=trace_file_cols, dtype=trace_dtypes)
+    times = data['time'].values
+    if np.any(times[1:] < times[:-1]):
+        if np.all(times[1:] <= times[:-1]):
+            data = data.iloc[::-1]
+        else:
+            data = data.iloc[np.argsort(times, kind='mergesort')]
+    return data
+
+
+def cab_block_starts(cab_ids):
+    """
+    :param cab_ids: array of cab id of each row
+    :return: tuple (order, starts): order is None if the rows of each cab are
+    consecutive, otherwise a stable permutation of rows that makes them so.
+    starts is a boolean array, True at the first row of each cab in that order
+    """
+    codes = pd.factorize(cab_ids)[0]
+    starts = np.empty(len(codes), dtype=bool)
+    starts[:1] = True
+    np.not_equal(codes[1:], codes[:-1], out=starts[1:])
+    order = None
+    if len(codes) > 0 and np.count_nonzero(starts) != codes.max() + 1:
+        order = np.argsort(codes, kind='mergesort')
+        codes = codes[order]
+        np.not_equal(codes[1:], codes[:-1], out=starts[1:])
+    return order, starts
+
+
+def calc_deltas_arrays(times, xs, ys, starts, dtime_max, prev_fixes=None):
+    """
+    Velocity, speed and direction of each fix from the previous row, for rows
+    laid out in consecutive blocks per cab
+    :param times: array of times of fixes
+    :param xs: array of x of fixes
+    :param ys: array of y of fixes
+    :param starts: boolean array, True at the first row of each cab's block
+    :param dtime_max: maximum delta time for valid velocity, in seconds
+    :param prev_fixes: optional tuple of arrays (times, xs, ys) of the fix
+    before the first row of each block, NaN where there is none. By default,
+    there is none for any block
+    :return: tuple of float64 arrays (vx, vy, speed, dir). Velocities are
+    NaN where there is no valid previous fix, and speed is 0 there
+    """
+    n_rows = len(times)
+    dtimes = np.empty(n_rows)
+    vx = np.empty(n_rows)
+    vy = np.empty(n_rows)
+    # in float64 whatever the dtypes of the columns
+    np.subtract(times[1:], times[:-1], out=dtimes[1:], dtype=np.float64)
+    np.subtract(xs[1:], xs[:-1], out=vx[1:], dtype=np.float64)
+    np.subtract(ys[1:], ys[:-1], out=vy[1:], dtype=np.float64)
+    start_idxs = np.flatnonzero(starts)
+    if prev_fixes is None:
+        dtimes[start_idxs] = np.nan
+    else:
+        dtimes[start_idxs] = times[start_idxs] - prev_fixes[0]
+        vx[start_idxs] = xs[start_idxs] - prev_fixes[1]
+        vy[start_idxs] = ys[start_idxs] - prev_fixes[2]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dtimes[dtimes > dtime_max] = np.nan
+        vx /= dtimes
+        vy /= dtimes
+    del dtimes
+    speeds = np.square(vx)
+    speeds[np.isnan(speeds)] = 0.0
+    vy_sqr = np.square(vy)
+    vy_sqr[np.isnan(vy_sqr)] = 0.0
+    speeds += vy_sqr
+    del vy_sqr
+    np.sqrt(speeds, out=speeds)
+    return vx, vy, speeds, np.arctan2(vy, vx)
+
+
+def avg_segment_speeds(segment_col, speeds):
+    """
+    :param segment_col: array of assigned segment of each row, negative where unassigned
+    :param speeds: array of speed of each row
+    :return: Series of mean speed of each segment with assigned rows,
+    indexed by segment. Segments whose rows have no speed get NaN
+    """
+    on_road = segment_col >= 0
+    segment_col = segment_col[on_road].astype(np.int64)
+    speeds = speeds[on_road]
+    valid = np.invert(np.isnan(speeds))
+    n_rows = np.bincount(segment_col)
+    speed_sums = np.bincount(segment_col[valid], weights=speeds[valid], minlength=len(n_rows))
+    n_speeds = np.bincount(segment_col[valid], minlength=len(n_rows))
+    assigned = np.flatnonzero(n_rows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_speeds = speed_sums[assigned] / n_speeds[assigned]
+    return pd.Series(mean_speeds, index=pd.Index(assigned, name='segment'), name='speed')
 
 
 class CabData(object):
-    def __init__(self, dirname):
+    def __init__(self, dirname, n_workers=1, columns=None, cab_traces=None):
+        """
+        :param dirname: path to cabspotting data
+        :param n_workers: number of threads reading trace files, if traces
+        are not loaded from a save
+        :param columns: columns of cab_traces to load from a columnar save,
+        or None for all
+        :param cab_traces: DataFrame with the columns of read_cabtraces, used
+        instead of reading or loading the traces of dirname
+        """
+        self.logger = logging.getLogger("CabData")
         self._dirname = dirname
         self._fname = os.path.join(dirname, "_cabs.txt")
         self.cab_list = None
-        self.cab_traces = None
+        self.store = None
+        self._store_columns = None
+        self._cab_traces = None
+        self._time_order = None
+        self._sorted_times = None
+        self._xy_center = None
+        self.saved_at = None  # of the columnar save cab_traces equals, if any
+        self.save_dir = dirname
         self.cab_traces_file = os.path.join(dirname, "cab_traces.pickle")
+        self.cab_traces_store = os.path.join(dirname, "cab_traces.cols")
+        self.time_index_store = os.path.join(dirname, "cab_traces_time_index.cols")
+        self.section_assignments_store = os.path.join(dirname, "section_assignments.cols")
+        self._section_assignments = None
+        self._section_names = []
         self.read_cablist()
-        if os.path.isfile(self.cab_traces_file):
+        if cab_traces is not None:
+            self.cab_traces = compact_cab_traces(cab_traces)
+        elif colstore.store_exists(self.cab_traces_store):
+            self.cabtraces_from_save(self.cab_traces_store, columns)
+        elif os.path.isfile(self.cab_traces_file):
             self.cabtraces_from_save(self.cab_traces_file)
         else:
-            self.read_cabtraces()
+            self.read_cabtraces(n_workers)
             self.save_cabtraces()
 
-    def _tag_value(self, line, tag_name):
-        try:
-            search_str = '{}="'.format(tag_name)
-            start_idx = line.index(search_str) + len(search_str)
-            end_idx = line.index('"', start_idx)
-            return line[start_idx:end_idx]
-        except ValueError as valerr:
-            print(valerr)
-
-    def _proc_line(self, line):
-        line_s = line.rstrip()
-        if line_s.startswith('<') and line_s.endswith('/>'):
-            cab_id = self._tag_value(line_s, "cab id")
-            updates = int(self._tag_value(line_s, "updates"))
-            cab = {'id': cab_id, 'updates': updates}
-            return cab
+    @property
+    def cab_traces(self):
+        """
+        DataFrame of all cab traces. When loaded from a columnar save, it is
+        only materialized on first access; column() reads single columns
+        without doing so
+        """
+        if self._cab_traces is None and self.store is not None:
+            self._cab_traces = compact_cab_traces(self.store.to_frame(self._store_columns))
+        return self._cab_traces
+
+    @cab_traces.setter
+    def cab_traces(self, cab_traces):
+        self._cab_traces = cab_traces
+        self.store = None
+        self.saved_at = None
+
+    def column(self, col):
+        """
+        :return: array of values of a column of cab_traces, memory-mapped
+        from the columnar save if cab_traces was not materialized
+        """
+        if self._cab_traces is None and self.store is not None:
+            return self.store.array(col)
+        return self._cab_traces[col].values
+
+    def has_column(self, col):
+        if self._cab_traces is None and self.store is not None:
+            return col in self.store
+        return col in self._cab_traces.columns
+
+    def n_rows(self):
+        if self._cab_traces is None and self.store is not None:
+            return self.store.n_rows
+        return len(self._cab_traces.index)
+
+    def memory_usage(self):
+        """
+        :return: DataFrame of dtype, bytes and bytes per row of each column
+        of cab_traces and of the time index if built, with a 'total' row.
+        Columns of a columnar save count their stored arrays
+        """
+        if self._cab_traces is None and self.store is not None:
+            arrays = [(col, self.store.array(col)) for col in self.store.columns]
+            usage = [(col, str(values.dtype), values.nbytes) for col, values in arrays]
         else:
-            warnings.warn("Line does not look like a tag. Ignored!")
+            nbytes = self._cab_traces.memory_usage(index=False, deep=True)
+            usage = [(col, str(self._cab_traces[col].dtype), nbytes[col])
+                     for col in self._cab_traces.columns]
+        if self._time_order is not None:
+            usage += [('time_order', str(self._time_order.dtype), self._time_order.nbytes),
+                      ('sorted_times', str(self._sorted_times.dtype), self._sorted_times.nbytes)]
+        usage = pd.DataFrame(usage, columns=['column', 'dtype', 'bytes']).set_index('column')
+        usage.loc['total'] = ['', usage['bytes'].sum()]
+        usage['bytes_per_row'] = usage['bytes'] / max(self.n_rows(), 1)
+        return usage
 
     def read_cablist(self):
-        cab_list = []
-        with open(self._fname, 'r') as fin:
-            for line in fin:
-                cab_data = self._proc_line(line)
-                if cab_data is not None:
-                    cab_list.append(cab_data)
-        self.cab_list = pd.DataFrame(cab_list)
+        self.cab_list = read_cab_list(self._fname)
 
     def cab_id_to_fname(self, cab_id):
         return os.path.join(self._dirname, "new_{}.txt".format(cab_id))
 
-    def read_cabtraces(self):
+    def read_cabtraces(self, n_workers=1):
+        """
+        Read the trace file of each cab in cab_list directly into its slice of
+        preallocated columns, sized by the cab list's update counts. Cabs are
+        laid out in order of cab id, so the result is sorted by cab id and time
+        without a global sort.
+        :param n_workers: number of threads reading trace files
+        """
         assert(self.cab_list is not None)
-        id_col = self.cab_list['id'].apply(self.cab_id_to_fname)
-        flist = self.cab_list.assign(fname=id_col)
-        cab_data_list = []
-        for cabf in flist.itertuples():
-            cab_data = pd.read_csv(cabf.fname, delim_whitespace=True,
-                                   names=['lat', 'long', 'occupancy', 'time'])
-            cab_data_list.append(cab_data.assign(cab_id=cabf.id))
-        self.cab_traces = pd.concat(cab_data_list, ignore_index=True)
-        self.cab_traces.sort_values(by=['cab_id', 'time'], inplace=True)
-        self.cab_traces.reset_index(drop=True, inplace=True)
-
-    def save_cabtraces(self):
-        self.cab_traces.to_pickle(self.cab_traces_file)
-
-    def cabtraces_from_save(self, fname):
-        self.cab_traces = pd.read_pickle(fname)
+        start_time = time.time()
+        cab_list = self.cab_list.sort_values('id', kind='mergesort')
+        cab_ids = cab_list['id'].values
+        n_rows = cab_list['updates'].values.astype(np.int64)
+        offsets = np.concatenate(([0], np.cumsum(n_rows)))
+        columns = {col: np.empty(offsets[-1], dtype=compact_dtypes[col]) for col in trace_file_cols}
+
+        def read_into_columns(cab_idx):
+            cab_data = read_cabtrace_file(self.cab_id_to_fname(cab_ids[cab_idx]))
+            if len(cab_data.index) != n_rows[cab_idx]:
+                return cab_data
+            for col in trace_file_cols:
+                columns[col][offsets[cab_idx]:offsets[cab_idx + 1]] = to_compact(col, cab_data[col].values)
+            return None
+
+        if n_workers > 1:
+            with ThreadPoolExecutor(max_workers=n_workers) as pool:
+                mismatched = list(pool.map(read_into_columns, range(len(cab_ids))))
+        else:
+            mismatched = [read_into_columns(cab_idx) for cab_idx in range(len(cab_ids))]
+        if any(cab_data is not None for cab_data in mismatched):
+            columns, n_rows = self._fix_mismatched_cabtraces(columns, offsets, cab_ids,
+                                                              mismatched)
+        cab_codes, cab_categories = pd.factorize(cab_ids)
+        columns['cab_id'] = pd.Categorical.from_codes(np.repeat(cab_codes, n_rows), cab_categories)
+        self.cab_traces = pd.DataFrame(columns, columns=trace_file_cols + ['cab_id'])
+        self.invalidate_time_index()
+        elapsed = time.time() - start_time
+        self.logger.info("Read {} rows of {} cabs in {:.2f} s ({:.0f} rows/s)".format(
+            len(self.cab_traces.index), len(cab_ids), elapsed,
+            len(self.cab_traces.index) / max(elapsed, 1e-9)))
+
+    def _fix_mismatched_cabtraces(self, columns, offsets, cab_ids, mismatched):
+        """
+        Rebuild columns where cab trace files had a different number of rows
+        than their cab list update count
+        :return: tuple (columns, number of rows of each cab)
+        """
+        n_rows = np.diff(offsets)
+        for cab_idx, cab_data in enumerate(mismatched):
+            if cab_data is not None:
+                warnings.warn("Cab {}: {} rows read, {} updates listed".format(
+                    cab_ids[cab_idx], len(cab_data.index), n_rows[cab_idx]))
+        new_n_rows = np.array([n if cab_data is None else len(cab_data.index)
+                               for n, cab_data in zip(n_rows, mismatched)], dtype=np.int64)
+        new_columns = {}
+        for col in trace_file_cols:
+            pieces = [columns[col][offsets[cab_idx]:offsets[cab_idx + 1]] if cab_data is None
+                      else cab_data[col].values
+                      for cab_idx, cab_data in enumerate(mismatched)]
+            new_columns[col] = to_compact(col, np.concatenate(pieces)) if pieces else columns[col]
+        return new_columns, new_n_rows
+
+    def save_cabtraces(self, columnar=True):
+        """
+        :param columnar: save to a columnar store of one file per column,
+        otherwise to a single pickle
+        """
+        if columnar:
+            saved_at = time.time()
+            colstore.save_frame(self.cab_traces_store, self.cab_traces,
+                                meta={'saved_at': saved_at, 'xy_center': self._xy_center})
+            self.save_time_index(saved_at)
+            self.saved_at = saved_at
+            if self._section_names:
+                self.save_section_assignments()
+        else:
+            self.cab_traces.to_pickle(self.cab_traces_file)
+
+    def cabtraces_from_save(self, fname, columns=None):
+        """
+        :param fname: path of a columnar store directory or of a pickle
+        :param columns: columns to load from a columnar store, or None for all
+        """
+        if os.path.isdir(fname):
+            self._cab_traces = None
+            self.store = colstore.ColumnStore(fname)
+            self._store_columns = columns
+            if self.store.meta.get('xy_center') is not None:
+                self._xy_center = tuple(self.store.meta['xy_center'])
+            self.saved_at = self.store.meta.get('saved_at')
+            self._section_assignments_from_save()
+        else:
+            self.cab_traces = compact_cab_traces(pd.read_pickle(fname))
+        self.invalidate_time_index()
 
     def calc_xy(self, lat_center, long_center):
-        self.cab_traces['x'] = gps.long_to_x(self.cab_traces['long'],
-                                             lat_center, long_center)
-        self.cab_traces['y'] = gps.lat_to_y(self.cab_traces['lat'], lat_center)
+        """
+        Calculate x and y of each row in the frame centered at lat_center,
+        long_center. Section assignments of the previous x and y are dropped
+        """
+        self._xy_center = (lat_center, long_center)
+        self.cab_traces['x'] = to_compact('x', gps.long_to_x(self.cab_traces['long'].values,
+                                                             lat_center, long_center))
+        self.cab_traces['y'] = to_compact('y', gps.lat_to_y(self.cab_traces['lat'].values, lat_center))
+        self._clear_section_assignments()
+        self.saved_at = None
 
-    def calc_deltas(self, dtime_max=90):
+    def calc_deltas(self, dtime_max=90, prev_fixes=None):
         """
+        Calculate vx, vy, speed and dir of each row from the previous row of
+        its cab, with array operations on cab blocks instead of a groupby.
+        Section assignments of the previous directions are dropped
         :param dtime_max: Maximum delta time for valid velocity, in seconds
-        :return:
+        :param prev_fixes: optional tuple of arrays (times, xs, ys) of the
+        last fix of each cab before the rows of cab_traces, indexed by code
+        of the cab_id categories, NaN for cabs without one
+        """
+        order, starts = cab_block_starts(self.cab_traces['cab_id'].values)
+        cols = [self.cab_traces[col].values for col in ['time', 'x', 'y']]
+        if order is not None:
+            cols = [values[order] for values in cols]
+        block_prev_fixes = None
+        if prev_fixes is not None:
+            codes = self.cab_traces['cab_id'].cat.codes.values
+            block_codes = (codes[order] if order is not None else codes)[starts]
+            block_prev_fixes = tuple(values[block_codes] for values in prev_fixes)
+        deltas = calc_deltas_arrays(cols[0], cols[1], cols[2], starts, dtime_max, block_prev_fixes)
+        for col, values in zip(delta_cols, deltas):
+            if order is not None:
+                unordered = np.empty_like(values)
+                unordered[order] = values
+                values = unordered
+            self.cab_traces[col] = to_compact(col, values)
+        self._clear_section_assignments()
+        self.saved_at = None
+
+    def append_cabtraces(self, new_traces, dtime_max=90):
+        """
+        Append rows to cab_traces. If deltas were calculated, only the deltas
+        of the new rows are calculated, from the previous row of their cab
+        :param new_traces: DataFrame with the columns of read_cabtraces,
+        sorted by time within each cab
+        :param dtime_max: Maximum delta time for valid velocity, in seconds
+        """
+        new_traces = new_traces.reset_index(drop=True)
+        new_traces['cab_id'] = self._cab_ids_as_categorical(new_traces['cab_id'].values)
+        if self.has_column('x'):
+            if self._xy_center is None:
+                raise ValueError("Center of x, y of cab traces is unknown")
+            new_traces['x'] = to_compact('x', gps.long_to_x(new_traces['long'].values,
+                                                            *self._xy_center))
+            new_traces['y'] = to_compact('y', gps.lat_to_y(new_traces['lat'].values,
+                                                           self._xy_center[0]))
+        if self.delta_data_exists():
+            order, starts = cab_block_starts(new_traces['cab_id'].values)
+            if order is not None:
+                new_traces = new_traces.iloc[order].reset_index(drop=True)
+            prev_fixes = self._last_fixes_of_cabs(new_traces['cab_id'].cat.codes.values[starts])
+            deltas = calc_deltas_arrays(new_traces['time'].values, new_traces['x'].values,
+                                        new_traces['y'].values, starts, dtime_max, prev_fixes)
+            for col, values in zip(delta_cols, deltas):
+                new_traces[col] = values
+        if self.has_column('segment'):
+            new_traces['segment'] = -1
+        new_traces = compact_cab_traces(new_traces)
+        self.cab_traces = pd.concat([self.cab_traces, new_traces[self.cab_traces.columns]],
+                                    ignore_index=True)
+        self.invalidate_time_index()
+
+    def _cab_ids_as_categorical(self, cab_ids):
+        """
+        Add the cab ids of cab_ids missing from the categories of the cab_id
+        column of cab_traces
+        :return: Categorical of cab_ids, with the categories of that column
+        """
+        compact_cab_traces(self.cab_traces)
+        categories = self.cab_traces['cab_id'].cat.categories
+        new_categories = pd.Index(pd.unique(np.asarray(cab_ids))).difference(categories)
+        if len(new_categories) > 0:
+            self.cab_traces['cab_id'] = self.cab_traces['cab_id'].cat.add_categories(new_categories)
+            categories = self.cab_traces['cab_id'].cat.categories
+        return pd.Categorical(cab_ids, categories=categories)
+
+    def _last_fixes_of_cabs(self, cab_codes):
+        """
+        :param cab_codes: array of codes of cabs in the cab_id categories of cab_traces
+        :return: tuple of arrays (times, xs, ys) of the last row of each cab
+        of cab_codes in cab_traces, NaN for cabs without rows
+        """
+        all_codes = self.cab_traces['cab_id'].cat.codes.values
+        # the first occurrence of a cab in reversed rows is its last row
+        codes, reversed_rows = np.unique(all_codes[::-1], return_index=True)
+        last_rows = np.full(len(self.cab_traces['cab_id'].cat.categories), -1, dtype=np.int64)
+        last_rows[codes] = len(all_codes) - 1 - reversed_rows
+        rows = last_rows[cab_codes]
+        found = rows >= 0
+        prev_fixes = []
+        for col in ['time', 'x', 'y']:
+            values = np.full(len(cab_codes), np.nan)
+            values[found] = self.cab_traces[col].values[rows[found]]
+            prev_fixes.append(values)
+        return tuple(prev_fixes)
+
+    def last_fixes(self):
+        """
+        :return: tuple of arrays (times, xs, ys) of the last row of each cab,
+        indexed by code of the cab_id categories, NaN for cabs without rows
         """
-        cab_traces_grouped = self.cab_traces.groupby('cab_id')[['time', 'x', 'y']]
-        delta = cab_traces_grouped.shift(0) - cab_traces_grouped.shift(1)
-        delta.loc[delta['time'] > dtime_max, 'time'] = np.nan
-        self.cab_traces['vx'] = delta['x'] / delta['time']
-        self.cab_traces['vy'] = delta['y'] / delta['time']
-        self.cab_traces['speed'] = np.sqrt(np.square(self.cab_traces[['vx', 'vy']]).sum(axis=1))
-        self.cab_traces['dir'] = np.arctan2(self.cab_traces['vy'], self.cab_traces['vx'])
+        n_cabs = len(self.cab_traces['cab_id'].cat.categories)
+        return self._last_fixes_of_cabs(np.arange(n_cabs))
 
     def delta_data_exists(self):
-        return 'dir' in self.cab_traces.columns
+        return self.has_column('dir')
+
+    def invalidate_time_index(self):
+        """
+        Must be called whenever rows of cab_traces or their times change
+        """
+        self._time_order = None
+        self._sorted_times = None
+
+    def _build_time_index(self):
+        if self._time_index_from_save():
+            return
+        times = self.column('time')
+        self._time_order = np.argsort(times, kind='mergesort')
+        if len(times) <= np.iinfo(np.int32).max:
+            self._time_order = self._time_order.astype(np.int32)
+        self._sorted_times = times[self._time_order]
+
+    def save_time_index(self, saved_at):
+        """
+        Save the time index next to the columnar save of cab_traces, so that
+        processes loading the save memory-map it instead of sorting again
+        :param saved_at: 'saved_at' of the columnar save's manifest
+        """
+        if self._time_order is None:
+            self._build_time_index()
+        index = pd.DataFrame({'order': self._time_order, 'time': self._sorted_times},
+                             columns=['order', 'time'])
+        colstore.save_frame(self.time_index_store, index, meta={'saved_at': saved_at})
+
+    def _time_index_from_save(self):
+        """
+        :return: True if the time index was memory-mapped from a save that
+        matches the columnar save cab_traces was loaded from
+        """
+        if self._cab_traces is not None or self.store is None:
+            return False
+        if not colstore.store_exists(self.time_index_store):
+            return False
+        index = colstore.ColumnStore(self.time_index_store)
+        if index.meta.get('saved_at') != self.store.meta.get('saved_at'):
+            return False
+        self._time_order = index.array('order')
+        self._sorted_times = index.array('time')
+        return True
+
+    def rows_in_time_window(self, time_lims):
+        """
+        :param time_lims: tuple (start, end) of times, both inclusive
+        :return: positions of cab_traces rows with time within time_lims,
+        in order of increasing time
+        """
+        if self._time_order is None:
+            self._build_time_index()
+        start = np.searchsorted(self._sorted_times, time_lims[0], side='left')
+        end = np.searchsorted(self._sorted_times, time_lims[1], side='right')
+        return self._time_order[start:end]
+
+    def columns_in_time_window(self, time_lims, columns):
+        """
+        :param time_lims: tuple (start, end) of times, both inclusive
+        :param columns: names of columns
+        :return: dict of column name to array of values of the rows with time
+        within time_lims, in order of increasing time
+        """
+        rows = self.rows_in_time_window(time_lims)
+        return {col: self.column(col)[rows] for col in columns}
+
+    def iter_columns(self, columns):
+        """
+        :param columns: names of columns
+        :return: iterator of dicts of column name to array of values of
+        consecutive rows in order of time, here a single one of all rows
+        """
+        yield self.columns_in_time_window((np.iinfo(np.int64).min, np.iinfo(np.int64).max), columns)
 
     def rows_within_time(self, time_lims):
         if time_lims is not None:
-            rel_rows = self.cab_traces['time'].between(time_lims[0], time_lims[1])
+            rel_rows = np.full(self.n_rows(), False)
+            rel_rows[self.rows_in_time_window(time_lims)] = True
         else:
-            rel_rows = np.full(len(self.cab_traces.index), True)
+            rel_rows = np.full(self.n_rows(), True)
         return rel_rows
 
-    def assign_road_segments(self, road_section, dist_thresh, angle_thresh, time_lims=None):
+    def assign_road_segments(self, road_section, dist_thresh, angle_thresh, time_lims=None,
+                             vectorized=True):
         """
         For each cab in self.cab_traces, data must previously be sorted by
         increasing time
@@ -106,20 +588,185 @@ class CabData(object):
         :param dist_thresh: threshold of distance to road segment, in meters
         :param angle_thresh: threshold of gps direction to road angle, in radians
         :param time_lims: tuple (start, end) between which to assign segments
+        :param vectorized: if False, use the row-by-row reference implementation
         :return:
         """
         rel_rows = self.rows_within_time(time_lims)
         cab_traces = self.cab_traces[rel_rows]
-        seg_assn = gps.assign_segments(cab_traces, road_section, dist_thresh, angle_thresh)
-        seg_assn = pd.DataFrame({'segment': seg_assn})
-        seg_assn.set_index(self.cab_traces.index[rel_rows], inplace=True)
-        self.cab_traces['segment'] = seg_assn
-        # self.cab_traces.groupby('cab_id').first()
-        pass
+        if vectorized:
+            seg_assn = gps.assign_segments(cab_traces, road_section, dist_thresh, angle_thresh)
+        else:
+            seg_assn = gps.assign_segments_rowwise(cab_traces, road_section, dist_thresh,
+                                                   angle_thresh)
+        segments = np.full(self.n_rows(), -1, dtype=compact_dtypes['segment'])
+        segments[rel_rows] = seg_assn.values
+        self.cab_traces['segment'] = segments
+        self.saved_at = None
+
+    def section_assignments(self):
+        """
+        :return: tuple (dict of arrays of section_assignment_cols of the
+        (row, section id, segment) pairs of assign_sections, in order of row
+        and section id, list of the name of each section id)
+        """
+        if self._section_assignments is None:
+            row_dtype = np.int32 if self.n_rows() <= np.iinfo(np.int32).max else np.int64
+            return ({'row': np.empty(0, dtype=row_dtype),
+                     'section': np.empty(0, dtype=section_dtype),
+                     'segment': np.empty(0, dtype=compact_dtypes['segment'])}, [])
+        return self._section_assignments, self._section_names
+
+    def save_section_assignments(self):
+        """
+        Save the section assignments next to the columnar save of cab_traces
+        they were made for
+        """
+        assignments, names = self.section_assignments()
+        colstore.save_frame(self.section_assignments_store,
+                            pd.DataFrame(assignments, columns=section_assignment_cols),
+                            meta={'traces_saved_at': self.saved_at, 'sections': names})
+
+    def _clear_section_assignments(self):
+        self._section_assignments = None
+        self._section_names = []
+
+    def _section_assignments_from_save(self):
+        self._clear_section_assignments()
+        if not colstore.store_exists(self.section_assignments_store):
+            return
+        store = colstore.ColumnStore(self.section_assignments_store)
+        if store.meta.get('traces_saved_at') != self.saved_at:
+            self.logger.warning("Section assignments of an older save of cab traces are ignored")
+            return
+        self._section_assignments = {col: store.array(col) for col in section_assignment_cols}
+        self._section_names = list(store.meta['sections'])
+
+    def assign_sections(self, section_set, dist_thresh, angle_thresh, time_lims=None):
+        """
+        Assign rows to the segments of the sections of section_set that are
+        not assigned yet, in a single pass over the rows with the combined
+        segment grid of those sections. Each row gets a (section id, segment)
+        pair per section it is assigned to, kept apart from the segment
+        column and from the pairs of other sections. Sections are identified
+        by name, so adding a section to the set only tests the rows against
+        the segments of the new section. If cab_traces is saved, the pairs
+        are saved next to it
+        :param section_set: road.SectionSet in the x, y frame of cab_traces
+        :param dist_thresh: threshold of distance to road segment, in meters
+        :param angle_thresh: threshold of gps direction to road angle, in radians
+        :param time_lims: tuple (start, end) between which to assign segments
+        :return: list of the section id of each section of section_set
+        """
+        if self._xy_center is None or not np.allclose(section_set.center, self._xy_center):
+            raise ValueError("Sections are not in the x, y frame of the cab traces")
+        assignments, names = self.section_assignments()
+        new_positions = [pos for pos, name in enumerate(section_set.names) if name not in names]
+        if new_positions:
+            start_time = time.time()
+            rel_rows = np.flatnonzero(self.rows_within_time(time_lims))
+            cab_traces = pd.DataFrame({col: self.column(col)[rel_rows] for col in ['x', 'y', 'dir']})
+            rows, positions, segments = gps.assign_section_segments(
+                cab_traces, section_set.subset(new_positions), dist_thresh, angle_thresh)
+            section_ids = len(names) + positions
+            new_assignments = {'row': np.concatenate((assignments['row'], rel_rows[rows])),
+                               'section': np.concatenate((assignments['section'], section_ids)),
+                               'segment': np.concatenate((assignments['segment'], segments))}
+            order = np.lexsort((new_assignments['section'], new_assignments['row']))
+            self._section_assignments = {
+                col: new_assignments[col][order].astype(assignments[col].dtype)
+                for col in section_assignment_cols}
+            self._section_names = names + [section_set.names[pos] for pos in new_positions]
+            names = self._section_names
+            self.logger.info("Assigned {} sections in {:.2f} s: {} pairs".format(
+                len(new_positions), time.time() - start_time, len(rows)))
+            if self.saved_at is not None:
+                self.save_section_assignments()
+        return [names.index(name) for name in section_set.names]
+
+    def section_segments(self, section_id):
+        """
+        :return: array of the segment of section_id each row is assigned to,
+        -1 where unassigned, like the segment column
+        """
+        assignments, names = self.section_assignments()
+        in_section = assignments['section'] == section_id
+        segments = np.full(self.n_rows(), -1, dtype=compact_dtypes['segment'])
+        segments[assignments['row'][in_section]] = assignments['segment'][in_section]
+        return segments
+
+    def segments_from_section(self, section_id):
+        """
+        Set the segment column to the segments of a section of assign_sections
+        """
+        self.cab_traces['segment'] = self.section_segments(section_id)
+        self.saved_at = None
 
     def calc_avg_segment_speeds(self, segments, time_lims):
-        rel_rows = self.rows_within_time(time_lims)
-        traces = self.cab_traces[rel_rows]
-        traces = traces[traces['segment'] >= 0]
-        traces_grouped = traces.groupby('segment')['speed']
-        return traces_grouped.mean()
+        """
+        :param segments: segments of the RoadSection that was assigned
+        :param time_lims: tuple (start, end) of times, both inclusive, or None
+        for all times
+        :return: Series of mean speed of each segment with assigned rows,
+        indexed by segment
+        """
+        if time_lims is not None:
+            rel_rows = self.rows_in_time_window(time_lims)
+        else:
+            rel_rows = slice(None)
+        return avg_segment_speeds(self.column('segment')[rel_rows], self.column('speed')[rel_rows])
+
+
+class SectionCabData(object):
+    """
+    Cab traces of a CabData as seen by one section of its assign_sections,
+    whose segment column is that of the section. Provides
+    calc_avg_segment_speeds and iter_columns like CabData, so estimators and
+    speed cubes of each section share the traces
+    """
+    def __init__(self, cab_data, section_id):
+        self.cab_data = cab_data
+        self.section_id = section_id
+        self.segments = cab_data.section_segments(section_id)
+        self.save_dir = os.path.join(cab_data.save_dir, "section_{}".format(section_id))
+        self.saved_at = cab_data.saved_at
+
+    def n_rows(self):
+        return self.cab_data.n_rows()
+
+    def delta_data_exists(self):
+        return self.cab_data.delta_data_exists()
+
+    def column(self, col):
+        return self.segments if col == 'segment' else self.cab_data.column(col)
+
+    def columns_in_time_window(self, time_lims, columns):
+        """
+        :param time_lims: tuple (start, end) of times, both inclusive
+        :param columns: names of columns
+        :return: dict of column name to array of values of the rows with time
+        within time_lims, in order of increasing time
+        """
+        rows = self.cab_data.rows_in_time_window(time_lims)
+        return {col: self.column(col)[rows] for col in columns}
+
+    def iter_columns(self, columns):
+        """
+        :param columns: names of columns
+        :return: iterator of dicts of column name to array of values of
+        consecutive rows in order of time, here a single one of all rows
+        """
+        yield self.columns_in_time_window((np.iinfo(np.int64).min, np.iinfo(np.int64).max), columns)
+
+    def calc_avg_segment_speeds(self, segments, time_lims):
+        """
+        :param segments: segments of the section
+        :param time_lims: tuple (start, end) of times, both inclusive, or None
+        for all times
+        :return: Series of mean speed of each segment with assigned rows,
+        indexed by segment
+        """
+        if time_lims is not None:
+            rel_rows = self.cab_data.rows_in_time_window(time_lims)
+        else:
+            rel_rows = slice(None)
+        return avg_segment_speeds(self.segments[rel_rows], self.cab_data.column('speed')[rel_rows])
@@ -0,0 +1,114 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+manifest_fname = "manifest.json"
+store_version = 1
+
+
+def _column_fname(col):
+    return "{}.npy".format(col)
+
+
+def _save_array(dirname, fname, values):
+    # write next to the target and rename, so memory maps of a previous
+    # version of the file stay valid
+    tmp_path = os.path.join(dirname, fname + ".tmp")
+    with open(tmp_path, 'wb') as fout:
+        np.save(fout, values)
+    os.replace(tmp_path, os.path.join(dirname, fname))
+
+
+def save_frame(dirname, frame, meta=None):
+    """
+    Save each column of frame to its own typed binary file in dirname,
+    described by a JSON manifest
+    :param dirname: directory of the store, created if needed
+    :param frame: DataFrame to save
+    :param meta: optional dict of JSON-serializable info saved in the manifest
+    """
+    os.makedirs(dirname, exist_ok=True)
+    columns = []
+    for col in frame.columns:
+        values = frame[col]
+        entry = {'name': col, 'file': _column_fname(col)}
+        is_categorical = isinstance(values.dtype, pd.api.types.CategoricalDtype)
+        if is_categorical or values.dtype == object:
+            # store strings and categoricals as integer codes into a list of categories
+            entry['kind'] = 'category' if is_categorical else 'object'
+            categorical = pd.Categorical(values)
+            entry['categories'] = [str(cat) for cat in categorical.categories]
+            values = np.asarray(categorical.codes)
+        else:
+            entry['kind'] = 'array'
+            values = values.values
+        entry['dtype'] = values.dtype.str
+        _save_array(dirname, entry['file'], values)
+        columns.append(entry)
+    manifest = {'version': store_version, 'n_rows': len(frame.index),
+                'columns': columns, 'meta': meta if meta is not None else {}}
+    tmp_path = os.path.join(dirname, manifest_fname + ".tmp")
+    with open(tmp_path, 'w') as fout:
+        json.dump(manifest, fout, indent=1)
+    os.replace(tmp_path, os.path.join(dirname, manifest_fname))
+
+
+def store_exists(dirname):
+    return os.path.isfile(os.path.join(dirname, manifest_fname))
+
+
+class ColumnStore(object):
+    """
+    Read side of a store written by save_frame. Columns are only read when
+    first accessed, and are memory-mapped read-only so that processes
+    reading the same store share the OS page cache
+    """
+    def __init__(self, dirname, mmap=True):
+        self.dirname = dirname
+        self._mmap_mode = 'r' if mmap else None
+        with open(os.path.join(dirname, manifest_fname), 'r') as fin:
+            manifest = json.load(fin)
+        if manifest['version'] != store_version:
+            raise ValueError("{}: unsupported store version {}".format(dirname, manifest['version']))
+        self.n_rows = manifest['n_rows']
+        self.meta = manifest['meta']
+        self._entries = {entry['name']: entry for entry in manifest['columns']}
+        self.columns = [entry['name'] for entry in manifest['columns']]
+        self._arrays = {}
+
+    def __contains__(self, col):
+        return col in self._entries
+
+    def array(self, col):
+        """
+        :return: the raw stored array of col (integer codes for string and
+        categorical columns), memory-mapped if the store was opened with mmap
+        """
+        if col not in self._arrays:
+            entry = self._entries[col]
+            self._arrays[col] = np.load(os.path.join(self.dirname, entry['file']),
+                                        mmap_mode=self._mmap_mode)
+        return self._arrays[col]
+
+    def column(self, col):
+        """
+        :return: values of col with their original type: an array, an object
+        array of strings, or a Categorical
+        """
+        entry = self._entries[col]
+        values = self.array(col)
+        if entry['kind'] == 'category':
+            return pd.Categorical.from_codes(values, entry['categories'])
+        elif entry['kind'] == 'object':
+            return np.asarray(entry['categories'], dtype=object)[values]
+        return values
+
+    def to_frame(self, columns=None):
+        """
+        :param columns: list of columns to load, or None for all
+        :return: DataFrame of the columns
+        """
+        if columns is None:
+            columns = self.columns
+        return pd.DataFrame({col: self.column(col) for col in columns}, columns=columns)
@@ -1,12 +1,16 @@
 import os
+import logging
 import numpy as np
 import pandas as pd
 import pytz
 import datetime
 import warnings
 
+from proc import colstore
+
 pems_time_format = "%m/%d/%Y %H:%M"
 mph_to_mps = 0.44704
+pems_cols = ["5 Minutes", "Flow (Veh/5 Minutes)", "Speed (mph)"]
 
 
 def time_pems_to_unix(time_str, timezone):
@@ -17,6 +21,77 @@ def time_pems_to_unix(time_str, timezone):
     return utc_time.timestamp()
 
 
+def times_pems_to_unix(time_strs, timezone):
+    """
+    Vectorized equivalent of time_pems_to_unix for a whole column
+    :param time_strs: Series of local times in pems_time_format
+    :param timezone: pytz timezone of the times
+    :return: array of unix times, in seconds
+    """
+    naive = pd.to_datetime(time_strs, format=pems_time_format)
+    naive_secs = (naive.values.astype('datetime64[s]').astype(np.int64))
+    # UTC offsets only change on the hour, so localize each distinct hour
+    # like time_pems_to_unix does (ambiguous and nonexistent local times are
+    # taken as standard time) and apply its offset to all times in it
+    hours, hour_idxs = np.unique(naive_secs // 3600, return_inverse=True)
+    epoch = datetime.datetime(1970, 1, 1)
+    offsets = np.empty(len(hours))
+    for i, hour in enumerate(hours):
+        localized = timezone.localize(epoch + datetime.timedelta(hours=int(hour)))
+        offsets[i] = localized.utcoffset().total_seconds()
+    return naive_secs - offsets[hour_idxs]
+
+
+def read_pems_csv(fname, timezone):
+    """
+    :return: DataFrame of columns time (unix time), flow and speed of a PeMS
+    5-minute CSV, with flow and speed in the file's units
+    """
+    data = pd.read_csv(fname, usecols=pems_cols)
+    data = data[pems_cols]
+    data["5 Minutes"] = times_pems_to_unix(data["5 Minutes"], timezone)
+    data.columns = ['time', 'flow', 'speed']
+    return data
+
+
+def pems_to_si(flows, speeds):
+    """
+    :param flows: flows in vehicles per 5 minutes
+    :param speeds: speeds in mph
+    :return: tuple (flows in vehicles/s, speeds in m/s)
+    """
+    return flows / 300.0, speeds * mph_to_mps
+
+
+def interp_at_times(data_times, vals, times):
+    """
+    Linearly interpolate vals between the data times surrounding each query
+    time. Of duplicate data times, the first row is used. Query times
+    outside the data take the value at the nearest end of the data
+    :param data_times: sorted array of times of vals
+    :param vals: array of values
+    :param times: array of query times
+    :return: tuple (array of values, mask of times before the data, mask of
+    times after the data)
+    """
+    n_data = len(data_times)
+    times = np.asarray(times, dtype=np.float64)
+    # idx2: first row after time; idx1: first row at the last data time <= time
+    idx2 = np.searchsorted(data_times, times, side='right')
+    before_data = idx2 == 0
+    after_data = idx2 == n_data
+    idx1 = np.searchsorted(data_times, data_times[np.maximum(idx2 - 1, 0)], side='left')
+    idx2 = np.minimum(idx2, n_data - 1)
+    inputs = (data_times[idx1], data_times[idx2])
+    outputs = (vals[idx1], vals[idx2])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slopes = (outputs[1] - outputs[0]) / (inputs[1] - inputs[0])
+        result = outputs[0] + slopes * (times - inputs[0])
+    result[before_data] = vals[0]
+    result[after_data] = outputs[0][after_data]
+    return result, before_data, after_data
+
+
 def lin_interp(val, inputs, outputs):
     denom = inputs[1] - inputs[0]
     assert(denom > 0.0)
@@ -25,46 +100,94 @@ def lin_interp(val, inputs, outputs):
 
 
 class StatDetector(object):
-    def __init__(self, dirname, vds_id):
+    def __init__(self, dirname, vds_id, use_cache=True, cache_dir=None):
+        """
+        :param dirname: directory containing pems_vds_<vds_id>.csv
+        :param vds_id: id of the detector station
+        :param use_cache: load the parsed table from a binary cache if it is
+        up to date, and write the cache otherwise
+        :param cache_dir: directory of the cache, default is dirname, next to
+        the CSV
+        """
+        self.logger = logging.getLogger("StatDetector")
         self._timezone = pytz.timezone('US/Pacific')
         self._csv_path = os.path.join(dirname, "pems_vds_{}.csv".format(vds_id))
+        self._cache_path = os.path.join(dirname if cache_dir is None else cache_dir,
+                                        "pems_vds_{}.cols".format(vds_id))
         self.vds_id = vds_id
-        self.data = self.data_from_csv()
+        if use_cache:
+            self.data = self.data_from_cache()
+            if self.data is None:
+                self.data = self.data_from_csv()
+                self.save_cache()
+        else:
+            self.data = self.data_from_csv()
+        self._sort_by_time()
 
     def time_to_unix(self, time_str):
         return time_pems_to_unix(time_str, self._timezone)
 
     def data_from_csv(self):
-        data = pd.read_csv(self._csv_path,
-                           usecols=["5 Minutes", "Flow (Veh/5 Minutes)", "Speed (mph)"],
-                           converters={"5 Minutes": self.time_to_unix})
-        data["Flow (Veh/5 Minutes)"] /= 300.0
-        data["Speed (mph)"] *= mph_to_mps
-        data.columns = ['time', 'flow', 'speed']
+        data = read_pems_csv(self._csv_path, self._timezone)
+        data['flow'], data['speed'] = pems_to_si(data['flow'], data['speed'])
         return data
 
-    def calc_val_at_time(self, col, time):
-        delta_times = time - self.data['time']
-        filt = delta_times >= 0
-        before, after = (delta_times[filt], delta_times[np.invert(filt)])
-        idx1 = before.idxmin() if not before.empty else None
-        idx2 = after.idxmax() if not after.empty else None
-        if idx1 is None and idx2 is None:
+    def _csv_mtime(self):
+        return os.path.getmtime(self._csv_path)
+
+    def data_from_cache(self):
+        """
+        :return: parsed table from the binary cache, or None if there is no
+        cache or it is older than the CSV
+        """
+        if not colstore.store_exists(self._cache_path):
+            return None
+        store = colstore.ColumnStore(self._cache_path, mmap=False)
+        if store.meta.get('csv_mtime') != self._csv_mtime():
+            return None
+        return store.to_frame(['time', 'flow', 'speed'])
+
+    def save_cache(self):
+        """
+        Save the parsed table to the binary cache. If it cannot be written,
+        e.g. in a read-only data set, the table is only kept in memory
+        """
+        try:
+            colstore.save_frame(self._cache_path, self.data, meta={'csv_mtime': self._csv_mtime()})
+        except OSError as err:
+            self.logger.warning("VDS {}: cache not saved: {}".format(self.vds_id, err))
+
+    def _sort_by_time(self):
+        times = self.data['time'].values
+        if np.any(times[1:] < times[:-1]):
+            self.data = self.data.iloc[np.argsort(times, kind='mergesort')].reset_index(drop=True)
+        self._times = self.data['time'].values
+
+    def calc_vals_at_times(self, col, times):
+        """
+        Linearly interpolate a column of data between the data times
+        surrounding each query time. Query times outside the data take the
+        value at the nearest end of the data, with a warning
+        :param col: name of column of data, e.g. 'flow' or 'speed'
+        :param times: array of unix times
+        :return: array of interpolated values, one per time
+        """
+        data_times = self._times
+        if len(data_times) == 0:
             raise RuntimeError("VDS {}: times are empty!".format(self.vds_id))
-        elif idx1 is None and idx2 is not None:
+        result, before_data, after_data = interp_at_times(data_times, self.data[col].values, times)
+        if np.any(before_data):
             warnings.warn("VDS {}: time outside data. Last time's {} taken".format(self.vds_id, col))
-            return self.data[col][idx2]
-        elif idx2 is None and idx1 is not None:
+        if np.any(after_data):
             warnings.warn(
                 "VDS {}: time outside data. First time's {} taken".format(self.vds_id, col))
-            return self.data[col][idx1]
-        else:
-            return lin_interp(time,
-                              self.data['time'].values[[idx1, idx2]],
-                              self.data[col].values[[idx1, idx2]])
+        return result
+
+    def calc_val_at_time(self, col, time):
+        return self.calc_vals_at_times(col, [time])[0]
 
 
-def read_detector_if_exists(vds_id, dirname):
+def read_detector_if_exists(vds_id, dirname, cache_dir=None):
     if vds_id is not None and not np.isnan(vds_id):
-        return StatDetector(dirname, int(vds_id))
+        return StatDetector(dirname, int(vds_id), cache_dir=cache_dir)
     return None
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class IterationTrace(object):
+    """
+    Fixed-size ring buffer of per-iteration estimator values. Recording
+    copies into preallocated arrays; values are only formatted on request
+    """
+    fields = ('times', 'speeds', 'predicted', 'updated', 'innovations')
+
+    def __init__(self, capacity, n_segments, n_states, n_meas):
+        """
+        :param capacity: number of most recent iterations kept
+        """
+        self.capacity = capacity
+        self.times = np.empty(capacity)
+        self.speeds = np.empty((capacity, n_segments))
+        self.predicted = np.empty((capacity, n_states))
+        self.updated = np.empty((capacity, n_states))
+        self.innovations = np.empty((capacity, n_meas))
+        self.n_recorded = 0
+
+    def __len__(self):
+        return min(self.n_recorded, self.capacity)
+
+    def record(self, time, speeds, predicted, updated, innovations):
+        """
+        :param time: time of the iteration
+        :param speeds: segment speeds used in prediction, NaN where default
+        :param predicted: state after prediction
+        :param updated: state after measurement update
+        :param innovations: measurement innovation vector
+        """
+        idx = self.n_recorded % self.capacity
+        self.times[idx] = time
+        self.speeds[idx] = speeds
+        self.predicted[idx] = predicted
+        self.updated[idx] = updated
+        self.innovations[idx] = innovations
+        self.n_recorded += 1
+
+    def _ordered_idxs(self, n_last=None):
+        n = len(self)
+        if n_last is not None:
+            n = min(n, n_last)
+        return np.arange(self.n_recorded - n, self.n_recorded) % self.capacity
+
+    def last(self, n_last=None):
+        """
+        :param n_last: number of most recent iterations, or None for all kept
+        :return: dict of field name to array of values, oldest first
+        """
+        idxs = self._ordered_idxs(n_last)
+        return {field: getattr(self, field)[idxs] for field in self.fields}
+
+    def format(self, n_last=10):
+        """
+        :return: human-readable text of the n_last most recent iterations
+        """
+        lines = []
+        for idx in self._ordered_idxs(n_last):
+            lines.append("========= ITERATION @ {} ==========".format(self.times[idx]))
+            lines.append("Non-default speeds used in meas: {}".format(self.speeds[idx]))
+            lines.append("Predicted state: {}".format(self.predicted[idx]))
+            lines.append("Innovations: {}".format(self.innovations[idx]))
+            lines.append("Updated state: {}".format(self.updated[idx]))
+        return "\n".join(lines)
+
+    def save(self, fname):
+        """
+        Save the kept iterations, oldest first, as a binary .npz file
+        """
+        np.savez(fname, **self.last())
@@ -1,11 +1,13 @@
 import numpy as np
-import pandas as pd
 import logging
 
+from proc.kalman import RoadKalmanEngine, BatchedRoadKalmanEngine
+from proc.diagnostics import IterationTrace
+
 max_age_use_prev_speed = 120
 max_speed_plausible = 42.5
-velocity_default = pd.Series([31.3, 29.2, 30.1, 30.1, 29.5, 27.4])
-vel_var_default = pd.Series([2.18, 0.83, 1.63, 1.63, 2.84, 2.84])
+velocity_default = np.array([31.3, 29.2, 30.1, 30.1, 29.5, 27.4])
+vel_var_default = np.array([2.18, 0.83, 1.63, 1.63, 2.84, 2.84])
 measured_flow_idxs = [1, 2]
 gps_pos_var = 3.0**2
 gps_interval = 60  # time between measurements, in seconds
@@ -15,50 +17,109 @@ ramp_density_init_val = 0.005
 ramp_density_process_noise = 1e-5
 
 
+def segment_defaults(values, n_segments):
+    """
+    :return: array of values for n_segments segments, the last value
+    repeated for segments beyond the given values
+    """
+    return np.concatenate((values[:n_segments],
+                           np.full(max(n_segments - len(values), 0), values[-1])))
+
+
+class StepTerms(object):
+    """
+    Terms of one estimator iteration that the Kalman predict takes: the
+    diagonal and subdiagonal of the segment block of the transition matrix,
+    the input added to the state and the diagonal of the process noise
+    covariance
+    """
+    def __init__(self, outlet_terms, inlet_terms, inputs, process_vars):
+        self.outlet_terms = outlet_terms
+        self.inlet_terms = inlet_terms
+        self.inputs = inputs
+        self.process_vars = process_vars
+
+
 class RoadSpeedBuffer(object):
+    """
+    Last measured speed of each segment, and the number of updates since
+    """
     def __init__(self, n_segments):
-        self.data = pd.DataFrame({'speed': np.full(n_segments, np.nan),
-                                  'age': [0] * n_segments})
+        self.speeds = np.full(n_segments, np.nan)
+        self.ages = np.zeros(n_segments, dtype=np.int64)
 
     def get_valid_speeds_filt(self, max_age):
-        valid_prev_speeds = np.invert(np.isnan(self.data['speed']))
-        return np.logical_and(valid_prev_speeds, self.data['age'] <= max_age)
+        return np.logical_and(np.invert(np.isnan(self.speeds)), self.ages <= max_age)
 
     def valid_speeds(self, max_age):
-        tmp = self.data['speed'].copy()
-        tmp[np.invert(self.get_valid_speeds_filt(max_age))]['speed'] = np.nan
-        return tmp
+        # speeds older than max_age have never been masked here: the former
+        # DataFrame version assigned NaN to a copy. Kept so output is unchanged
+        return self.speeds.copy()
 
-    def update(self, cur_speeds):
-        avail_idxs = list(cur_speeds.index)
-        self.data['age'] += 1
-        self.data.loc[avail_idxs, 'speed'] = cur_speeds
-        self.data.loc[avail_idxs, 'age'] = 0
+    def update(self, segment_idxs, speeds):
+        """
+        :param segment_idxs: array of segments with new measurements
+        :param speeds: array of their speeds, NaN if unknown
+        """
+        self.ages += 1
+        self.speeds[segment_idxs] = speeds
+        self.ages[segment_idxs] = 0
 
 
 class RoadStateEstimator(object):
-    def __init__(self, road_section, timestep, start_time):
+    def __init__(self, road_section, timestep, start_time, end_time=None, detector_meas=None):
+        """
+        :param road_section: RoadSection instance
+        :param timestep: time between iterations, in seconds
+        :param start_time: unix time of the initial state
+        :param end_time: if given, detector measurements are precomputed for
+        all iterations up to end_time instead of being calculated every
+        iteration
+        :param detector_meas: source of detector measurements with the
+        interface of road.DetectorMeas, e.g. one fed online. Used instead of
+        precomputing measurements or calculating them from road_section
+        """
         self.logger = logging.getLogger("RoadStateEstimator")
         self.time = start_time
         self.timestep = timestep
         self.road_section = road_section
+        self.detector_meas = detector_meas
+        if detector_meas is None and end_time is not None:
+            # last iteration starts before end_time and measures one step later
+            self.detector_meas = road_section.calc_detector_meas(start_time, end_time + timestep,
+                                                                 timestep)
         self.n_segments = len(self.road_section.segments.index)
         self.n_states = self.n_segments + self.road_section.n_ramps
+        self._timestep_per_length = self.timestep / self.road_section.segments['length'].values
+        self._velocity_default = segment_defaults(velocity_default, self.n_segments)
+        self._vel_var_default = segment_defaults(vel_var_default, self.n_segments)
         self.state = self._init_state()
         self.error_covar = self._init_error_covar()
         self.speed_buffer = RoadSpeedBuffer(self.n_segments)
         self._cur_speeds = None
+        self._step_speeds = None  # segment speeds of the step being run
         self._transition_mat_template = self._calc_transition_mat_template()
         self._input_transition_mat = self._calc_input_transition_mat()
         self._state_to_meas_mat = self._calc_state_to_meas_mat(measured_flow_idxs)
-        self._default_process_covar = self._init_def_process_covar()
+        self._default_process_vars = self._init_def_process_vars()
         self._measurement_covar = self._calc_measurement_covar()
+        self.n_meas = len(self._state_to_meas_mat)
+        self.engine = RoadKalmanEngine(self._transition_mat_template, self._state_to_meas_mat,
+                                       self._measurement_covar, self.n_segments)
+        self.trace = None
+
+    def enable_trace(self, capacity):
+        """
+        Record speeds, states and innovations of the last capacity iterations
+        in self.trace, an IterationTrace
+        """
+        self.trace = IterationTrace(capacity, self.n_segments, self.n_states, self.n_meas)
 
     def _init_state(self):
         # for first density we can use flow coming into section
         # for subsequent densities use previous density, or flow if part of measurement
         state = np.full(self.n_states, np.nan)
-        densities = self.road_section.calc_density_meas_at_time(self.time)
+        densities = self._calc_density_meas()
         if len(densities) > 0:
             idx1 = np.array(densities.index)
             idx1[1:] -= 1
@@ -89,26 +150,48 @@ class RoadStateEstimator(object):
                          [mat_ll, mat_lr]])
 
     def _calc_cur_speeds(self, segment_speeds):
-        speeds = segment_speeds.reindex(pd.Index(range(self.n_segments)))
+        """
+        :param segment_speeds: tuple of arrays (segments, speeds) of segments
+        with measured speeds
+        """
+        speeds = np.full(self.n_segments, np.nan)
+        speeds[segment_speeds[0]] = segment_speeds[1]
         fill_with_prev = np.logical_and(self.speed_buffer.get_valid_speeds_filt(max_age_use_prev_speed),
                                         np.isnan(speeds))
-        speeds[fill_with_prev] = self.speed_buffer.data['speed'][fill_with_prev]
+        speeds[fill_with_prev] = self.speed_buffer.speeds[fill_with_prev]
         self._cur_speeds = speeds
 
-    def _calc_transition_mat(self):
+    def _calc_transition_terms(self):
+        """
+        :return: tuple of arrays (diagonal, subdiagonal) of the segment block
+        of the transition matrix
+        """
         speeds = self._cur_speeds.copy()
-        speeds[np.isnan(speeds)] = velocity_default
-        outlet_terms = 1.0 - (self.timestep / self.road_section.segments['length']) * speeds
-        inlet_terms = self.timestep / self.road_section.segments.loc[1:, 'length']
-        inlet_terms = inlet_terms.reset_index(drop=True) * speeds[:-1]
-        mat_ul = np.diag(outlet_terms) + np.diag(inlet_terms, k=-1)
-        mat_full = self._transition_mat_template.copy()
-        mat_full[:self.n_segments, :self.n_segments] = mat_ul
-        return mat_full
+        unknown = np.isnan(speeds)
+        speeds[unknown] = self._velocity_default[unknown]
+        outlet_terms = 1.0 - self._timestep_per_length * speeds
+        inlet_terms = self._timestep_per_length[1:] * speeds[:-1]
+        return outlet_terms, inlet_terms
+
+    def _meas_time_idx(self):
+        if self.detector_meas is None:
+            return None
+        return self.detector_meas.time_idx(self.time)
+
+    def _calc_density_meas(self):
+        time_idx = self._meas_time_idx()
+        if time_idx is not None:
+            return self.detector_meas.densities_at(time_idx)
+        return self.road_section.calc_density_meas_at_time(self.time)
 
     def _calc_input_mat(self):
-        detector_first = self.road_section.section['vds_data'][0]
-        flow_in = detector_first.calc_val_at_time('flow', self.time)
+        time_idx = self._meas_time_idx()
+        if time_idx is not None:
+            # first detector is at the start of the section
+            flow_in = self.detector_meas.flows[time_idx, 0]
+        else:
+            detector_first = self.road_section.section['vds_data'][0]
+            flow_in = detector_first.calc_val_at_time('flow', self.time)
         u = np.zeros(self.n_segments - self.road_section.n_ramps + 1)
         u[0] = flow_in
         return u
@@ -124,7 +207,7 @@ class RoadStateEstimator(object):
         mat[-1, self.n_segments - 1] = 1  # flow out of last segment
         return mat
 
-    def _init_def_process_covar(self):
+    def _init_def_process_vars(self):
         gps_vel_var = (2.0 / gps_interval**2) * gps_pos_var
         flow_terms = self.timestep / self.road_section.segments['length'] * typ_segment_density
         flow_terms = np.square(flow_terms) * gps_vel_var
@@ -135,67 +218,189 @@ class RoadStateEstimator(object):
         ramp_terms = np.zeros(self.n_segments)
         ramp_terms[self.road_section.segments['ramp'] != 'none'] = ramp_noise_var
         vars_total = flow_terms + density_terms + ramp_terms
-        vars_total = np.append(vars_total, [ramp_noise_var] * self.road_section.n_ramps)
-        return np.diag(vars_total)
+        return np.append(vars_total, [ramp_noise_var] * self.road_section.n_ramps)
 
-    def _calc_process_covar(self):
-        covar = self._default_process_covar
-        flow_add = np.zeros(self.n_segments)
+    def _calc_process_vars(self):
+        """
+        :return: diagonal of the process noise covariance of this step
+        """
+        flow_add = np.zeros(self.n_states)
         filt = np.isnan(self._cur_speeds)
-        flow_add[filt] = self.timestep / self.road_section.segments['length'][filt] * typ_segment_density
-        flow_add[filt] = np.square(flow_add[filt]) * vel_var_default[filt]
-        flow_add = np.append(flow_add, np.zeros(self.road_section.n_ramps))
-        covar += np.diag(flow_add)
-        return covar
-
+        flow_terms = self._timestep_per_length[filt] * typ_segment_density
+        flow_add[:self.n_segments][filt] = np.square(flow_terms) * self._vel_var_default[filt]
+        return self._default_process_vars + flow_add
 
     def _calc_measurement_covar(self):
         return np.diag([3.12e-4, 6.82e-4, 2.70e-4])
 
-    def _calc_kalman_gain(self):
-        H = self._state_to_meas_mat
-        Ht = H.transpose()
-        P = self.error_covar
-        R = self._measurement_covar
-        numerator = np.matmul(P, Ht)
-        denominator = np.matmul(np.matmul(H, P), Ht) + R
-        return np.matmul(numerator, np.linalg.inv(denominator))
-
     def _increment_time(self):
         self.time += self.timestep
 
     def _limit_state_to_positive(self):
         self.state = np.clip(self.state, 0.0, None)
 
-    def predict(self, segment_speeds):
-        self._calc_cur_speeds(segment_speeds)
-        A = self._calc_transition_mat()
-        B = self._input_transition_mat
-        u = self._calc_input_mat()
-        self.state = np.matmul(A, self.state) + np.matmul(B, u)
+    def predict(self, step_terms):
+        """
+        :param step_terms: StepTerms of this step, from prepare_step
+        """
+        self.state = self.engine.predict_state(self.state, step_terms.outlet_terms,
+                                               step_terms.inlet_terms)
+        self.state += step_terms.inputs
         self._limit_state_to_positive()
-        self.error_covar = np.matmul(np.matmul(A, self.error_covar), A.transpose())
-        self.error_covar += self._calc_process_covar()
+        self.engine.predict_covar(self.error_covar, step_terms.outlet_terms,
+                                  step_terms.inlet_terms, step_terms.process_vars)
 
     def update(self, meas):
-        K = self._calc_kalman_gain()
-        innov = meas - np.matmul(self._state_to_meas_mat, self.state)
-        self.state += np.matmul(K, innov)
+        innov = self.engine.update(self.state, self.error_covar, meas)
         self._limit_state_to_positive()
-        I = np.identity(self.n_states)
-        error_covar_factor = I - np.matmul(K, self._state_to_meas_mat)
-        self.error_covar = np.matmul(error_covar_factor, self.error_covar)
+        return innov
 
-    def run_iteration(self, cab_data):
-        self.logger.info("========= ITERATION @ {} ==========".format(self.time + self.timestep))
+    def _calc_segment_speeds(self, cab_data):
+        """
+        :return: tuple of arrays (segments, speeds) of segments with cab
+        data in the last timestep, with NaN for unknown or implausible speeds
+        """
         times = [self.time - self.timestep + 1, self.time]
         segment_speeds = cab_data.calc_avg_segment_speeds(self.road_section.segments, times)
-        segment_speeds[segment_speeds > max_speed_plausible] = np.nan
-        self.predict(segment_speeds)
-        self.logger.info("Non-default speeds used in meas: {}".format(self._cur_speeds))
-        self.logger.info("Predicted state: {}".format(self.state))
+        speeds = segment_speeds.values.copy()
+        with np.errstate(invalid='ignore'):
+            speeds[speeds > max_speed_plausible] = np.nan
+        return segment_speeds.index.values, speeds
+
+    def _calc_meas(self):
+        time_idx = self._meas_time_idx()
+        if time_idx is not None:
+            return self.detector_meas.densities[time_idx, 1:]
+        return np.array(self.road_section.calc_density_meas_at_time(self.time))[1:]
+
+    def prepare_step(self, cab_data):
+        """
+        First part of an iteration, before the Kalman predict: average the
+        segment speeds of the last timestep and calculate the terms of the
+        step from them
+        :return: StepTerms of the step
+        """
+        self.logger.debug("========= ITERATION @ %s ==========", self.time + self.timestep)
+        self._step_speeds = self._calc_segment_speeds(cab_data)
+        self._calc_cur_speeds(self._step_speeds)
+        self.logger.debug("Non-default speeds used in meas: %s", self._cur_speeds)
+        outlet_terms, inlet_terms = self._calc_transition_terms()
+        return StepTerms(outlet_terms, inlet_terms,
+                         np.matmul(self._input_transition_mat, self._calc_input_mat()),
+                         self._calc_process_vars())
+
+    def finish_step(self):
+        """
+        Part of an iteration between the Kalman predict and update: advance
+        the time and buffer the segment speeds of the step
+        :return: detector measurements at the new time
+        """
         self._increment_time()
-        self.speed_buffer.update(segment_speeds)
-        meas = self.road_section.calc_density_meas_at_time(self.time)
-        self.update(np.array(meas)[1:])
-        self.logger.info("Updated state: {}".format(self.state))
\ No newline at end of file
+        self.speed_buffer.update(*self._step_speeds)
+        self._step_speeds = None
+        return self._calc_meas()
+
+    def record_step(self, predicted, innov):
+        """
+        Record the step in the trace, if enabled
+        :param predicted: state after the predict
+        :param innov: innovation of the update
+        """
+        if self.trace is not None:
+            self.trace.record(self.time, self._cur_speeds, predicted, self.state, innov)
+
+    def run_iteration(self, cab_data):
+        self.predict(self.prepare_step(cab_data))
+        self.logger.debug("Predicted state: %s", self.state)
+        predicted = self.state.copy() if self.trace is not None else None
+        innov = self.update(self.finish_step())
+        self.logger.debug("Updated state: %s", self.state)
+        self.record_step(predicted, innov)
+
+
+class _EstimatorGroup(object):
+    """
+    Estimators of sections with the same numbers of segments and ramps,
+    whose states and error covariances are stacked along a batch axis
+    """
+    def __init__(self, estimators, cab_data_idxs):
+        self.estimators = estimators
+        self.cab_data_idxs = cab_data_idxs
+        n_batch = len(estimators)
+        n_segments = estimators[0].n_segments
+        self.engine = BatchedRoadKalmanEngine([estimator.engine for estimator in estimators])
+        self.state = np.array([estimator.state for estimator in estimators])
+        self.error_covar = np.array([estimator.error_covar for estimator in estimators])
+        self.outlet_terms = np.empty((n_batch, n_segments))
+        self.inlet_terms = np.empty((n_batch, n_segments - 1))
+        self.inputs = np.empty((n_batch, estimators[0].n_states))
+        self.process_vars = np.empty((n_batch, estimators[0].n_states))
+        self.meas = np.empty((n_batch, estimators[0].n_meas))
+        # estimators see their slices of the stacked arrays, which are only updated in place
+        for i, estimator in enumerate(estimators):
+            estimator.state = self.state[i]
+            estimator.error_covar = self.error_covar[i]
+
+    def _limit_state_to_positive(self):
+        np.clip(self.state, 0.0, None, out=self.state)
+
+    def run_iteration(self, cab_datas):
+        estimators = self.estimators
+        for i, estimator in enumerate(estimators):
+            step_terms = estimator.prepare_step(cab_datas[self.cab_data_idxs[i]])
+            self.outlet_terms[i] = step_terms.outlet_terms
+            self.inlet_terms[i] = step_terms.inlet_terms
+            self.inputs[i] = step_terms.inputs
+            self.process_vars[i] = step_terms.process_vars
+        self.state[:] = self.engine.predict_state(self.state, self.outlet_terms, self.inlet_terms)
+        self.state += self.inputs
+        self._limit_state_to_positive()
+        self.engine.predict_covar(self.error_covar, self.outlet_terms, self.inlet_terms,
+                                  self.process_vars)
+        tracing = any(estimator.trace is not None for estimator in estimators)
+        predicted = self.state.copy() if tracing else None
+        for i, estimator in enumerate(estimators):
+            self.meas[i] = estimator.finish_step()
+        innovs = self.engine.update(self.state, self.error_covar, self.meas)
+        self._limit_state_to_positive()
+        for i, estimator in enumerate(estimators):
+            estimator.record_step(predicted[i] if tracing else None, innovs[i])
+
+
+class BatchedRoadStateEstimator(object):
+    """
+    Runs the RoadStateEstimators of many road sections together. Estimators
+    of sections with the same numbers of segments and ramps are grouped, and
+    the Kalman steps of a group are batched array operations instead of one
+    set of small matrix operations per section. Each estimator's output is
+    the same as running it on its own.
+    """
+    def __init__(self, estimators):
+        """
+        :param estimators: list of RoadStateEstimator, which must not have run
+        any iterations yet
+        """
+        self.logger = logging.getLogger("BatchedRoadStateEstimator")
+        self.estimators = list(estimators)
+        group_idxs = {}
+        for idx, estimator in enumerate(self.estimators):
+            key = (estimator.n_segments, estimator.road_section.n_ramps)
+            group_idxs.setdefault(key, []).append(idx)
+        self._groups = [_EstimatorGroup([self.estimators[idx] for idx in idxs], idxs)
+                        for idxs in group_idxs.values()]
+        self.logger.info("Batching {} estimators in {} groups".format(len(self.estimators),
+                                                                     len(self._groups)))
+
+    def run_iteration(self, cab_data):
+        """
+        Run one iteration of every estimator
+        :param cab_data: CabData of segment speeds for all sections, or a list
+        of one CabData per estimator
+        """
+        if isinstance(cab_data, (list, tuple)):
+            assert(len(cab_data) == len(self.estimators))
+            cab_datas = cab_data
+        else:
+            cab_datas = [cab_data] * len(self.estimators)
+        for group in self._groups:
+            group.run_iteration(cab_datas)
@@ -1,7 +1,42 @@
 import numpy as np
 import pandas as pd
 
-import vis.fd
+estimate_col_prefixes = ('density_', 'speed_')
+fd_speed_thresh = 25  # m/s, segment speeds at or above which traffic is free-flowing
+
+
+def is_estimate_col(col):
+    """
+    :return: True if col of an estimator output CSV is used in fitting
+    """
+    return col.startswith(estimate_col_prefixes)
+
+
+def read_estimates(fnames, chunksize=None):
+    """
+    Read the segment density and speed columns of estimator output CSVs
+    :param chunksize: number of rows read at once, or None to read whole files
+    :return: DataFrame of the files' rows, in order of fnames
+    """
+    chunks = []
+    for fname in fnames:
+        reader = pd.read_csv(fname, usecols=is_estimate_col, dtype=np.float64, chunksize=chunksize)
+        if chunksize is None:
+            chunks.append(reader)
+        else:
+            chunks.extend(reader)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def segment_data(data, segment_num):
+    """
+    :param data: DataFrame of estimator output
+    :return: DataFrame with the speed, density and flow of segment segment_num
+    """
+    speeds = data['speed_{}'.format(segment_num)]
+    densities = data['density_{}'.format(segment_num)]
+    return pd.DataFrame({'speed': speeds, 'density': densities,
+                         'flow': np.multiply(densities.values, speeds.values)})
 
 
 def calc_flows(data, n_segments):
@@ -21,16 +56,32 @@ def fit_freeflow(densities, flows):
 
 
 def calc_capacity(densities, flows):
+    """
+    Find the highest flow at which at least min_pts_at_max points, spread
+    over a range of densities, lie within tolerance of it. Flows are tried
+    from the highest down, each time below the band of the previous one
+    :return: capacity flow, or None if no flow qualifies
+    """
     tolerance = 0.005
     min_pts_at_max = 3
-    flows_remain = flows
-    while len(flows_remain) >= 1:
-        cur_max = flows_remain.max()
-        at_max = np.logical_and(cur_max - tolerance <= flows, flows <= cur_max + tolerance)
-        if np.sum(at_max) >= min_pts_at_max:
-            if (densities[at_max].max() - densities[at_max].min()) >= 0.001:
+    min_density_range = 0.001
+    flows = np.asarray(flows, dtype=np.float64)
+    order = np.argsort(flows)
+    sorted_flows = flows[order]
+    sorted_densities = np.asarray(densities, dtype=np.float64)[order]
+    # NaN flows are sorted last and never lie within a band
+    n_remain = len(sorted_flows) - np.count_nonzero(np.isnan(sorted_flows))
+    while n_remain > 0:
+        cur_max = sorted_flows[n_remain - 1]
+        band_start = np.searchsorted(sorted_flows[:n_remain], cur_max - tolerance, side='left')
+        band_end = np.searchsorted(sorted_flows, cur_max + tolerance, side='right')
+        if band_end - band_start >= min_pts_at_max:
+            band_densities = sorted_densities[band_start:band_end]
+            if (np.nanmax(band_densities) - np.nanmin(band_densities)) >= min_density_range:
                 return cur_max
-        flows_remain = flows_remain[np.invert(at_max)]
+        # flows remaining are those below the band
+        n_remain = band_start
+    return None
 
 
 def density_at_flow_cap(freeflow_fit, flow_cap):
@@ -39,11 +90,51 @@ def density_at_flow_cap(freeflow_fit, flow_cap):
     return (flow_cap - freeflow_fit[1]) / freeflow_fit[0]
 
 
-def calc_bin_flow(flows):
-    q1 = flows.quantile(q=0.25)
-    q3 = flows.quantile(q=0.75)
-    min_outlier_flow = q3 + 1.5*(q3-q1)
-    return flows[flows < min_outlier_flow].max()
+def calc_bin_means(vals, bin_len):
+    """
+    :param vals: array of values, in consecutive bins of bin_len values, the
+    last bin possibly shorter
+    :return: array of mean of each bin
+    """
+    n_bins = -(-len(vals) // bin_len)
+    padded = np.zeros(n_bins * bin_len)
+    padded[:len(vals)] = vals
+    padded = padded.reshape(n_bins, bin_len)
+    # summed in order within each bin, as a groupby mean does
+    sums = padded[:, 0].copy()
+    for col in range(1, bin_len):
+        sums += padded[:, col]
+    counts = np.full(n_bins, bin_len)
+    if n_bins > 0:
+        counts[-1] = len(vals) - (n_bins - 1) * bin_len
+    return sums / counts
+
+
+def calc_bin_flows(flows, bin_len):
+    """
+    :param flows: array of flows, in consecutive bins of bin_len flows, the
+    last bin possibly shorter
+    :return: array of highest flow of each bin that is not an upper outlier,
+    i.e. below q3 + 1.5 * (q3 - q1) of the bin's flows
+    """
+    n_full_bins = len(flows) // bin_len
+    n_bins = -(-len(flows) // bin_len)
+    quartiles = np.empty((2, n_bins))
+    if n_full_bins > 0:
+        quartiles[:, :n_full_bins] = np.percentile(
+            flows[:n_full_bins * bin_len].reshape(n_full_bins, bin_len), [25, 75], axis=1)
+    if n_bins > n_full_bins:
+        quartiles[:, n_full_bins] = np.percentile(flows[n_full_bins * bin_len:], [25, 75])
+    q1, q3 = quartiles
+    min_outlier_flows = q3 + 1.5*(q3-q1)
+    # padding is never below a threshold
+    padded = np.full(n_bins * bin_len, np.inf)
+    padded[:len(flows)] = flows
+    padded = padded.reshape(n_bins, bin_len)
+    below = padded < min_outlier_flows[:, np.newaxis]
+    bin_flows = np.where(below, padded, -np.inf).max(axis=1)
+    bin_flows[np.invert(np.any(below, axis=1))] = np.nan
+    return bin_flows
 
 
 def fit_cong(density, flow, crit_pt):
@@ -56,52 +147,73 @@ def fit_cong(density, flow, crit_pt):
     return fit
 
 
-def calc_cong_bins(data, rho_crit, q_crit):
-    filt = np.logical_and(data['flow'] <= q_crit, data['density'] > rho_crit)
-    data_cong = data[filt].sort_values('density')
-    idxs = data_cong.index
-    data_cong['bin'] = pd.Series(np.arange(len(data_cong)) // 10 + 1, index=idxs)
-    grouped_bins = data_cong.groupby('bin')
-    bin_densities = grouped_bins['density'].mean()
-    bin_flows = grouped_bins['flow'].agg(calc_bin_flow)
+def calc_cong_bins(data, rho_crit, q_crit, bin_len=10):
+    """
+    Bin congested points in order of density, bin_len points per bin
+    :return: tuple of Series (mean density, highest non-outlier flow) of
+    each bin, indexed by bin number from 1
+    """
+    densities = data['density'].values
+    flows = data['flow'].values
+    with np.errstate(invalid='ignore'):
+        filt = np.logical_and(flows <= q_crit, densities > rho_crit)
+    # same sort as DataFrame.sort_values, so that ties are binned alike
+    order = np.argsort(densities[filt], kind='quicksort')
+    cong_densities = densities[filt][order]
+    cong_flows = flows[filt][order]
+    bins = pd.Index(np.arange(-(-len(cong_densities) // bin_len)) + 1, name='bin')
+    bin_densities = pd.Series(calc_bin_means(cong_densities, bin_len), index=bins, name='density')
+    bin_flows = pd.Series(calc_bin_flows(cong_flows, bin_len), index=bins, name='flow')
     return bin_densities, bin_flows
 
 
+def fit_segment(cur_data, speed_thresh=fd_speed_thresh):
+    """
+    Fit the triangular fundamental diagram of one segment
+    :param cur_data: DataFrame of the segment's speed, density and flow
+    :return: dict of the fit
+    """
+    filt = cur_data['speed'] >= speed_thresh
+    data_free = cur_data[filt]
+    segment_free_rho = data_free['density']
+    segment_free_q = data_free['flow']
+    fit_data = {}
+    fit_data['freeflow_filt'] = filt
+    fit_data['freeflow_fit'] = fit_freeflow(segment_free_rho, segment_free_q)
+    fit_data['flow_cap'] = calc_capacity(segment_free_rho, segment_free_q)
+    if fit_data['flow_cap'] is None:
+        raise ValueError("No flow capacity found in free-flow data!")
+    rho_crit = density_at_flow_cap(fit_data['freeflow_fit'], fit_data['flow_cap'])
+    fit_data['rho_crit'] = rho_crit
+    try:
+        cong_bin_densities, cong_bin_flows = calc_cong_bins(cur_data, rho_crit, fit_data['flow_cap'])
+        fit_data['cong_fit'] = fit_cong(cong_bin_densities, cong_bin_flows, (rho_crit, fit_data['flow_cap']))
+    except np.linalg.LinAlgError:
+        fit_data['cong_fit'] = None
+    return fit_data
+
+
+def fit_info(segment_num, fit_data):
+    info = "Segment {}: v_free={:.2f} | C_f={:.2f}".format(segment_num + 1,
+                                                           fit_data['freeflow_fit'][0],
+                                                           fit_data['flow_cap'])
+    if fit_data['cong_fit'] is not None:
+        info += " | v_cong={:.2f}".format(fit_data['cong_fit'][0])
+    return info
+
+
 def fit_fds(fnames):
-    data = pd.concat((pd.read_csv(fname) for fname in fnames))
-    data.reset_index(drop=True, inplace=True)
+    # imported here, so that pyplot is only loaded by the functions that plot
+    import vis.fd
+    data = read_estimates(fnames)
     n_segments = len(data.filter(regex="speed_").columns)
-    flows = calc_flows(data, n_segments)
-    data = pd.concat([data, flows], axis=1)
-    speed_thresh = 25
     fits = []
     for i in range(n_segments):
-        cur_data = pd.DataFrame({'speed': data['speed_{}'.format(i)],
-                                 'density': data['density_{}'.format(i)],
-                                 'flow': data['flow_{}'.format(i)]})
-        filt = cur_data['speed'] >= speed_thresh
-        data_free = cur_data[filt]
-        segment_free_rho = data_free['density']
-        segment_free_q = data_free['flow']
-        fit_data = {}
-        fit_data['freeflow_filt'] = filt
-        fit_data['freeflow_fit'] = fit_freeflow(segment_free_rho, segment_free_q)
-        fit_data['flow_cap'] = calc_capacity(segment_free_rho, segment_free_q)
-        rho_crit = density_at_flow_cap(fit_data['freeflow_fit'], fit_data['flow_cap'])
-        fit_data['rho_crit'] = rho_crit
-        try:
-            cong_bin_densities, cong_bin_flows = calc_cong_bins(cur_data, rho_crit, fit_data['flow_cap'])
-            fit_data['cong_fit'] = fit_cong(cong_bin_densities, cong_bin_flows, (rho_crit, fit_data['flow_cap']))
-        except np.linalg.LinAlgError:
-            fit_data['cong_fit'] = None
+        cur_data = segment_data(data, i)
+        fit_data = fit_segment(cur_data)
         fits.append(fit_data)
         plot_title = "Segment {} training set".format(i + 1)
-        segment_info = "Segment {}: v_free={:.2f} | C_f={:.2f}".format(i+1,
-                                                                       fit_data['freeflow_fit'][0],
-                                                                       fit_data['flow_cap'])
-        if fit_data['cong_fit'] is not None:
-            segment_info += " | v_cong={:.2f}".format(fit_data['cong_fit'][0])
-        print(segment_info)
+        print(fit_info(i, fit_data))
         vis.fd.plot_fd(cur_data['density'], cur_data['flow'], fit_data, plot_title)
     return fits
 
@@ -112,7 +224,9 @@ def estimate_flow(density, fd_fit):
     if np.any(freeflow_filt):
         flow_est[freeflow_filt] = density[freeflow_filt] * fd_fit['freeflow_fit'][0] + fd_fit['freeflow_fit'][1]
     cong_filt = np.invert(freeflow_filt)
-    if np.any(cong_filt):
+    if fd_fit['cong_fit'] is None:
+        flow_est[cong_filt] = np.nan
+    elif np.any(cong_filt):
         flow_est[cong_filt] = density[cong_filt] * fd_fit['cong_fit'][0] + fd_fit['cong_fit'][1]
     return flow_est
 
@@ -127,27 +241,40 @@ def calc_rmse(pred, val):
         return 0.0
 
 
+def test_segment(cur_data, fd_fit):
+    """
+    Score a fit on a segment's validation data
+    :param cur_data: DataFrame of the segment's density and flow
+    :return: dict of RMSE of free-flow points and of congested bins, None
+    without a congested fit, and the bins' densities and flows
+    """
+    free_filt = cur_data['density'] <= fd_fit['rho_crit']
+    flow_est = estimate_flow(cur_data['density'][free_filt], fd_fit)
+    scores = {'rmse_free': calc_rmse(cur_data['flow'][free_filt], flow_est),
+              'rmse_cong': None,
+              'cong_bins_rho': pd.Series([], dtype=np.float64),
+              'cong_bins_q': pd.Series([], dtype=np.float64)}
+    if fd_fit['cong_fit'] is not None:
+        cong_bins_rho, cong_bins_q = calc_cong_bins(cur_data, fd_fit['rho_crit'], fd_fit['flow_cap'])
+        cong_bins_q_est = estimate_flow(cong_bins_rho, fd_fit)
+        scores['rmse_cong'] = calc_rmse(cong_bins_q, cong_bins_q_est)
+        scores['cong_bins_rho'], scores['cong_bins_q'] = (cong_bins_rho, cong_bins_q)
+    return scores
+
+
+def test_info(segment_num, scores):
+    info = 'Segment {}: rmse_free={:.3f}'.format(segment_num + 1, scores['rmse_free'])
+    if scores['rmse_cong'] is not None:
+        info += ' | rmse_cong={:.3f}'.format(scores['rmse_cong'])
+    return info
+
+
 def test_fd(fnames, fits):
-    data = pd.concat((pd.read_csv(fname) for fname in fnames))
-    data.reset_index(drop=True, inplace=True)
-    n_segments = len(data.filter(regex="speed_").columns)
-    flows = calc_flows(data, n_segments)
-    data = pd.concat([data, flows], axis=1)
+    import vis.fd
+    data = read_estimates(fnames)
     for segment_num, fd_fit in enumerate(fits):
-        new_col_name = 'flow_est_{}'.format(segment_num)
-        density_col_name = "density_{}".format(segment_num)
-        flow_col_name = "flow_{}".format(segment_num)
-        data[new_col_name] = estimate_flow(data[density_col_name], fd_fit)
-        cur_data = pd.DataFrame({'density': data[density_col_name],
-                                 'flow': data[flow_col_name]})
-        free_filt = cur_data['density'] <= fd_fit['rho_crit']
-        rmse_free = calc_rmse(cur_data[free_filt]['flow'], data[free_filt][new_col_name])
-        info_str = 'Segment {}: rmse_free={:.3f}'.format(segment_num + 1, rmse_free)
-        if fd_fit['cong_fit'] is not None:
-            cong_bins_rho, cong_bins_q = calc_cong_bins(cur_data, fd_fit['rho_crit'], fd_fit['flow_cap'])
-            cong_bins_q_est = estimate_flow(cong_bins_rho, fd_fit)
-            rmse_cong = calc_rmse(cong_bins_q, cong_bins_q_est)
-            info_str += ' | rmse_cong={:.3f}'.format(rmse_cong)
-        print(info_str)
+        cur_data = segment_data(data, segment_num)
+        scores = test_segment(cur_data, fd_fit)
+        print(test_info(segment_num, scores))
         title = 'Segment {} validation set'.format(segment_num + 1)
-        vis.fd.plot_test_data(cur_data, fd_fit, cong_bins_rho, cong_bins_q, title)
+        vis.fd.plot_test_data(cur_data, fd_fit, scores['cong_bins_rho'], scores['cong_bins_q'], title)
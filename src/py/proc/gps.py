@@ -2,6 +2,9 @@ import numpy as np
 import pandas as pd
 
 earth_rad = 6.378137e6 # radius of Earth in meters
+assign_chunk_size = 10000  # max number of points assigned per vectorized pass
+grid_cell_size = 50.0  # side length of SegmentGrid cells, in meters
+segment_dtype = np.int16  # dtype of assigned segment idxs
 
 
 class Extents(object):
@@ -34,6 +37,160 @@ def dist_sqr(p1, p2):
     return np.sum(np.square(vec), 1)
 
 
+def point_segment_dists_vec(points, starts, line_vecs, len_sqrs):
+    """
+    Vectorized point-to-line-segment distances. Arguments are broadcast
+    against each other, so either aligned (k, 2) arrays of point/segment
+    pairs or e.g. (n, 1, 2) points against (m, 2) segments can be given
+    :param points: array of x, y of points
+    :param starts: array of x, y of segment starts
+    :param line_vecs: array of segment end minus segment start
+    :param len_sqrs: array of squared segment lengths
+    :return: array of distances between points and segments
+    """
+    starts_to_points = points - starts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pt_proj_dists = np.sum(starts_to_points * line_vecs, axis=-1) / len_sqrs
+    # zero-length segments: distance to their start point
+    pt_proj_dists = np.where(len_sqrs == 0.0, 0.0, pt_proj_dists)
+    np.clip(pt_proj_dists, 0.0, 1.0, out=pt_proj_dists)
+    projs_to_points = starts_to_points - pt_proj_dists[..., np.newaxis] * line_vecs
+    return np.sqrt(np.sum(np.square(projs_to_points), axis=-1))
+
+
+class SegmentGrid(object):
+    """
+    Uniform grid over the extents of road segments. Each cell lists the
+    segments that pass within buffer of some point in the cell, so the
+    segments within buffer of a point are found by a single cell lookup.
+    """
+    def __init__(self, starts, line_vecs, buffer, cell_size=grid_cell_size):
+        """
+        :param starts: (m, 2) array of x, y of segment starts
+        :param line_vecs: (m, 2) array of segment end minus segment start
+        :param buffer: max point-to-segment distance that queries are exact for
+        :param cell_size: side length of grid cells, in meters
+        """
+        self.buffer = buffer
+        self.cell_size = cell_size
+        ends = starts + line_vecs
+        seg_mins = np.minimum(starts, ends) - buffer
+        seg_maxes = np.maximum(starts, ends) + buffer
+        self.origin = seg_mins.min(axis=0)
+        self.shape = (np.floor((seg_maxes.max(axis=0) - self.origin) / cell_size)).astype(np.int64) + 1
+        len_sqrs = np.sum(np.square(line_vecs), 1)
+        cell_half_diag = np.sqrt(2.0) * cell_size / 2.0
+        cell_keys = []
+        cell_segments = []
+        for seg_idx in range(len(starts)):
+            cell_mins = self._cell_coords(seg_mins[seg_idx])
+            cell_maxes = self._cell_coords(seg_maxes[seg_idx])
+            ix, iy = np.meshgrid(np.arange(cell_mins[0], cell_maxes[0] + 1),
+                                 np.arange(cell_mins[1], cell_maxes[1] + 1))
+            ix, iy = (ix.ravel(), iy.ravel())
+            centers = self.origin + (np.column_stack((ix, iy)) + 0.5) * cell_size
+            dists = point_segment_dists_vec(centers, starts[seg_idx], line_vecs[seg_idx],
+                                            len_sqrs[seg_idx])
+            near = dists <= buffer + cell_half_diag
+            cell_keys.append(self._cell_keys_of(ix[near], iy[near]))
+            cell_segments.append(np.full(np.sum(near), seg_idx, dtype=np.int64))
+        cell_keys = np.concatenate(cell_keys)
+        cell_segments = np.concatenate(cell_segments)
+        order = np.lexsort((cell_segments, cell_keys))
+        cell_keys, cell_segments = (cell_keys[order], cell_segments[order])
+        self._keys, key_starts = np.unique(cell_keys, return_index=True)
+        self._offsets = np.append(key_starts, len(cell_keys))
+        self._segments = cell_segments
+
+    def _cell_coords(self, points):
+        return np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+
+    def _cell_keys_of(self, ix, iy):
+        return iy * self.shape[0] + ix
+
+    def candidate_pairs(self, points):
+        """
+        :param points: (n, 2) array of x, y of points
+        :return: tuple of arrays (point idxs, segment idxs), listing for each
+        point every segment that may be within buffer of it, grouped by point
+        and in increasing segment idx
+        """
+        cells = self._cell_coords(points)
+        in_grid = np.all(np.logical_and(cells >= 0, cells < self.shape), axis=1)
+        keys = self._cell_keys_of(cells[:, 0], cells[:, 1])
+        key_idxs = np.searchsorted(self._keys, keys)
+        key_idxs[key_idxs == len(self._keys)] = 0
+        found = np.logical_and(in_grid, self._keys[key_idxs] == keys)
+        point_idxs = np.flatnonzero(found)
+        key_idxs = key_idxs[found]
+        counts = self._offsets[key_idxs + 1] - self._offsets[key_idxs]
+        pair_point_idxs = np.repeat(point_idxs, counts)
+        # position of each pair within its cell's segment list
+        pair_offsets = np.arange(len(pair_point_idxs)) - np.repeat(np.cumsum(counts) - counts, counts)
+        pair_seg_idxs = self._segments[np.repeat(self._offsets[key_idxs], counts) + pair_offsets]
+        return pair_point_idxs, pair_seg_idxs
+
+
+def assign_segments_chunk(points, dirs, road_section, dist_thresh, angle_thresh):
+    """
+    Vectorized equivalent of assign_segment for a chunk of points. Only
+    point-segment pairs from the section's segment grid are tested
+    :param points: (n, 2) array of x, y of points
+    :param dirs: (n,) array of gps directions, in radians
+    :return: (n,) array of assigned segment idxs, -1 where unassigned
+    """
+    assignments = np.full(len(points), -1, dtype=segment_dtype)
+    grid = road_section.get_segment_grid(dist_thresh)
+    point_idxs, seg_idxs = grid.candidate_pairs(points)
+    if len(point_idxs) == 0:
+        return assignments
+    dists = point_segment_dists_vec(points[point_idxs], road_section.seg_starts[seg_idxs],
+                                    road_section.seg_vecs[seg_idxs],
+                                    road_section.seg_len_sqrs[seg_idxs])
+    # closest segment of each point, lowest segment idx on ties
+    order = np.lexsort((seg_idxs, dists, point_idxs))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = point_idxs[order[1:]] != point_idxs[order[:-1]]
+    closest = order[first]
+    point_idxs, seg_idxs, min_dist = (point_idxs[closest], seg_idxs[closest], dists[closest])
+    angle_diff = np.abs(dirs[point_idxs] - road_section.seg_angles[seg_idxs])
+    with np.errstate(invalid='ignore'):
+        assigned = np.logical_and(min_dist <= dist_thresh, angle_diff <= angle_thresh)
+    assignments[point_idxs[assigned]] = seg_idxs[assigned]
+    return assignments
+
+
+def assign_section_segments_chunk(points, dirs, section_set, dist_thresh, angle_thresh):
+    """
+    assign_segments_chunk for every section of a SectionSet at once: the
+    candidate pairs of the combined segment grid are grouped by point and
+    section, and the closest segment of each group is tested
+    :param points: (n, 2) array of x, y of points
+    :param dirs: (n,) array of gps directions, in radians
+    :return: tuple of arrays (point idxs, combined segment idxs) of the
+    assigned pairs, in order of point and section
+    """
+    grid = section_set.get_segment_grid(dist_thresh)
+    point_idxs, seg_idxs = grid.candidate_pairs(points)
+    if len(point_idxs) == 0:
+        return point_idxs, seg_idxs
+    dists = point_segment_dists_vec(points[point_idxs], section_set.seg_starts[seg_idxs],
+                                    section_set.seg_vecs[seg_idxs],
+                                    section_set.seg_len_sqrs[seg_idxs])
+    sections = section_set.seg_sections[seg_idxs]
+    # closest segment of each point in each section, lowest segment idx on ties
+    order = np.lexsort((seg_idxs, dists, sections, point_idxs))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = np.logical_or(point_idxs[order[1:]] != point_idxs[order[:-1]],
+                              sections[order[1:]] != sections[order[:-1]])
+    closest = order[first]
+    point_idxs, seg_idxs, min_dist = (point_idxs[closest], seg_idxs[closest], dists[closest])
+    angle_diff = np.abs(dirs[point_idxs] - section_set.seg_angles[seg_idxs])
+    with np.errstate(invalid='ignore'):
+        assigned = np.logical_and(min_dist <= dist_thresh, angle_diff <= angle_thresh)
+    return point_idxs[assigned], seg_idxs[assigned]
+
+
 def assign_segment(loc_xy, road_section, dist_thresh, angle_thresh):
     dists = road_section.point_segment_dists(loc_xy).squeeze()
     idx_min = dists.idxmin()
@@ -45,8 +202,9 @@ def assign_segment(loc_xy, road_section, dist_thresh, angle_thresh):
     return -1
 
 
-def assign_segments(cab_traces, road_section, dist_thresh, angle_thresh):
+def assign_segments_rowwise(cab_traces, road_section, dist_thresh, angle_thresh):
     """
+    Row-by-row reference implementation of assign_segments
     :param cab_traces: must contain entries 'x' and 'y' of location of interest
     :param road_section: RoadSection instance
     :param dist_thresh: distance to segment threshold
@@ -54,7 +212,8 @@ def assign_segments(cab_traces, road_section, dist_thresh, angle_thresh):
     :return: idx of segment that should be assigned to loc,
     or -1 if loc's distance to the section is outside thresh
     """
-    assignments = pd.Series([-1] * len(cab_traces.index), index=cab_traces.index)
+    assignments = pd.Series(np.full(len(cab_traces.index), -1, dtype=segment_dtype),
+                            index=cab_traces.index)
     loc_xy = cab_traces[['x', 'y', 'dir']]
     need_calcs = road_section.min_pt_dist_approx(loc_xy) <= dist_thresh
     if np.any(need_calcs):
@@ -62,4 +221,58 @@ def assign_segments(cab_traces, road_section, dist_thresh, angle_thresh):
                                                            axis=1,
                                                            args=(road_section, dist_thresh,
                                                                  angle_thresh))
-    return assignments
+    return assignments.astype(segment_dtype)
+
+
+def assign_segments(cab_traces, road_section, dist_thresh, angle_thresh,
+                    chunk_size=assign_chunk_size):
+    """
+    :param cab_traces: must contain entries 'x', 'y' and 'dir' of location of interest
+    :param road_section: RoadSection instance
+    :param dist_thresh: distance to segment threshold
+    :param angle_thresh: threshold of gps direction to road angle, in radians
+    :param chunk_size: max number of points whose distances to all segments
+    are calculated at once, bounding memory use
+    :return: idx of segment that should be assigned to loc,
+    or -1 if loc's distance to the section is outside thresh
+    """
+    assignments = np.full(len(cab_traces.index), -1, dtype=segment_dtype)
+    # in float64, whatever the dtypes of the columns
+    points = cab_traces[['x', 'y']].values.astype(np.float64)
+    dirs = cab_traces['dir'].values.astype(np.float64)
+    for chunk_start in range(0, len(points), chunk_size):
+        rows = slice(chunk_start, chunk_start + chunk_size)
+        assignments[rows] = assign_segments_chunk(points[rows], dirs[rows], road_section,
+                                                  dist_thresh, angle_thresh)
+    return pd.Series(assignments, index=cab_traces.index)
+
+
+def assign_section_segments(cab_traces, section_set, dist_thresh, angle_thresh,
+                            chunk_size=assign_chunk_size):
+    """
+    Assign the rows of cab_traces to the segments of every section of a
+    SectionSet in one pass. A row may be assigned to a segment of each section
+    :param cab_traces: must contain entries 'x', 'y' and 'dir' of location of
+    interest, in the x, y frame of section_set
+    :param section_set: SectionSet instance
+    :param dist_thresh: distance to segment threshold
+    :param angle_thresh: threshold of gps direction to road angle, in radians
+    :param chunk_size: max number of points whose candidate pairs are
+    processed at once, bounding memory use
+    :return: tuple of arrays (row positions, section positions, segment idxs
+    within the section) of the assigned pairs, in order of row and section
+    """
+    points = cab_traces[['x', 'y']].values.astype(np.float64)
+    dirs = cab_traces['dir'].values.astype(np.float64)
+    rows = []
+    seg_idxs = []
+    for chunk_start in range(0, len(points), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        chunk_rows, chunk_seg_idxs = assign_section_segments_chunk(
+            points[chunk], dirs[chunk], section_set, dist_thresh, angle_thresh)
+        rows.append(chunk_rows + chunk_start)
+        seg_idxs.append(chunk_seg_idxs)
+    rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+    seg_idxs = np.concatenate(seg_idxs) if seg_idxs else np.empty(0, dtype=np.int64)
+    return (rows, section_set.seg_sections[seg_idxs],
+            section_set.seg_idxs[seg_idxs].astype(segment_dtype))
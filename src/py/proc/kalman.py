@@ -0,0 +1,242 @@
+import numpy as np
+
+
+class RoadKalmanEngine(object):
+    """
+    Kalman filter predict/update steps specialized to the road state model.
+    States are n_segments segment densities followed by ramp densities.
+    The transition matrix is bidiagonal over the segment block (outlet terms
+    on the diagonal, inlet terms below it), has one +-1 entry linking each
+    ramp segment to its ramp state, and is the identity over ramp states.
+    Each measurement observes a single state. Products with these matrices
+    are done as row operations, so a step costs O(n_states^2) instead of
+    the O(n_states^3) of dense matmuls, without allocating per step.
+    """
+    def __init__(self, transition_mat_template, state_to_meas_mat, measurement_covar,
+                 n_segments):
+        """
+        :param transition_mat_template: transition matrix with zero segment block
+        :param state_to_meas_mat: measurement matrix with a single 1 per row
+        :param measurement_covar: measurement noise covariance
+        :param n_segments: number of segment states, which come first
+        """
+        n_states = len(transition_mat_template)
+        self.n_segments = n_segments
+        self.n_states = n_states
+        ramp_block = transition_mat_template[:n_segments, n_segments:]
+        self._ramp_rows, ramp_cols = np.nonzero(ramp_block)
+        assert len(np.unique(self._ramp_rows)) == len(self._ramp_rows)
+        self._ramp_cols = ramp_cols + n_segments
+        self._ramp_signs = ramp_block[self._ramp_rows, ramp_cols]
+        assert np.all(np.sum(state_to_meas_mat != 0, axis=1) == 1)
+        self._meas_idxs = np.argmax(state_to_meas_mat != 0, axis=1)
+        self._meas_coefs = state_to_meas_mat[np.arange(len(self._meas_idxs)), self._meas_idxs]
+        self._measurement_covar = measurement_covar
+        self._diag_idxs = np.diag_indices(n_states)
+        self._work = np.empty((n_states, n_states))
+        self._work2 = np.empty((n_states, n_states))
+
+    def apply_transition(self, outlet_terms, inlet_terms, mat, out):
+        """
+        out = A @ mat, for the transition matrix A given by its segment terms
+        :param outlet_terms: (n_segments,) diagonal of the segment block
+        :param inlet_terms: (n_segments - 1,) subdiagonal of the segment block
+        :param mat: (n_states,) vector or (n_states, k) matrix
+        :param out: array like mat to write the result to, not overlapping mat
+        :return: out
+        """
+        n_seg = self.n_segments
+        signs = self._ramp_signs
+        if mat.ndim == 2:
+            outlet_terms = outlet_terms[:, np.newaxis]
+            inlet_terms = inlet_terms[:, np.newaxis]
+            signs = signs[:, np.newaxis]
+        np.multiply(outlet_terms, mat[:n_seg], out=out[:n_seg])
+        out[1:n_seg] += inlet_terms * mat[:n_seg - 1]
+        out[self._ramp_rows] += signs * mat[self._ramp_cols]
+        out[n_seg:] = mat[n_seg:]
+        return out
+
+    def apply_transition_transposed(self, outlet_terms, inlet_terms, mat, out):
+        """
+        out = mat @ A.T, as column operations on mat
+        :param mat: (k, n_states) matrix
+        :param out: matrix like mat to write the result to, not overlapping mat
+        :return: out
+        """
+        n_seg = self.n_segments
+        np.multiply(mat[:, :n_seg], outlet_terms, out=out[:, :n_seg])
+        out[:, 1:n_seg] += mat[:, :n_seg - 1] * inlet_terms
+        out[:, self._ramp_rows] += mat[:, self._ramp_cols] * self._ramp_signs
+        out[:, n_seg:] = mat[:, n_seg:]
+        return out
+
+    def predict_state(self, state, outlet_terms, inlet_terms):
+        """
+        :return: A @ state, as a new array
+        """
+        return self.apply_transition(outlet_terms, inlet_terms, state, np.empty_like(state))
+
+    def predict_covar(self, error_covar, outlet_terms, inlet_terms, process_vars):
+        """
+        error_covar = A @ error_covar @ A.T + diag(process_vars), in place
+        :param process_vars: (n_states,) diagonal of the process noise covariance
+        """
+        self.apply_transition(outlet_terms, inlet_terms, error_covar, self._work)
+        self.apply_transition_transposed(outlet_terms, inlet_terms, self._work, self._work2)
+        self._symmetrize(self._work2, error_covar)
+        error_covar[self._diag_idxs] += process_vars
+
+    def _symmetrize(self, mat, out):
+        np.add(mat, mat.T, out=out)
+        out *= 0.5
+
+    def update(self, state, error_covar, meas):
+        """
+        Kalman update of state and error_covar in place, with a Joseph form
+        covariance update to keep error_covar symmetric positive semi-definite
+        :param meas: measurement vector
+        :return: innovation vector
+        """
+        h, c = (self._meas_idxs, self._meas_coefs)
+        pht = error_covar[:, h] * c
+        innov_covar = pht[h] * c[:, np.newaxis] + self._measurement_covar
+        # K = P H^T S^-1, from S K^T = H P since S is symmetric
+        gain = np.ascontiguousarray(np.linalg.solve(innov_covar, pht.T).T)
+        innov = meas - state[h] * c
+        # summed elementwise rather than by BLAS gemv, whose rounding depends
+        # on memory alignment; batched sections then match single ones exactly
+        state += np.sum(gain * innov, axis=-1)
+        # (I - K H) P (I - K H)^T + K R K^T
+        kh_p = np.matmul(gain, c[:, np.newaxis] * error_covar[h], out=self._work)
+        np.subtract(error_covar, kh_p, out=self._work2)
+        factor_p_kht = np.matmul(self._work2[:, h] * c, gain.T, out=self._work)
+        self._work2 -= factor_p_kht
+        self._work2 += np.matmul(np.matmul(gain, self._measurement_covar), gain.T)
+        self._symmetrize(self._work2, error_covar)
+        return innov
+
+
+class BatchedRoadKalmanEngine(object):
+    """
+    RoadKalmanEngine steps of a batch of road sections at once, on arrays
+    with a leading batch axis. Sections must have the same numbers of
+    segments, ramps and measurements, but ramps and measured states may be
+    at different positions. Every operation is the one RoadKalmanEngine
+    does for a single section, so each section's result is the same as
+    stepping it on its own.
+    """
+    def __init__(self, engines):
+        """
+        :param engines: list of RoadKalmanEngine, one per section of the batch
+        """
+        first = engines[0]
+        for engine in engines:
+            assert(engine.n_states == first.n_states and engine.n_segments == first.n_segments)
+            assert(len(engine._ramp_rows) == len(first._ramp_rows))
+            assert(len(engine._meas_idxs) == len(first._meas_idxs))
+        n_batch = len(engines)
+        n_states = first.n_states
+        self.n_batch = n_batch
+        self.n_segments = first.n_segments
+        self.n_states = n_states
+        self._ramp_rows = np.array([engine._ramp_rows for engine in engines])
+        self._ramp_cols = np.array([engine._ramp_cols for engine in engines])
+        self._ramp_signs = np.array([engine._ramp_signs for engine in engines])
+        self._meas_idxs = np.array([engine._meas_idxs for engine in engines])
+        self._meas_coefs = np.array([engine._meas_coefs for engine in engines])
+        self._measurement_covar = np.array([engine._measurement_covar for engine in engines])
+        # index arrays selecting per-section rows, and per-section columns of every row
+        self._batch_idxs = np.arange(n_batch)[:, np.newaxis]
+        self._batch_idxs3 = np.arange(n_batch)[:, np.newaxis, np.newaxis]
+        self._row_idxs3 = np.arange(n_states)[np.newaxis, :, np.newaxis]
+        self._diag_idxs = np.diag_indices(n_states)
+        self._work = np.empty((n_batch, n_states, n_states))
+        self._work2 = np.empty((n_batch, n_states, n_states))
+
+    def _columns(self, mat, col_idxs):
+        # mat[b][:, col_idxs[b]] for each section b
+        return mat[self._batch_idxs3, self._row_idxs3[:, :mat.shape[1]], col_idxs[:, np.newaxis, :]]
+
+    def apply_transition(self, outlet_terms, inlet_terms, mat, out):
+        """
+        out[b] = A[b] @ mat[b] for each section b
+        :param outlet_terms: (n_batch, n_segments) diagonals of the segment blocks
+        :param inlet_terms: (n_batch, n_segments - 1) subdiagonals of the segment blocks
+        :param mat: (n_batch, n_states) vectors or (n_batch, n_states, k) matrices
+        :param out: array like mat to write the result to, not overlapping mat
+        :return: out
+        """
+        n_seg = self.n_segments
+        signs = self._ramp_signs
+        rows = (self._batch_idxs, self._ramp_rows)
+        cols = (self._batch_idxs, self._ramp_cols)
+        if mat.ndim == 3:
+            outlet_terms = outlet_terms[:, :, np.newaxis]
+            inlet_terms = inlet_terms[:, :, np.newaxis]
+            signs = signs[:, :, np.newaxis]
+        np.multiply(outlet_terms, mat[:, :n_seg], out=out[:, :n_seg])
+        out[:, 1:n_seg] += inlet_terms * mat[:, :n_seg - 1]
+        out[rows] += signs * mat[cols]
+        out[:, n_seg:] = mat[:, n_seg:]
+        return out
+
+    def apply_transition_transposed(self, outlet_terms, inlet_terms, mat, out):
+        """
+        out[b] = mat[b] @ A[b].T, as column operations on mat
+        :param mat: (n_batch, k, n_states) matrices
+        :param out: array like mat to write the result to, not overlapping mat
+        :return: out
+        """
+        n_seg = self.n_segments
+        rows = self._row_idxs3[:, :mat.shape[1]]
+        ramp_rows = (self._batch_idxs3, rows, self._ramp_rows[:, np.newaxis, :])
+        np.multiply(mat[:, :, :n_seg], outlet_terms[:, np.newaxis, :], out=out[:, :, :n_seg])
+        out[:, :, 1:n_seg] += mat[:, :, :n_seg - 1] * inlet_terms[:, np.newaxis, :]
+        out[ramp_rows] += self._columns(mat, self._ramp_cols) * self._ramp_signs[:, np.newaxis, :]
+        out[:, :, n_seg:] = mat[:, :, n_seg:]
+        return out
+
+    def predict_state(self, state, outlet_terms, inlet_terms):
+        """
+        :return: A[b] @ state[b] of each section b, as a new array
+        """
+        return self.apply_transition(outlet_terms, inlet_terms, state, np.empty_like(state))
+
+    def predict_covar(self, error_covar, outlet_terms, inlet_terms, process_vars):
+        """
+        error_covar[b] = A[b] @ error_covar[b] @ A[b].T + diag(process_vars[b]), in place
+        :param process_vars: (n_batch, n_states) diagonals of the process noise covariances
+        """
+        self.apply_transition(outlet_terms, inlet_terms, error_covar, self._work)
+        self.apply_transition_transposed(outlet_terms, inlet_terms, self._work, self._work2)
+        self._symmetrize(self._work2, error_covar)
+        error_covar[(slice(None),) + self._diag_idxs] += process_vars
+
+    def _symmetrize(self, mat, out):
+        np.add(mat, mat.swapaxes(1, 2), out=out)
+        out *= 0.5
+
+    def update(self, state, error_covar, meas):
+        """
+        Kalman update of each section's state and error_covar in place, as
+        RoadKalmanEngine.update
+        :param meas: (n_batch, n_meas) measurement vectors
+        :return: (n_batch, n_meas) innovation vectors
+        """
+        h, c = (self._meas_idxs, self._meas_coefs)
+        meas_rows = (self._batch_idxs, h)
+        pht = self._columns(error_covar, h) * c[:, np.newaxis, :]
+        innov_covar = pht[meas_rows] * c[:, :, np.newaxis] + self._measurement_covar
+        gain = np.ascontiguousarray(np.linalg.solve(innov_covar, pht.swapaxes(1, 2)).swapaxes(1, 2))
+        gain_t = gain.swapaxes(1, 2)
+        innov = meas - state[meas_rows] * c
+        state += np.sum(gain * innov[:, np.newaxis, :], axis=-1)
+        kh_p = np.matmul(gain, c[:, :, np.newaxis] * error_covar[meas_rows], out=self._work)
+        np.subtract(error_covar, kh_p, out=self._work2)
+        factor_p_kht = np.matmul(self._columns(self._work2, h) * c[:, np.newaxis, :], gain_t,
+                                 out=self._work)
+        self._work2 -= factor_p_kht
+        self._work2 += np.matmul(np.matmul(gain, self._measurement_covar), gain_t)
+        self._symmetrize(self._work2, error_covar)
+        return innov
@@ -0,0 +1,379 @@
+import sys
+import bisect
+import asyncio
+import logging
+import numpy as np
+import pandas as pd
+
+from proc import gps
+from proc import road
+from proc import cabdata
+from proc import detectors
+from proc import estimator
+
+default_dist_thresh = 11.0
+default_angle_thresh = np.deg2rad(30.0)
+tail_poll_interval = 0.5  # seconds between reads of a tailed file at its end
+
+
+class OnlineCabData(object):
+    """
+    Cab fixes of a live feed. Fixes are queued as they arrive; deltas to the
+    previous fix of the same cab and road segments are computed for the
+    queue at once, before the estimator uses it. Only fixes on the road
+    section that an estimator iteration may still use are kept, and only the
+    last fix of each cab is remembered. Provides calc_avg_segment_speeds like
+    CabData
+    """
+    def __init__(self, road_section, dist_thresh=default_dist_thresh,
+                 angle_thresh=default_angle_thresh, dtime_max=90):
+        """
+        :param road_section: RoadSection fixes are assigned to
+        :param dist_thresh: threshold of distance to road segment, in meters
+        :param angle_thresh: threshold of gps direction to road angle, in radians
+        :param dtime_max: maximum delta time for valid velocity, in seconds
+        """
+        self.road_section = road_section
+        self.dist_thresh = dist_thresh
+        self.angle_thresh = angle_thresh
+        self.dtime_max = dtime_max
+        self._pending = []
+        self._cab_idxs = {}
+        self._cab_ids = []
+        self._last_fix = np.full((0, 3), np.nan)  # time, x, y of each cab's last fix
+        self._min_time = -np.inf
+        self.cab_ids = np.empty(0, dtype=object)
+        self.times = np.empty(0, dtype=np.int64)
+        self.segments = np.empty(0, dtype=gps.segment_dtype)
+        self.speeds = np.empty(0, dtype=cabdata.compact_dtypes['speed'])
+        self.n_late = 0
+        self.n_out_of_order = 0
+
+    def add_fix(self, cab_id, lat, long, occupancy, time):
+        self._pending.append((self._cab_idx(cab_id), lat, long, time))
+
+    def _cab_idx(self, cab_id):
+        cab_idx = self._cab_idxs.get(cab_id)
+        if cab_idx is None:
+            cab_idx = len(self._cab_ids)
+            self._cab_idxs[cab_id] = cab_idx
+            self._cab_ids.append(cab_id)
+            if cab_idx >= len(self._last_fix):
+                grown = np.full((max(2 * len(self._last_fix), 64), 3), np.nan)
+                grown[:len(self._last_fix)] = self._last_fix
+                self._last_fix = grown
+        return cab_idx
+
+    def process_pending(self):
+        """
+        Calculate deltas and road segments of the queued fixes, as
+        CabData.calc_deltas and assign_road_segments would
+        """
+        if len(self._pending) == 0:
+            return
+        pending = np.array(self._pending)
+        self._pending = []
+        cab_idxs = pending[:, 0].astype(np.int64)
+        times = pending[:, 3].astype(np.int64)
+        # fixes older than the last fix of their cab cannot be chained any more
+        with np.errstate(invalid='ignore'):
+            in_order = np.invert(times < self._last_fix[cab_idxs, 0])
+        self.n_out_of_order += np.sum(np.invert(in_order))
+        order = np.lexsort((times[in_order], cab_idxs[in_order]))
+        pending, cab_idxs, times = (pending[in_order][order], cab_idxs[in_order][order],
+                                    times[in_order][order])
+        lat_center, long_center = self.road_section.center
+        # x, y, speeds and dirs are rounded to the dtypes CabData keeps them in
+        fixes = np.column_stack((times,
+                                 cabdata.to_compact('x', gps.long_to_x(pending[:, 2], lat_center,
+                                                                       long_center)),
+                                 cabdata.to_compact('y', gps.lat_to_y(pending[:, 1], lat_center))))
+        first = np.ones(len(cab_idxs), dtype=bool)
+        first[1:] = cab_idxs[1:] != cab_idxs[:-1]
+        prev_fixes = np.empty_like(fixes)
+        prev_fixes[1:] = fixes[:-1]
+        prev_fixes[first] = self._last_fix[cab_idxs[first]]
+        last = np.ones(len(cab_idxs), dtype=bool)
+        last[:-1] = first[1:]
+        self._last_fix[cab_idxs[last]] = fixes[last]
+        delta = fixes - prev_fixes
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta[delta[:, 0] > self.dtime_max, 0] = np.nan
+            vx = delta[:, 1] / delta[:, 0]
+            vy = delta[:, 2] / delta[:, 0]
+        # like CabData.calc_deltas, unknown velocity components count as 0 in speed
+        speeds = np.sqrt(np.where(np.isnan(vx), 0.0, np.square(vx)) +
+                         np.where(np.isnan(vy), 0.0, np.square(vy)))
+        speeds = cabdata.to_compact('speed', speeds)
+        dirs = cabdata.to_compact('dir', np.arctan2(vy, vx)).astype(np.float64)
+        # fixes in iterations that already ran only serve as previous fixes
+        current = times > self._min_time
+        self.n_late += np.sum(np.invert(current))
+        segments = gps.assign_segments_chunk(fixes[current, 1:], dirs[current], self.road_section,
+                                             self.dist_thresh, self.angle_thresh)
+        on_road = segments >= 0
+        cab_ids = np.asarray(self._cab_ids, dtype=object)[cab_idxs[current][on_road]]
+        self.cab_ids = np.concatenate((self.cab_ids, cab_ids))
+        self.times = np.concatenate((self.times, times[current][on_road]))
+        self.segments = np.concatenate((self.segments, segments[on_road]))
+        self.speeds = np.concatenate((self.speeds, speeds[current][on_road]))
+
+    def forget_before(self, time):
+        """
+        Drop fixes before time, and the last fixes of cabs whose next fix
+        can not be within dtime_max of it. Fixes before time that arrive
+        later are only used for deltas
+        """
+        keep = self.times >= time
+        self.cab_ids, self.times = (self.cab_ids[keep], self.times[keep])
+        self.segments, self.speeds = (self.segments[keep], self.speeds[keep])
+        self._min_time = time - 1
+        with np.errstate(invalid='ignore'):
+            stale = self._last_fix[:, 0] < self._min_time - self.dtime_max
+        self._last_fix[stale] = np.nan
+
+    def calc_avg_segment_speeds(self, segments, time_lims):
+        """
+        :param segments: segments of the RoadSection that was assigned
+        :param time_lims: tuple (start, end) of times, both inclusive
+        :return: Series of mean speed of each segment with assigned rows,
+        indexed by segment
+        """
+        self.process_pending()
+        rows = np.flatnonzero(np.logical_and(self.times >= time_lims[0],
+                                             self.times <= time_lims[1]))
+        # rows in the order of CabData's time index, so that sums round the same
+        rows = rows[np.argsort(self.cab_ids[rows].astype(str), kind='mergesort')]
+        rows = rows[np.argsort(self.times[rows], kind='mergesort')]
+        return cabdata.avg_segment_speeds(self.segments[rows], self.speeds[rows])
+
+
+class OnlineDetectorMeas(object):
+    """
+    Detector measurements from samples received so far, with the interface
+    of road.DetectorMeas. Rows are only interpolated for the few times an
+    estimator is about to use, and stored in a small ring. Times later than
+    the last sample of a detector take its last sample's values
+    """
+    def __init__(self, vds_ids, point_idxs, capacity=4):
+        """
+        :param vds_ids: ids of the section's detectors, in section point order
+        :param point_idxs: idxs of the section points of the detectors
+        :param capacity: number of rows kept
+        """
+        self.point_idxs = point_idxs
+        self._columns = {vds_id: col for col, vds_id in enumerate(vds_ids)}
+        self._samples = [([], [], []) for vds_id in vds_ids]  # times, flows, speeds
+        self.row_times = np.full(capacity, np.nan)
+        self.flows = np.zeros((capacity, len(vds_ids)))
+        self.speeds = np.zeros((capacity, len(vds_ids)))
+        self.densities = np.zeros((capacity, len(vds_ids)))
+        self._next_row = 0
+
+    def add_sample(self, vds_id, time, flow, speed):
+        """
+        :param flow: flow in vehicles per 5 minutes
+        :param speed: speed in mph
+        :return: False if vds_id is not a detector of the section
+        """
+        col = self._columns.get(vds_id)
+        if col is None:
+            return False
+        times, flows, speeds = self._samples[col]
+        idx = bisect.bisect_right(times, time)
+        flow, speed = detectors.pems_to_si(flow, speed)
+        times.insert(idx, time)
+        flows.insert(idx, flow)
+        speeds.insert(idx, speed)
+        return True
+
+    def has_samples(self):
+        return all(len(times) > 0 for times, flows, speeds in self._samples)
+
+    def compute(self, time):
+        """
+        Interpolate a row of measurements at time, replacing the oldest row
+        :return: idx of the row
+        """
+        row = self._next_row
+        self._next_row = (row + 1) % len(self.row_times)
+        for col, (times, flows, speeds) in enumerate(self._samples):
+            times = np.array(times, dtype=np.float64)
+            self.flows[row, col] = detectors.interp_at_times(times, np.array(flows), [time])[0][0]
+            self.speeds[row, col] = detectors.interp_at_times(times, np.array(speeds), [time])[0][0]
+        self.densities[row] = road.calc_densities(self.flows[row], self.speeds[row])
+        self.row_times[row] = time
+        return row
+
+    def time_idx(self, time):
+        """
+        :return: row of time, or None if no row was computed for time
+        """
+        rows = np.flatnonzero(self.row_times == time)
+        return int(rows[0]) if len(rows) > 0 else None
+
+    def densities_at(self, time_idx):
+        """
+        :return: Series of densities of row time_idx, indexed by section point idx
+        """
+        return pd.Series(self.densities[time_idx], index=self.point_idxs)
+
+    def forget_before(self, time):
+        """
+        Drop samples that are not needed to interpolate at time or later
+        """
+        for times, flows, speeds in self._samples:
+            idx = bisect.bisect_right(times, time) - 1
+            if idx > 0:
+                idx = bisect.bisect_left(times, times[idx])
+                del times[:idx], flows[:idx], speeds[:idx]
+
+
+class OnlineEstimator(object):
+    """
+    Runs a RoadStateEstimator on a live feed of cab fixes and detector
+    samples. Feed time is the latest time of any received fix, sample or
+    tick. An iteration runs as soon as feed time is lag seconds past the
+    time of its detector measurement, so every estimate is emitted lag
+    seconds of feed time after its time. Fixes and samples later than that
+    are not used
+    """
+    def __init__(self, road_section, timestep, on_estimate, start_time=None, lag=0,
+                 dist_thresh=default_dist_thresh, angle_thresh=default_angle_thresh):
+        """
+        :param road_section: RoadSection, whose detector data need not be loaded
+        :param timestep: time between estimates, in seconds
+        :param on_estimate: function called with (time, state, speeds) of each estimate
+        :param start_time: time of the initial state, or None for the first feed time
+        :param lag: seconds of feed time that data may arrive late
+        """
+        self.logger = logging.getLogger("OnlineEstimator")
+        self.road_section = road_section
+        self.timestep = timestep
+        self.on_estimate = on_estimate
+        self.start_time = start_time
+        self.lag = lag
+        self.feed_time = None
+        self.cab_data = OnlineCabData(road_section, dist_thresh, angle_thresh)
+        point_idxs = np.array(road_section.detector_point_idxs)
+        vds_ids = [int(vds_id) for vds_id in road_section.section['vds_id'][point_idxs]]
+        self.detector_meas = OnlineDetectorMeas(vds_ids, point_idxs)
+        self.estimator = None
+        self.n_estimates = 0
+
+    def handle_line(self, line):
+        """
+        Handle a line of the feed, one of
+        gps <cab id> <lat> <long> <occupancy> <unix time>
+        vds <vds id> <unix time> <flow (veh/5 min)> <speed (mph)>
+        tick <unix time>
+        """
+        fields = line.split()
+        if len(fields) == 0:
+            return
+        try:
+            if fields[0] == 'gps':
+                time = int(fields[5])
+                self.cab_data.add_fix(fields[1], float(fields[2]), float(fields[3]),
+                                      int(fields[4]), time)
+            elif fields[0] == 'vds':
+                time = int(fields[2])
+                self.detector_meas.add_sample(int(fields[1]), time, float(fields[3]),
+                                              float(fields[4]))
+            elif fields[0] == 'tick':
+                time = int(fields[1])
+            else:
+                raise ValueError("unknown record type")
+        except (IndexError, ValueError) as err:
+            self.logger.warning("Ignored feed line {!r}: {}".format(line, err))
+            return
+        self.advance(time)
+
+    def advance(self, time):
+        """
+        Move feed time forward to time, and run all iterations that are due
+        """
+        if self.feed_time is not None and time <= self.feed_time:
+            return
+        self.feed_time = time
+        if self.start_time is None:
+            self.start_time = time
+        if self.estimator is None:
+            if time < self.start_time + self.lag or not self.detector_meas.has_samples():
+                return
+            self.detector_meas.compute(self.start_time)
+            self.estimator = estimator.RoadStateEstimator(self.road_section, self.timestep,
+                                                          self.start_time,
+                                                          detector_meas=self.detector_meas)
+            self.cab_data.forget_before(self.start_time + 1)
+        while self.estimator.time + self.timestep + self.lag <= time:
+            self._run_iteration()
+
+    def _run_iteration(self):
+        cur_time = self.estimator.time
+        for meas_time in (cur_time, cur_time + self.timestep):
+            if self.detector_meas.time_idx(meas_time) is None:
+                self.detector_meas.compute(meas_time)
+        self.estimator.run_iteration(self.cab_data)
+        self.cab_data.forget_before(cur_time + 1)
+        self.detector_meas.forget_before(self.estimator.time)
+        self.on_estimate(self.estimator.time, self.estimator.state,
+                         self.estimator.speed_buffer.valid_speeds(12))
+        self.n_estimates += 1
+
+
+async def _read_stream_lines(reader):
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        yield line.decode()
+
+
+async def _tail_file_lines(fname, follow):
+    with open(fname, 'r') as fin:
+        partial = ''
+        while True:
+            line = fin.readline()
+            if line.endswith('\n'):
+                yield partial + line
+                partial = ''
+            elif follow:
+                partial += line
+                await asyncio.sleep(tail_poll_interval)
+            else:
+                if partial + line:
+                    yield partial + line
+                return
+
+
+async def feed_lines(source, follow=False):
+    """
+    Asynchronously iterate over lines of a feed
+    :param source: 'tcp:<host>:<port>' or 'unix:<path>' to connect to a
+    server, '-' for standard input, or the path of a file
+    :param follow: keep reading a file as it grows, like tail -f
+    """
+    if source.startswith('tcp:'):
+        host, port = source[len('tcp:'):].rsplit(':', 1)
+        reader, writer = await asyncio.open_connection(host, int(port))
+    elif source.startswith('unix:'):
+        reader, writer = await asyncio.open_unix_connection(source[len('unix:'):])
+    elif source == '-':
+        reader = asyncio.StreamReader()
+        await asyncio.get_event_loop().connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    else:
+        async for line in _tail_file_lines(source, follow):
+            yield line
+        return
+    async for line in _read_stream_lines(reader):
+        yield line
+
+
+async def run_online(online_estimator, source, follow=False):
+    """
+    Feed all lines of source to online_estimator
+    """
+    async for line in feed_lines(source, follow):
+        online_estimator.handle_line(line)
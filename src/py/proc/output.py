@@ -0,0 +1,114 @@
+import csv
+import queue
+import logging
+import threading
+import numpy as np
+
+default_block_rows = 4096
+n_blocks = 3  # blocks being filled, queued and written at once
+
+
+def estimate_header(n_segments, n_ramps):
+    """
+    :return: column names of estimator output rows, as read by proc.fd
+    """
+    return (['time'] +
+            ['density_{}'.format(i) for i in range(n_segments)] +
+            ['ramp_density_{}'.format(i) for i in range(n_ramps)] +
+            ['speed_{}'.format(i) for i in range(n_segments)])
+
+
+class EstimateWriter(object):
+    """
+    CSV sink for estimator output. Rows are copied into a preallocated
+    block; full blocks are formatted and written by a background thread
+    while estimation continues. Use as a context manager, or call close()
+    """
+    def __init__(self, fname, n_segments, n_ramps, block_rows=default_block_rows,
+                 flush_blocks=False):
+        """
+        :param block_rows: number of rows written together
+        :param flush_blocks: flush the file after writing each block, for
+        readers following the file as it is written
+        """
+        self._flush_blocks = flush_blocks
+        self.header = estimate_header(n_segments, n_ramps)
+        self._part_ends = np.cumsum([1, n_segments + n_ramps, n_segments])
+        self._outputf = open(fname, 'w', newline='')
+        self._output_wr = csv.writer(self._outputf, dialect='excel')
+        self._output_wr.writerow(self.header)
+        self._free_blocks = queue.Queue()
+        for i in range(n_blocks):
+            self._free_blocks.put(np.empty((block_rows, len(self.header))))
+        self._full_blocks = queue.Queue()
+        self._block = self._free_blocks.get()
+        self._n_rows = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._write_blocks, name="EstimateWriter")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # an error of the writer thread must not replace one leaving the block
+        self.close(raise_error=exc_type is None)
+
+    def _write_blocks(self):
+        while True:
+            item = self._full_blocks.get()
+            if item is None:
+                return
+            block, n_rows = item
+            try:
+                if self._error is None:
+                    self._output_wr.writerows(block[:n_rows].tolist())
+                    if self._flush_blocks:
+                        self._outputf.flush()
+            except Exception as err:
+                self._error = err
+            self._free_blocks.put(block)
+
+    def _check_error(self):
+        if self._error is not None:
+            raise IOError("Writing estimates failed: {}".format(self._error))
+
+    def _flush_block(self):
+        self._full_blocks.put((self._block, self._n_rows))
+        self._block = self._free_blocks.get()
+        self._n_rows = 0
+
+    def write_row(self, time, state, speeds):
+        """
+        :param time: time of the estimate
+        :param state: estimator state vector
+        :param speeds: speed of each segment
+        """
+        self._check_error()
+        row = self._block[self._n_rows]
+        row[0] = time
+        row[self._part_ends[0]:self._part_ends[1]] = state
+        row[self._part_ends[1]:self._part_ends[2]] = speeds
+        self._n_rows += 1
+        if self._n_rows == len(self._block):
+            self._flush_block()
+
+    def close(self, raise_error=True):
+        """
+        Write the remaining rows and close the file
+        :param raise_error: raise IOError if writing failed, otherwise only
+        log the error
+        """
+        if self._outputf.closed:
+            return
+        if self._n_rows > 0:
+            self._flush_block()
+        self._full_blocks.put(None)
+        self._thread.join()
+        self._outputf.close()
+        if raise_error:
+            self._check_error()
+        elif self._error is not None:
+            logging.getLogger("EstimateWriter").error(
+                "Writing estimates failed: {}".format(self._error))
@@ -0,0 +1,257 @@
+import os
+import json
+import time
+import shutil
+import logging
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from proc import cabdata
+from proc import colstore
+
+partitions_dirname = "cab_traces_parts"
+chunks_dirname = "chunks"
+manifest_fname = "partitions.json"
+default_partition_len = 86400  # seconds of traces in each partition
+default_batch_rows = 2000000  # max number of trace file rows read at once when splitting
+
+
+def partition_name(key):
+    return "part_{:06d}".format(key)
+
+
+def partition_keys(times, partition_len):
+    """
+    :return: array of key of the partition of each time. Partition k holds
+    times k * partition_len to (k + 1) * partition_len - 1
+    """
+    return np.floor_divide(times, partition_len)
+
+
+def read_manifest(dirname):
+    """
+    :return: dict of the partitions manifest of the cab data in dirname, or
+    None if there is none
+    """
+    fname = os.path.join(dirname, partitions_dirname, manifest_fname)
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'r') as fin:
+        return json.load(fin)
+
+
+def partitions_exist(dirname, partition_len):
+    manifest = read_manifest(dirname)
+    return manifest is not None and manifest['partition_len'] == partition_len
+
+
+def split_cabtraces(dirname, parts_dir, partition_len, n_workers=1, batch_rows=default_batch_rows):
+    """
+    Read the trace files of dirname in batches of cabs, in order of cab id,
+    and save the rows of each batch that fall in each partition as a chunk of
+    that partition. Only one batch is in memory at a time
+    :param n_workers: number of threads reading trace files
+    :param batch_rows: number of rows of cab list updates after which a batch ends
+    :return: tuple (sorted array of keys of partitions with rows, Index of
+    all cab ids)
+    """
+    cab_list = cabdata.read_cab_list(os.path.join(dirname, "_cabs.txt"))
+    cab_list = cab_list.sort_values('id', kind='mergesort')
+    cab_ids = pd.Index(cab_list['id'].values)
+    batch_nums = np.cumsum(cab_list['updates'].values) // batch_rows
+    keys = set()
+
+    def read_trace(cab_id):
+        return cabdata.read_cabtrace_file(os.path.join(dirname, "new_{}.txt".format(cab_id)))
+
+    with ThreadPoolExecutor(max_workers=max(n_workers, 1)) as pool:
+        for batch_num in np.unique(batch_nums):
+            batch_cab_ids = cab_ids[batch_nums == batch_num]
+            traces = list(pool.map(read_trace, batch_cab_ids))
+            batch = pd.DataFrame({col: cabdata.to_compact(col, np.concatenate(
+                                      [trace[col].values for trace in traces]))
+                                  for col in cabdata.trace_file_cols},
+                                 columns=cabdata.trace_file_cols)
+            n_rows = [len(trace.index) for trace in traces]
+            batch['cab_id'] = pd.Categorical.from_codes(
+                np.repeat(cab_ids.get_indexer(batch_cab_ids), n_rows), cab_ids)
+            del traces
+            batch_keys = partition_keys(batch['time'].values, partition_len)
+            for key in np.unique(batch_keys):
+                chunk_dir = os.path.join(parts_dir, chunks_dirname, partition_name(key),
+                                         "batch_{:06d}".format(batch_num))
+                colstore.save_frame(chunk_dir, batch[batch_keys == key].reset_index(drop=True))
+                keys.add(int(key))
+    return np.array(sorted(keys), dtype=np.int64), cab_ids
+
+
+def build_partition(part_dir, chunk_dir, road_section, prev_fixes, dist_thresh, angle_thresh,
+                    time_lims=None, dtime_max=90):
+    """
+    Gather the chunks of a partition, calculate its x, y, deltas and road
+    segments and save it as a CabData save in part_dir
+    :param prev_fixes: tuple of arrays (times, xs, ys) of the last fix of each
+    cab in earlier partitions, as from CabData.last_fixes, or None for the
+    first partition
+    :return: CabData of the partition
+    """
+    chunk_fnames = sorted(os.listdir(chunk_dir))
+    chunks = [colstore.ColumnStore(os.path.join(chunk_dir, fname), mmap=False).to_frame()
+              for fname in chunk_fnames]
+    cab_traces = pd.concat(chunks, ignore_index=True)
+    del chunks
+    cab_ids = cab_traces['cab_id'].cat.categories
+    n_rows = np.bincount(cab_traces['cab_id'].cat.codes.values, minlength=len(cab_ids))
+    os.makedirs(part_dir, exist_ok=True)
+    cabdata.write_cab_list(os.path.join(part_dir, "_cabs.txt"), cab_ids[n_rows > 0],
+                           n_rows[n_rows > 0])
+    cab_data = cabdata.CabData(part_dir, cab_traces=cab_traces)
+    cab_data.calc_xy(*road_section.center)
+    cab_data.calc_deltas(dtime_max, prev_fixes)
+    cab_data.assign_road_segments(road_section, dist_thresh, angle_thresh, time_lims)
+    cab_data.save_cabtraces()
+    shutil.rmtree(chunk_dir)
+    return cab_data
+
+
+def build_partitions(dirname, road_section, partition_len=default_partition_len, n_workers=1,
+                     dist_thresh=11.0, angle_thresh=np.deg2rad(30.0), time_lims=None,
+                     dtime_max=90, batch_rows=default_batch_rows):
+    """
+    Split the cab traces of dirname into partitions of partition_len seconds,
+    then process the partitions in order of time. The deltas of the first
+    fix of each cab in a partition are calculated from the last fix of the
+    cab in earlier partitions, so only that one fix per cab is carried over
+    and the result equals that of a single CabData
+    :param time_lims: tuple (start, end) between which to assign segments, or
+    None for all times
+    """
+    logger = logging.getLogger("PartitionedCabData")
+    start_time = time.time()
+    parts_dir = os.path.join(dirname, partitions_dirname)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    keys, cab_ids = split_cabtraces(dirname, parts_dir, partition_len, n_workers, batch_rows)
+    partitions = []
+    prev_fixes = None
+    for key in keys:
+        cab_data = build_partition(os.path.join(parts_dir, partition_name(key)),
+                                   os.path.join(parts_dir, chunks_dirname, partition_name(key)),
+                                   road_section, prev_fixes, dist_thresh, angle_thresh,
+                                   time_lims, dtime_max)
+        last_fixes = cab_data.last_fixes()
+        if prev_fixes is not None:
+            has_rows = np.invert(np.isnan(last_fixes[0]))
+            last_fixes = tuple(np.where(has_rows, last, prev)
+                               for last, prev in zip(last_fixes, prev_fixes))
+        prev_fixes = last_fixes
+        partitions.append({'key': int(key), 'name': partition_name(key),
+                           'n_rows': cab_data.n_rows()})
+        logger.info("Partition {} of {}: {} rows".format(len(partitions), len(keys),
+                                                         cab_data.n_rows()))
+        del cab_data
+    shutil.rmtree(os.path.join(parts_dir, chunks_dirname), ignore_errors=True)
+    manifest = {'partition_len': partition_len, 'partitions': partitions,
+                'xy_center': list(road_section.center), 'saved_at': time.time()}
+    os.makedirs(parts_dir, exist_ok=True)
+    with open(os.path.join(parts_dir, manifest_fname), 'w') as fout:
+        json.dump(manifest, fout, indent=1)
+    logger.info("Built {} partitions of {} cabs in {:.2f} s".format(
+        len(partitions), len(cab_ids), time.time() - start_time))
+
+
+class PartitionedCabData(object):
+    """
+    Cab traces saved by build_partitions, one CabData save per partition of
+    time. Partitions are loaded when a time window first needs them, and only
+    the max_loaded most recently used stay loaded, so memory use is bounded by
+    the partition length instead of the length of the data set. Provides
+    calc_avg_segment_speeds like CabData
+    """
+    def __init__(self, dirname, columns=None, max_loaded=2):
+        """
+        :param dirname: path to cabspotting data with partitions built by build_partitions
+        :param columns: columns of cab_traces to load from each partition, or None for all
+        :param max_loaded: max number of partitions kept loaded
+        """
+        self.logger = logging.getLogger("PartitionedCabData")
+        manifest = read_manifest(dirname)
+        if manifest is None:
+            raise ValueError("{}: cab traces are not partitioned".format(dirname))
+        self.parts_dir = os.path.join(dirname, partitions_dirname)
+        self.save_dir = self.parts_dir
+        self.saved_at = manifest['saved_at']
+        self.partition_len = manifest['partition_len']
+        self.partitions = pd.DataFrame(manifest['partitions'], columns=['key', 'name', 'n_rows'])
+        self._columns = columns
+        self.max_loaded = max_loaded
+        self._loaded = OrderedDict()
+
+    def n_rows(self):
+        return int(self.partitions['n_rows'].sum())
+
+    def delta_data_exists(self):
+        return True
+
+    def partition(self, key):
+        """
+        :return: CabData of the partition of key, loaded if not yet
+        """
+        if key in self._loaded:
+            self._loaded.move_to_end(key)
+            return self._loaded[key]
+        if len(self._loaded) >= self.max_loaded:
+            self._loaded.popitem(last=False)
+        name = self.partitions['name'].values[np.flatnonzero(self.partitions['key'].values == key)[0]]
+        cab_data = cabdata.CabData(os.path.join(self.parts_dir, name), columns=self._columns)
+        self._loaded[key] = cab_data
+        return cab_data
+
+    def partitions_in_time_window(self, time_lims):
+        """
+        :param time_lims: tuple (start, end) of times, both inclusive
+        :return: array of keys of partitions with rows within time_lims, in order of time
+        """
+        keys = self.partitions['key'].values
+        first, last = partition_keys(np.asarray(time_lims), self.partition_len)
+        return keys[(keys >= first) & (keys <= last)]
+
+    def columns_in_time_window(self, time_lims, columns):
+        """
+        :param time_lims: tuple (start, end) of times, both inclusive
+        :param columns: names of columns
+        :return: dict of column name to array of values of the rows with time
+        within time_lims, in order of increasing time
+        """
+        pieces = [self.partition(key).columns_in_time_window(time_lims, columns)
+                  for key in self.partitions_in_time_window(time_lims)]
+        return {col: (np.concatenate([piece[col] for piece in pieces]) if pieces
+                      else np.empty(0, dtype=cabdata.compact_dtypes.get(col, object)))
+                for col in columns}
+
+    def iter_columns(self, columns):
+        """
+        :param columns: names of columns
+        :return: iterator of dicts of column name to array of values of
+        consecutive rows in order of time, one per partition
+        """
+        for key in self.partitions['key'].values:
+            start = key * self.partition_len
+            yield self.partition(key).columns_in_time_window(
+                (start, start + self.partition_len - 1), columns)
+
+    def calc_avg_segment_speeds(self, segments, time_lims):
+        """
+        :param segments: segments of the RoadSection that was assigned
+        :param time_lims: tuple (start, end) of times, both inclusive, or None
+        for all times, which reads the rows of every partition at once
+        :return: Series of mean speed of each segment with assigned rows,
+        indexed by segment
+        """
+        if time_lims is None and len(self.partitions.index) > 0:
+            keys = self.partitions['key'].values
+            time_lims = (keys.min() * self.partition_len, (keys.max() + 1) * self.partition_len - 1)
+        values = self.columns_in_time_window(time_lims if time_lims is not None else (0, -1),
+                                             ['segment', 'speed'])
+        return cabdata.avg_segment_speeds(values['segment'], values['speed'])
@@ -4,12 +4,67 @@ import pandas as pd
 from proc import gps
 from proc import detectors
 
+segment_grid_buffer = 25.0  # default distance from segments covered by the segment grid, in meters
+
+
+def calc_densities(flows, speeds):
+    """
+    :return: flows / speeds, with 0 density where speed is 0 or unknown
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        densities = np.where(speeds == 0.0, np.nan, flows) / speeds
+    densities[np.isnan(densities)] = 0.0
+    return densities
+
+
+class DetectorMeas(object):
+    """
+    Flows, speeds and densities of a section's detectors at regularly spaced
+    times, as (time step x detector) matrices
+    """
+    def __init__(self, start_time, timestep, point_idxs, flows, speeds):
+        """
+        :param start_time: time of the first row
+        :param timestep: time between rows, in seconds
+        :param point_idxs: idxs of the section points of the detectors, one per column
+        :param flows: (n_times, n_detectors) matrix of flows
+        :param speeds: (n_times, n_detectors) matrix of speeds
+        """
+        self.start_time = start_time
+        self.timestep = timestep
+        self.point_idxs = point_idxs
+        self.flows = flows
+        self.speeds = speeds
+        self.densities = calc_densities(flows, speeds)
+
+    def time_idx(self, time):
+        """
+        :return: row of time, or None if time is not one of the rows' times
+        """
+        time_idx, remainder = divmod(time - self.start_time, self.timestep)
+        if remainder != 0 or time_idx < 0 or time_idx >= len(self.flows):
+            return None
+        return int(time_idx)
+
+    def densities_at(self, time_idx):
+        """
+        :return: Series of densities of row time_idx, indexed by section point idx
+        """
+        return pd.Series(self.densities[time_idx], index=self.point_idxs)
+
 
 class RoadSection(object):
-    def __init__(self, fname, vds_dir):
+    def __init__(self, fname, vds_dir, detector_cache_dir=None):
+        """
+        :param fname: path of the road section CSV
+        :param vds_dir: directory of the section's detector data, or None to
+        not load detector data
+        :param detector_cache_dir: directory of the detectors' binary caches,
+        default is vds_dir
+        """
         self.section = pd.read_csv(fname)
         self._process_data()
-        self._read_detectors(vds_dir)
+        self._read_detectors(vds_dir, detector_cache_dir)
 
     def _calc_xy(self):
         self.section['x'] = gps.long_to_x(self.section['long'], *self.center)
@@ -43,25 +98,45 @@ class RoadSection(object):
         self.segments['ramp'] = self._form_ramp_col()
         self.n_ramps = np.sum(self.segments['ramp'] != 'none')
 
+    def _calc_segment_arrays(self):
+        # plain arrays of segment geometry for vectorized distance calculations
+        self.seg_starts = self.segments['start'][['x', 'y']].values
+        self.seg_vecs = (self.segments['end'] - self.segments['start'])[['x', 'y']].values
+        self.seg_len_sqrs = np.sum(np.square(self.seg_vecs), 1)
+        self.seg_angles = self.segments['angle'].values
+
+    def get_segment_grid(self, dist_thresh):
+        """
+        :param dist_thresh: max point-to-segment distance of interest
+        :return: SegmentGrid of this section covering at least dist_thresh
+        """
+        if dist_thresh > self.segment_grid.buffer:
+            self.segment_grid = gps.SegmentGrid(self.seg_starts, self.seg_vecs, dist_thresh)
+        return self.segment_grid
+
     def _process_data(self):
         self.center = np.mean(self.section[['lat', 'long']])
         self.extents = gps.Extents(self.section[['lat', 'long']], 0.0005, 0.0005)
         self._calc_xy()
         self._calc_segments()
         self._calc_segment_props()
+        self._calc_segment_arrays()
+        self.segment_grid = gps.SegmentGrid(self.seg_starts, self.seg_vecs, segment_grid_buffer)
         self.approx_len = self._calc_approx_len()
 
     @classmethod
-    def _read_detector_from_row(cls, row, dirname):
-        return detectors.read_detector_if_exists(row['vds_id'], dirname)
-
-    @classmethod
-    def _get_detector_val_from_row(cls, row, col, time):
-        return row['vds_data'].calc_val_at_time(col, time)
+    def _read_detector_from_row(cls, row, dirname, cache_dir=None):
+        return detectors.read_detector_if_exists(row['vds_id'], dirname, cache_dir)
 
-    def _read_detectors(self, dirname):
+    def _read_detectors(self, dirname, cache_dir=None):
+        if dirname is None:
+            # detector samples come from elsewhere, e.g. a live feed
+            self.section['vds_data'] = None
+            self.detector_point_idxs = self.section.index[self.section['vds_id'].notnull()]
+            return
         self.section['vds_data'] = self.section.apply(RoadSection._read_detector_from_row,
-                                                      axis=1, args=[dirname])
+                                                      axis=1, args=[dirname, cache_dir])
+        self.detector_point_idxs = self.section.index[self.section['vds_data'].notnull()]
 
     def get_ramp_indexes(self):
         return self.segments['ramp'].index[self.segments['ramp'] != 'none']
@@ -107,12 +182,104 @@ class RoadSection(object):
             pt_projs = starts + line_vec.multiply(pt_proj_dists, axis=0)
             return np.sqrt(gps.dist_sqr(point, pt_projs))
 
+    def calc_detector_meas(self, start_time, end_time, timestep):
+        """
+        Precompute measurements of all detectors of the section
+        :param start_time: first time, in unix time
+        :param end_time: last time (inclusive if on the time grid)
+        :param timestep: time between measurements, in seconds
+        :return: DetectorMeas at times start_time + k * timestep up to end_time
+        """
+        times = np.arange(start_time, end_time + 1, timestep)
+        detectors = self.section['vds_data'][self.detector_point_idxs]
+        flows = np.empty((len(times), len(detectors)))
+        speeds = np.empty((len(times), len(detectors)))
+        for det_idx, detector in enumerate(detectors):
+            flows[:, det_idx] = detector.calc_vals_at_times('flow', times)
+            speeds[:, det_idx] = detector.calc_vals_at_times('speed', times)
+        return DetectorMeas(start_time, timestep, np.array(self.detector_point_idxs), flows, speeds)
+
     def calc_density_meas_at_time(self, time):
-        points_with_dets = self.section[np.invert(np.equal(self.section['vds_data'], None))]
-        flows = points_with_dets.apply(RoadSection._get_detector_val_from_row,
-                                       axis=1, args=['flow', time])
-        speeds = points_with_dets.apply(RoadSection._get_detector_val_from_row,
-                                       axis=1, args=['speed', time])
-        speeds[speeds == 0.0] = np.nan
-        densities = flows / speeds
-        return densities.fillna(0.0)
+        """
+        :return: Series of densities measured by each detector at time,
+        indexed by section point idx
+        """
+        return self.calc_detector_meas(time, time, 1).densities_at(0)
+
+
+class SectionSet(object):
+    """
+    Road sections in one x, y frame, with a combined segment grid over the
+    segments of all of them, so that cab traces are assigned to every
+    section in a single pass. Segments are numbered across sections in order
+    of section and of segment within the section; seg_sections and seg_idxs
+    map them back. Provides the segment arrays and get_segment_grid of
+    RoadSection
+    """
+    def __init__(self, road_sections, center, names=None):
+        """
+        :param road_sections: list of RoadSection
+        :param center: lat, long center of the x, y of the cab traces to assign
+        :param names: list of a unique name of each section, e.g. of its CSV,
+        identifying it across saves of assignments. Default is its position
+        """
+        self.road_sections = list(road_sections)
+        self.center = tuple(center)
+        if names is None:
+            names = [str(i) for i in range(len(self.road_sections))]
+        if len(names) != len(self.road_sections) or len(set(names)) != len(names):
+            raise ValueError("Sections need one unique name each")
+        self.names = list(names)
+        self._calc_segment_arrays()
+
+    def _calc_segment_arrays(self):
+        starts = []
+        vecs = []
+        for road_section in self.road_sections:
+            # in the frame of the cab traces instead of that of the section
+            xy = np.column_stack((gps.long_to_x(road_section.section['long'].values, *self.center),
+                                  gps.lat_to_y(road_section.section['lat'].values, self.center[0])))
+            starts.append(xy[:-1])
+            vecs.append(xy[1:] - xy[:-1])
+        n_segments = [len(section_starts) for section_starts in starts]
+        self.seg_offsets = np.append(0, np.cumsum(n_segments))
+        self.seg_sections = np.repeat(np.arange(len(n_segments)), n_segments)
+        self.seg_idxs = np.arange(self.seg_offsets[-1]) - self.seg_offsets[self.seg_sections]
+        self.seg_starts = np.concatenate(starts) if starts else np.empty((0, 2))
+        self.seg_vecs = np.concatenate(vecs) if vecs else np.empty((0, 2))
+        self.seg_len_sqrs = np.sum(np.square(self.seg_vecs), 1)
+        self.seg_angles = np.arctan2(self.seg_vecs[:, 1], self.seg_vecs[:, 0])
+        self.segment_grid = None
+
+    def __len__(self):
+        return len(self.road_sections)
+
+    def add_section(self, road_section, name=None):
+        """
+        :return: position of the added section
+        """
+        name = str(len(self.names)) if name is None else name
+        if name in self.names:
+            raise ValueError("Section name {} is not unique".format(name))
+        self.road_sections.append(road_section)
+        self.names.append(name)
+        self._calc_segment_arrays()
+        return len(self.road_sections) - 1
+
+    def subset(self, positions):
+        """
+        :return: SectionSet of the sections at positions, in that order
+        """
+        return SectionSet([self.road_sections[pos] for pos in positions], self.center,
+                          [self.names[pos] for pos in positions])
+
+    def get_segment_grid(self, dist_thresh):
+        """
+        :param dist_thresh: max point-to-segment distance of interest
+        :return: SegmentGrid of the segments of all sections covering at
+        least dist_thresh
+        """
+        if self.segment_grid is None or dist_thresh > self.segment_grid.buffer:
+            self.segment_grid = gps.SegmentGrid(self.seg_starts, self.seg_vecs,
+                                                max(dist_thresh, segment_grid_buffer))
+        return self.segment_grid
@@ -0,0 +1,150 @@
+import os
+import time
+import logging
+import numpy as np
+import pandas as pd
+
+from proc import colstore
+
+cube_cols = ['bin', 'segment', 'speed_sum', 'n_rows', 'n_speeds']
+segment_key_mult = 2**16  # greater than any segment idx, see gps.segment_dtype
+
+
+def cube_dirname(dirname, timestep, phase):
+    return os.path.join(dirname, "speed_cube_{}_{}.cols".format(timestep, phase))
+
+
+def estimator_phase(start_time, timestep):
+    """
+    :return: phase of the bins that are the windows of cab data of a
+    RoadStateEstimator starting at start_time
+    """
+    return (start_time + 1) % timestep
+
+
+def _aggregate_rows(bins, segments, speeds):
+    """
+    :return: dict of cube arrays of rows with bins and segments in order of time
+    """
+    keys = bins * segment_key_mult + segments
+    keys, inverse = np.unique(keys, return_inverse=True)
+    valid = np.invert(np.isnan(speeds))
+    # bincount adds the rows of each key in order, so sums round as in
+    # avg_segment_speeds of the rows of a single bin
+    return {'bin': keys // segment_key_mult, 'segment': keys % segment_key_mult,
+            'speed_sum': np.bincount(inverse[valid], weights=speeds[valid], minlength=len(keys)),
+            'n_rows': np.bincount(inverse, minlength=len(keys)),
+            'n_speeds': np.bincount(inverse[valid], minlength=len(keys))}
+
+
+def aggregate(column_chunks, timestep, phase):
+    """
+    Sum and count the speeds of assigned rows per segment and time bin, in
+    one pass over the rows
+    :param column_chunks: iterable of dicts of arrays 'time', 'segment' and
+    'speed' of consecutive rows in order of time, as from iter_columns of
+    CabData or PartitionedCabData
+    :return: dict of cube arrays, sorted by bin and segment
+    """
+    pieces = []
+    held = None
+    for chunk in column_chunks:
+        on_road = chunk['segment'] >= 0
+        chunk = {col: chunk[col][on_road] for col in ['time', 'segment', 'speed']}
+        if held is not None:
+            chunk = {col: np.concatenate((held[col], chunk[col])) for col in chunk}
+        bins = (chunk['time'].astype(np.int64) - phase) // timestep
+        # rows of the last bin may continue in the next chunk
+        n_done = np.searchsorted(bins, bins[-1], side='left') if len(bins) > 0 else 0
+        held = {col: values[n_done:] for col, values in chunk.items()}
+        pieces.append(_aggregate_rows(bins[:n_done], chunk['segment'][:n_done].astype(np.int64),
+                                      chunk['speed'][:n_done]))
+    if held is not None:
+        pieces.append(_aggregate_rows((held['time'].astype(np.int64) - phase) // timestep,
+                                      held['segment'].astype(np.int64), held['speed']))
+    if not pieces:
+        return {col: np.empty(0, dtype=np.float64 if col == 'speed_sum' else np.int64)
+                for col in cube_cols}
+    return {col: np.concatenate([piece[col] for piece in pieces]) for col in cube_cols}
+
+
+class SpeedCube(object):
+    """
+    Sums and counts of the speeds of cab fixes assigned to road segments, per
+    segment and time bin of timestep seconds. Bin k holds times
+    k * timestep + phase to (k + 1) * timestep + phase - 1. Stored sparsely,
+    as one row per (bin, segment) with assigned fixes, sorted by bin and
+    segment. Provides calc_avg_segment_speeds like CabData: windows that are
+    a bin read one slice of the cube, others are passed on to cab_data
+    """
+    def __init__(self, timestep, phase, cube, cab_data=None):
+        """
+        :param cube: dict or ColumnStore of the arrays of cube_cols
+        :param cab_data: CabData or PartitionedCabData the cube was built
+        from, used for windows that are not a bin. None to raise ValueError
+        for them instead
+        """
+        self.timestep = timestep
+        self.phase = phase
+        self._cube = {col: (cube[col] if isinstance(cube, dict) else cube.array(col))
+                      for col in cube_cols}
+        self.bins = self._cube['bin']
+        self.cab_data = cab_data
+
+    @classmethod
+    def build(cls, cab_data, timestep, phase):
+        return cls(timestep, phase, aggregate(cab_data.iter_columns(['time', 'segment', 'speed']),
+                                              timestep, phase), cab_data)
+
+    def save(self, fname, meta=None):
+        colstore.save_frame(fname, pd.DataFrame(self._cube, columns=cube_cols),
+                            meta=dict(meta or {}, timestep=self.timestep, phase=self.phase))
+
+    def covers(self, time_lims):
+        """
+        :return: True if the window time_lims, both inclusive, is a bin
+        """
+        return (time_lims is not None and time_lims[1] - time_lims[0] + 1 == self.timestep and
+                (time_lims[0] - self.phase) % self.timestep == 0)
+
+    def calc_avg_segment_speeds(self, segments, time_lims):
+        """
+        :param segments: segments of the RoadSection that was assigned
+        :param time_lims: tuple (start, end) of times, both inclusive, or None
+        for all times
+        :return: Series of mean speed of each segment with assigned rows,
+        indexed by segment
+        """
+        if not self.covers(time_lims):
+            if self.cab_data is None:
+                raise ValueError("Time window {} is not a bin of the speed cube".format(time_lims))
+            return self.cab_data.calc_avg_segment_speeds(segments, time_lims)
+        time_bin = (time_lims[0] - self.phase) // self.timestep
+        start = np.searchsorted(self.bins, time_bin, side='left')
+        end = np.searchsorted(self.bins, time_bin, side='right')
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_speeds = self._cube['speed_sum'][start:end] / self._cube['n_speeds'][start:end]
+        return pd.Series(mean_speeds, name='speed',
+                         index=pd.Index(self._cube['segment'][start:end], name='segment'))
+
+
+def load_or_build(cab_data, timestep, phase):
+    """
+    :param cab_data: CabData or PartitionedCabData with segments and speeds
+    :return: SpeedCube of cab_data, memory-mapped from its save if that was
+    built from the same save of the traces, otherwise aggregated and, if the
+    traces are saved, saved next to them
+    """
+    logger = logging.getLogger("SpeedCube")
+    fname = cube_dirname(cab_data.save_dir, timestep, phase)
+    if cab_data.saved_at is not None and colstore.store_exists(fname):
+        store = colstore.ColumnStore(fname)
+        if store.meta.get('traces_saved_at') == cab_data.saved_at:
+            return SpeedCube(timestep, phase, store, cab_data)
+    start_time = time.time()
+    cube = SpeedCube.build(cab_data, timestep, phase)
+    logger.info("Aggregated {} segment bins in {:.2f} s".format(len(cube.bins),
+                                                                time.time() - start_time))
+    if cab_data.saved_at is not None:
+        cube.save(fname, meta={'traces_saved_at': cab_data.saved_at})
+    return cube
@@ -0,0 +1,71 @@
+import argparse
+import logging
+
+
+def add_args(args_parser):
+    args_parser.add_argument('datadir', help="Path to cabspottingdata")
+    args_parser.add_argument('road', help="Path to road section CSV")
+    args_parser.add_argument('outputdir', help="Path to directory where frames will be saved")
+    args_parser.add_argument('--start', type=int, required=True, help="Time of the first frame")
+    args_parser.add_argument('--end', type=int, required=True, help="Latest time of a frame")
+    args_parser.add_argument('--step', type=int, default=10, help="Seconds between frames")
+    args_parser.add_argument('--window', type=int, default=60,
+                             help="Seconds of cab positions shown in each frame")
+    args_parser.add_argument('--jobs', type=int, default=1,
+                             help="Number of processes rendering frames")
+    args_parser.add_argument('--workers', type=int, default=1,
+                             help="Number of threads reading cab trace files")
+    args_parser.add_argument('--partition-len', type=int, default=None, metavar='SECONDS',
+                             help="Split cab traces into partitions of this many seconds, "
+                                  "as in main.py")
+    args_parser.add_argument('--tile-cache', default="tiles",
+                             help="Directory where map tiles are cached")
+    args_parser.add_argument('--tile-dir', default=None,
+                             help="Local tile directory, in zoom/x/y.png layout, copied into the cache")
+    args_parser.add_argument('--offline', action='store_true',
+                             help="Never download tiles; tiles missing from the cache render blank")
+    args_parser.add_argument('--zoom', type=int, default=17, help="Zoom level of map tiles")
+    args_parser.add_argument('--size', type=float, default=8.0, help="Frame size, in inches")
+    args_parser.add_argument('--dpi', type=int, default=100, help="Frame resolution")
+
+
+def args_setup():
+    args_parser = argparse.ArgumentParser(
+        description="Render frames of cab movement over a map, for a range of times")
+    add_args(args_parser)
+    return args_parser.parse_args()
+
+
+def run(args):
+    import numpy as np
+    import pandas as pd
+    import matplotlib
+    # set before pyplot is first imported, so frames render without a display
+    matplotlib.use('Agg')
+    import proc.road
+    import vis.core
+    import vis.tiles
+    from main import process_cab_data
+    road_section = proc.road.RoadSection(args.road, None)
+    cab_data = process_cab_data(args, road_section)
+    window = (args.start - args.window + 1, args.end)
+    cab_traces = pd.DataFrame(cab_data.columns_in_time_window(window, vis.core.frame_cols),
+                              columns=vis.core.frame_cols)
+    tile_cache = vis.tiles.TileCache(args.tile_cache, args.offline)
+    if args.tile_dir is not None:
+        tile_cache.populate(args.tile_dir)
+    map_plotter = vis.core.MapPlotter(cab_traces, road_section.extents, tile_cache, args.zoom)
+    logging.getLogger("render").info("Map rendered from {} cached and {} missing tiles".format(
+        tile_cache.n_hits, tile_cache.n_misses))
+    map_plotter.render_frames(np.arange(args.start, args.end + 1, args.step), args.window,
+                              args.outputdir, args.jobs, (args.size, args.size), args.dpi)
+
+
+def main():
+    args = args_setup()
+    logging.basicConfig(level=logging.INFO)
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
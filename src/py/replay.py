@@ -0,0 +1,185 @@
+import argparse
+import os
+import sys
+import glob
+import asyncio
+import logging
+import numpy as np
+import pandas as pd
+import pytz
+
+import proc.cabdata
+import proc.detectors
+
+drain_interval = 1000  # lines written between waits for the reader to catch up
+
+
+def args_setup():
+    args_parser = argparse.ArgumentParser(
+        description="Replay cabspotting traces and PeMS detector data as a live feed, in "
+                    "the line format read by online.py")
+    args_parser.add_argument('datadir', help="Path to cabspottingdata")
+    args_parser.add_argument('vdsdir', help="Path to directory containing stationary detector data")
+    args_parser.add_argument('--road', help="Path to road section CSV; only its detectors are "
+                                            "replayed. Default is all detectors in vdsdir")
+    args_parser.add_argument('--speed', type=float, default=1.0,
+                             help="Replay speed as a multiple of real time; 0 for no pacing")
+    args_parser.add_argument('--start', type=int, default=None, help="First unix time replayed")
+    args_parser.add_argument('--end', type=int, default=None, help="Last unix time replayed")
+    args_parser.add_argument('--tick', type=int, default=5,
+                             help="Seconds of feed time between tick lines")
+    args_parser.add_argument('--listen', metavar='HOST:PORT',
+                             help="Serve the feed to the first client connecting over TCP")
+    args_parser.add_argument('--unix', metavar='PATH',
+                             help="Serve the feed to the first client connecting to a unix socket")
+    return args_parser.parse_args()
+
+
+def in_time_window(times, start, end):
+    in_window = np.full(len(times), True)
+    if start is not None:
+        in_window &= times >= start
+    if end is not None:
+        in_window &= times <= end
+    return in_window
+
+
+def cab_fix_lines(datadir, start, end):
+    """
+    :return: list of DataFrames of time and feed line of each cab fix, one per cab
+    """
+    with open(os.path.join(datadir, "_cabs.txt"), 'r') as fin:
+        cab_ids = [tag[0] for tag in proc.cabdata.cab_tag_re.findall(fin.read())]
+    frames = []
+    for cab_id in cab_ids:
+        trace = proc.cabdata.read_cabtrace_file(os.path.join(datadir, "new_{}.txt".format(cab_id)))
+        trace = trace[in_time_window(trace['time'].values, start, end)]
+        lines = ["gps {} {!r} {!r} {} {}\n".format(cab_id, lat, long, occupancy, time)
+                 for lat, long, occupancy, time in zip(trace['lat'], trace['long'],
+                                                       trace['occupancy'], trace['time'])]
+        frames.append(pd.DataFrame({'time': trace['time'].values, 'line': lines}))
+    return frames
+
+
+def detector_lines(vdsdir, vds_ids, start, end):
+    """
+    :return: list of DataFrames of time and feed line of each detector sample, one per detector
+    """
+    timezone = pytz.timezone('US/Pacific')
+    frames = []
+    for vds_id in vds_ids:
+        data = proc.detectors.read_pems_csv(
+            os.path.join(vdsdir, "pems_vds_{}.csv".format(vds_id)), timezone)
+        times = data['time'].values.astype(np.int64)
+        in_window = in_time_window(times, start, end)
+        lines = ["vds {} {} {!r} {!r}\n".format(vds_id, time, float(flow), float(speed))
+                 for time, flow, speed in zip(times[in_window], data['flow'][in_window],
+                                              data['speed'][in_window])]
+        frames.append(pd.DataFrame({'time': times[in_window], 'line': lines}))
+    return frames
+
+
+def road_vds_ids(road_fname):
+    vds_ids = pd.read_csv(road_fname)['vds_id']
+    return [int(vds_id) for vds_id in vds_ids[vds_ids.notnull()]]
+
+
+def all_vds_ids(vdsdir):
+    fnames = glob.glob(os.path.join(vdsdir, "pems_vds_*.csv"))
+    return sorted(int(os.path.basename(fname)[len("pems_vds_"):-len(".csv")]) for fname in fnames)
+
+
+def feed_events(args):
+    """
+    :return: tuple (array of times, list of lines) of all feed lines, in order of time
+    """
+    vds_ids = road_vds_ids(args.road) if args.road is not None else all_vds_ids(args.vdsdir)
+    frames = cab_fix_lines(args.datadir, args.start, args.end)
+    frames += detector_lines(args.vdsdir, vds_ids, args.start, args.end)
+    events = pd.concat(frames, ignore_index=True)
+    events = events.iloc[np.argsort(events['time'].values, kind='mergesort')]
+    if len(events.index) > 0 and args.tick > 0:
+        tick_times = np.arange(events['time'].values[0], events['time'].values[-1] + 1, args.tick)
+        ticks = pd.DataFrame({'time': tick_times,
+                              'line': ["tick {}\n".format(time) for time in tick_times]})
+        # ticks come after the data of their time
+        events = pd.concat([events, ticks], ignore_index=True)
+        events = events.iloc[np.argsort(events['time'].values, kind='mergesort')]
+    return events['time'].values, list(events['line'])
+
+
+async def replay(times, lines, write, drain, speed):
+    """
+    Write lines at speed times the pace of their times
+    :param write: function writing a line
+    :param drain: coroutine function waiting until written lines are consumed
+    """
+    loop = asyncio.get_event_loop()
+    wall_start = loop.time()
+    for line_num, (time, line) in enumerate(zip(times, lines)):
+        if speed > 0:
+            delay = wall_start + (time - times[0]) / speed - loop.time()
+            if delay > 0:
+                await drain()
+                await asyncio.sleep(delay)
+        write(line)
+        if line_num % drain_interval == 0:
+            await drain()
+    await drain()
+
+
+def replay_to_stdout(times, lines, speed):
+    async def drain():
+        sys.stdout.flush()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(replay(times, lines, sys.stdout.write, drain, speed))
+
+
+def serve_replay(times, lines, speed, listen=None, unix_path=None):
+    """
+    Serve the replay to the first client connecting to the TCP address
+    listen or to the unix socket unix_path
+    """
+    logger = logging.getLogger("replay")
+    loop = asyncio.get_event_loop()
+    done = loop.create_future()
+
+    async def handle_client(reader, writer):
+        if done.done():
+            writer.close()
+            return
+        logger.info("Client connected, replaying {} lines".format(len(lines)))
+        try:
+            await replay(times, lines, lambda line: writer.write(line.encode()), writer.drain,
+                         speed)
+        except ConnectionError as err:
+            logger.warning("Client disconnected: {}".format(err))
+        finally:
+            writer.close()
+            if not done.done():
+                done.set_result(None)
+
+    if unix_path is not None:
+        server = loop.run_until_complete(asyncio.start_unix_server(handle_client, path=unix_path))
+    else:
+        host, port = listen.rsplit(':', 1)
+        server = loop.run_until_complete(asyncio.start_server(handle_client, host, int(port)))
+    logger.info("Waiting for a client")
+    loop.run_until_complete(done)
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+
+
+def main():
+    args = args_setup()
+    logging.basicConfig(level=logging.INFO)
+    times, lines = feed_events(args)
+    if args.listen is not None or args.unix is not None:
+        serve_replay(times, lines, args.speed, args.listen, args.unix)
+    else:
+        replay_to_stdout(times, lines, args.speed)
+
+
+if __name__ == "__main__":
+    main()
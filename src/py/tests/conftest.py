@@ -0,0 +1,41 @@
+import os
+import sys
+import pytest
+
+# modules are imported as in the scripts, relative to src/py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench.synthdata
+import proc.road
+
+
+@pytest.fixture(scope='session')
+def synth_paths(tmp_path_factory):
+    """
+    Paths of a small synthetic data set, as from bench.synthdata.generate
+    """
+    return bench.synthdata.generate(str(tmp_path_factory.mktemp('synth')), 8, 1500)
+
+
+@pytest.fixture
+def road_section(synth_paths):
+    return proc.road.RoadSection(synth_paths['road'], None)
+
+
+@pytest.fixture
+def cab_data(synth_paths, road_section, tmp_path):
+    """
+    CabData of a copy of the synthetic traces, with x, y, deltas and road
+    segments, not saved
+    """
+    import shutil
+    import numpy as np
+    import proc.cabdata
+    datadir = str(tmp_path / 'cabs')
+    shutil.copytree(synth_paths['datadir'], datadir,
+                    ignore=shutil.ignore_patterns('*.cols', '*.pickle'))
+    cab_data = proc.cabdata.CabData(datadir)
+    cab_data.calc_xy(*road_section.center)
+    cab_data.calc_deltas()
+    cab_data.assign_road_segments(road_section, 11.0, np.deg2rad(30.0))
+    return cab_data
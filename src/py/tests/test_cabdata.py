@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import bench.synthdata
+
+
+def time_windows(cab_data, n_windows, length, seed=0):
+    rng = np.random.RandomState(seed)
+    times = cab_data.column('time')
+    starts = rng.randint(times.min() - length, times.max() + 1, n_windows)
+    return [(int(start), int(start) + length - 1) for start in starts]
+
+
+def reference_avg_segment_speeds(cab_traces, time_lims):
+    times = cab_traces['time'].values
+    in_window = np.logical_and(times >= time_lims[0], times <= time_lims[1])
+    segments = cab_traces['segment'].values[in_window]
+    speeds = cab_traces['speed'].values[in_window].astype(np.float64)
+    assigned = np.unique(segments[segments >= 0])
+    means = []
+    for segment in assigned:
+        seg_speeds = speeds[segments == segment]
+        seg_speeds = seg_speeds[np.invert(np.isnan(seg_speeds))]
+        means.append(np.mean(seg_speeds) if len(seg_speeds) > 0 else np.nan)
+    return pd.Series(means, index=assigned)
+
+
+def test_rows_in_time_window(cab_data):
+    times = cab_data.column('time')
+    for time_lims in time_windows(cab_data, 50, 600) + [(0, -1)]:
+        rows = cab_data.rows_in_time_window(time_lims)
+        expected = np.flatnonzero(np.logical_and(times >= time_lims[0], times <= time_lims[1]))
+        np.testing.assert_array_equal(np.sort(rows), expected)
+        assert np.all(np.diff(times[rows]) >= 0)
+
+
+def test_calc_avg_segment_speeds(cab_data):
+    n_assigned = 0
+    for time_lims in time_windows(cab_data, 200, 300):
+        speeds = cab_data.calc_avg_segment_speeds(None, time_lims)
+        expected = reference_avg_segment_speeds(cab_data.cab_traces, time_lims)
+        np.testing.assert_array_equal(speeds.index.values, expected.index.values)
+        np.testing.assert_allclose(speeds.values, expected.values, rtol=1e-12)
+        n_assigned += len(speeds.index)
+    assert n_assigned > 0
+
+
+def test_time_index_after_append(cab_data):
+    times = cab_data.column('time')
+    cab_data.rows_in_time_window((times.min(), times.max()))
+    new_time = int(times.max()) + 100
+    new_traces = pd.DataFrame({'lat': [bench.synthdata.default_center[0]],
+                               'long': [bench.synthdata.default_center[1]],
+                               'occupancy': [1], 'time': [new_time],
+                               'cab_id': [cab_data.cab_traces['cab_id'].values[0]]})
+    cab_data.append_cabtraces(new_traces)
+    rows = cab_data.rows_in_time_window((new_time, new_time))
+    np.testing.assert_array_equal(rows, [cab_data.n_rows() - 1])
+
+
+def reference_deltas(cab_traces, lat_center, long_center, dtime_max=90):
+    """
+    Deltas from float64 x and y, with a groupby over cabs as before compact
+    dtypes
+    """
+    import proc.gps
+    traces = pd.DataFrame({'cab_id': np.asarray(cab_traces['cab_id'].values),
+                           'time': cab_traces['time'].values.astype(np.int64),
+                           'x': proc.gps.long_to_x(cab_traces['long'].values, lat_center, long_center),
+                           'y': proc.gps.lat_to_y(cab_traces['lat'].values, lat_center)})
+    diffs = traces.groupby('cab_id', sort=False)[['time', 'x', 'y']].diff()
+    dtimes = diffs['time'].values.astype(np.float64)
+    dtimes[dtimes > dtime_max] = np.nan
+    vx = diffs['x'].values / dtimes
+    vy = diffs['y'].values / dtimes
+    speeds = np.sqrt(np.nan_to_num(vx) ** 2 + np.nan_to_num(vy) ** 2)
+    return vx, vy, speeds
+
+
+def test_to_compact_range():
+    import proc.cabdata
+    assert proc.cabdata.to_compact('occupancy', np.array([0, 1])).dtype == np.int8
+    assert proc.cabdata.to_compact('time', np.array([0, 2 ** 31 - 1])).dtype == np.int32
+    with pytest.raises(ValueError):
+        proc.cabdata.to_compact('time', np.array([0, 2 ** 31]))
+    with pytest.raises(ValueError):
+        proc.cabdata.to_compact('occupancy', np.array([-129]))
+    with pytest.raises(ValueError):
+        proc.cabdata.to_compact('segment', np.array([2 ** 15]))
+
+
+def test_compact_dtypes(cab_data):
+    import proc.cabdata
+    traces = cab_data.cab_traces
+    for col in traces.columns:
+        if col == 'cab_id':
+            assert isinstance(traces[col].dtype, pd.api.types.CategoricalDtype)
+        else:
+            assert traces[col].dtype == proc.cabdata.compact_dtypes[col], col
+    usage = cab_data.memory_usage()
+    assert usage.loc['total', 'bytes'] == usage['bytes'].drop('total').sum()
+    assert usage.loc['total', 'bytes_per_row'] < 60
+
+
+def test_compact_traces_from_float64(cab_data):
+    import proc.cabdata
+    traces = cab_data.cab_traces
+    wide = pd.DataFrame({col: traces[col].values.astype(np.float64) for col in ['time', 'occupancy', 'x']})
+    wide['segment'] = np.where(traces['segment'].values >= 0, traces['segment'].values, np.nan)
+    wide['cab_id'] = np.asarray(traces['cab_id'].values)
+    compact = proc.cabdata.compact_cab_traces(wide)
+    for col in ['time', 'occupancy', 'x', 'segment']:
+        assert compact[col].dtype == proc.cabdata.compact_dtypes[col]
+        np.testing.assert_array_equal(compact[col].values, traces[col].values)
+    assert isinstance(compact['cab_id'].dtype, pd.api.types.CategoricalDtype)
+
+
+def test_compact_deltas_equal_float64(cab_data, road_section):
+    traces = cab_data.cab_traces
+    vx, vy, speeds = reference_deltas(traces, *road_section.center)
+    np.testing.assert_array_equal(np.isnan(traces['vx'].values), np.isnan(vx))
+    np.testing.assert_allclose(traces['vx'].values, vx, rtol=1e-5, atol=1e-4)
+    np.testing.assert_allclose(traces['vy'].values, vy, rtol=1e-5, atol=1e-4)
+    np.testing.assert_allclose(traces['speed'].values, speeds, rtol=1e-5, atol=1e-4)
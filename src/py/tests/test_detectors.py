@@ -0,0 +1,37 @@
+import os
+import shutil
+import numpy as np
+
+from proc import colstore
+from proc import detectors
+
+
+def copy_vds(synth_paths, tmp_path):
+    vdsdir = str(tmp_path / 'vds')
+    shutil.copytree(synth_paths['vdsdir'], vdsdir, ignore=shutil.ignore_patterns('*.cols'))
+    vds_id = int(sorted(os.listdir(vdsdir))[0][len("pems_vds_"):-len(".csv")])
+    return vdsdir, vds_id
+
+
+def test_cache_in_cache_dir(synth_paths, tmp_path):
+    vdsdir, vds_id = copy_vds(synth_paths, tmp_path)
+    cache_dir = str(tmp_path / 'cache')
+    parsed = detectors.StatDetector(vdsdir, vds_id, cache_dir=cache_dir)
+    assert not any(fname.endswith('.cols') for fname in os.listdir(vdsdir))
+    cached = detectors.StatDetector(vdsdir, vds_id, cache_dir=cache_dir)
+    assert cached.data_from_cache() is not None
+    for col in ['time', 'flow', 'speed']:
+        np.testing.assert_array_equal(cached.data[col].values, parsed.data[col].values)
+
+
+def test_unwritable_cache(synth_paths, tmp_path, monkeypatch):
+    vdsdir, vds_id = copy_vds(synth_paths, tmp_path)
+
+    def save_frame(dirname, frame, meta=None):
+        raise PermissionError(13, "Permission denied", dirname)
+
+    monkeypatch.setattr(colstore, 'save_frame', save_frame)
+    detector = detectors.StatDetector(vdsdir, vds_id)
+    expected = detectors.StatDetector(vdsdir, vds_id, use_cache=False)
+    np.testing.assert_array_equal(detector.data['flow'].values, expected.data['flow'].values)
+    assert detector.data_from_cache() is None
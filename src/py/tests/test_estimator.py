@@ -0,0 +1,111 @@
+import numpy as np
+import pandas as pd
+
+import proc.road
+import proc.estimator
+from proc.estimator import RoadStateEstimator, BatchedRoadStateEstimator, RoadSpeedBuffer
+
+timestep = 5
+n_iterations = 240
+
+
+def ramp_variant(synth_paths, tmp_path):
+    """
+    :return: path of the synthetic road with its ramps at other segments
+    """
+    section = pd.read_csv(synth_paths['road'])
+    section['on_ramp'] = [0, 1, 0, 0, 1, 0, 0]
+    section['off_ramp'] = [0, 0, 0, 0, 0, 0, 1]
+    fname = str(tmp_path / 'road_variant.csv')
+    section.to_csv(fname, index=False)
+    return fname
+
+
+def make_estimators(road_sections, start_times):
+    return [RoadStateEstimator(road_section, timestep, start_time,
+                               start_time + timestep * n_iterations)
+            for road_section, start_time in zip(road_sections, start_times)]
+
+
+def reference_step_terms(estimator, cur_speeds):
+    """
+    :return: tuple (outlet terms, inlet terms, process noise variances) of
+    a step, calculated on Series as the estimator did before it used arrays
+    """
+    lengths = estimator.road_section.segments['length']
+    speeds = pd.Series(cur_speeds.copy())
+    speeds[np.isnan(speeds)] = pd.Series(proc.estimator.velocity_default)
+    outlet_terms = 1.0 - (estimator.timestep / lengths) * speeds
+    inlet_terms = estimator.timestep / lengths.loc[1:]
+    inlet_terms = inlet_terms.reset_index(drop=True) * speeds[:-1]
+    flow_add = np.zeros(estimator.n_segments)
+    filt = np.isnan(cur_speeds)
+    flow_add[filt] = estimator.timestep / lengths[filt] * proc.estimator.typ_segment_density
+    flow_add[filt] = np.square(flow_add[filt]) * pd.Series(proc.estimator.vel_var_default)[filt]
+    flow_add = np.append(flow_add, np.zeros(estimator.road_section.n_ramps))
+    return (np.array(outlet_terms), np.array(inlet_terms),
+            estimator._default_process_vars + flow_add)
+
+
+def test_step_terms_equal_reference(synth_paths, cab_data):
+    road_section = proc.road.RoadSection(synth_paths['road'], synth_paths['vdsdir'])
+    assert road_section.segments.index.size == len(proc.estimator.velocity_default)
+    start_time = (int(cab_data.column('time').min()) // 86400) * 86400 + 8 * 3600
+    estimator = make_estimators([road_section], [start_time])[0]
+    n_known = 0
+    for i in range(n_iterations):
+        step_terms = estimator.prepare_step(cab_data)
+        expected = reference_step_terms(estimator, estimator._cur_speeds)
+        np.testing.assert_array_equal(step_terms.outlet_terms, expected[0])
+        np.testing.assert_array_equal(step_terms.inlet_terms, expected[1])
+        np.testing.assert_array_equal(step_terms.process_vars, expected[2])
+        n_known += np.count_nonzero(np.invert(np.isnan(estimator._cur_speeds)))
+        estimator.predict(step_terms)
+        estimator.update(estimator.finish_step())
+    assert 0 < n_known < n_iterations * estimator.n_segments
+
+
+def test_speed_buffer_equals_reference():
+    rng = np.random.RandomState(0)
+    n_segments = 6
+    speed_buffer = RoadSpeedBuffer(n_segments)
+    expected = pd.DataFrame({'speed': np.full(n_segments, np.nan), 'age': [0] * n_segments})
+    for i in range(200):
+        segments = np.flatnonzero(rng.rand(n_segments) < 0.2)
+        speeds = np.where(rng.rand(len(segments)) < 0.2, np.nan,
+                          rng.uniform(0.0, 40.0, len(segments)))
+        speed_buffer.update(segments, speeds)
+        expected['age'] += 1
+        expected.loc[segments, 'speed'] = speeds
+        expected.loc[segments, 'age'] = 0
+        np.testing.assert_array_equal(speed_buffer.speeds, expected['speed'].values)
+        np.testing.assert_array_equal(speed_buffer.ages, expected['age'].values)
+        valid = np.logical_and(expected['speed'].notnull(), expected['age'] <= 12)
+        np.testing.assert_array_equal(speed_buffer.get_valid_speeds_filt(12), valid.values)
+
+
+def test_batched_equals_single(synth_paths, cab_data, tmp_path):
+    road_sections = [proc.road.RoadSection(fname, synth_paths['vdsdir'])
+                     for fname in [synth_paths['road'], ramp_variant(synth_paths, tmp_path),
+                                   synth_paths['road']]]
+    day_start = (int(cab_data.column('time').min()) // 86400) * 86400
+    start_times = [day_start + hour * 3600 for hour in [7, 8, 17]]
+    singles = make_estimators(road_sections, start_times)
+    batched = make_estimators(road_sections, start_times)
+    for estimator in singles + batched:
+        estimator.enable_trace(n_iterations)
+    batch = BatchedRoadStateEstimator(batched)
+    assert len(batch._groups) == 1
+    for i in range(n_iterations):
+        for estimator in singles:
+            estimator.run_iteration(cab_data)
+        batch.run_iteration(cab_data)
+        for single, estimator in zip(singles, batched):
+            assert estimator.time == single.time
+            np.testing.assert_array_equal(estimator.state, single.state)
+            np.testing.assert_array_equal(estimator.error_covar, single.error_covar)
+    for single, estimator in zip(singles, batched):
+        np.testing.assert_array_equal(estimator.speed_buffer.speeds, single.speed_buffer.speeds)
+        for name in ['times', 'speeds', 'predicted', 'updated', 'innovations']:
+            np.testing.assert_array_equal(getattr(estimator.trace, name),
+                                          getattr(single.trace, name))
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+
+from proc import fd
+
+
+def reference_capacity(densities, flows):
+    """
+    calc_capacity as a plain loop over the remaining flows
+    """
+    tolerance = 0.005
+    flows_remain = flows
+    while len(flows_remain) >= 1:
+        cur_max = flows_remain.max()
+        at_max = np.logical_and(cur_max - tolerance <= flows, flows <= cur_max + tolerance)
+        if np.sum(at_max) >= 3 and densities[at_max].max() - densities[at_max].min() >= 0.001:
+            return cur_max
+        remain_at_max = np.logical_and(cur_max - tolerance <= flows_remain,
+                                       flows_remain <= cur_max + tolerance)
+        flows_remain = flows_remain[np.invert(remain_at_max)]
+    return None
+
+
+def reference_cong_bins(data, rho_crit, q_crit):
+    """
+    calc_cong_bins with a groupby over bins of 10 points
+    """
+    def bin_flow(flows):
+        q1 = flows.quantile(q=0.25)
+        q3 = flows.quantile(q=0.75)
+        return flows[flows < q3 + 1.5*(q3-q1)].max()
+
+    filt = np.logical_and(data['flow'] <= q_crit, data['density'] > rho_crit)
+    data_cong = data[filt].sort_values('density')
+    data_cong['bin'] = np.arange(len(data_cong)) // 10 + 1
+    grouped_bins = data_cong.groupby('bin')
+    return grouped_bins['density'].mean(), grouped_bins['flow'].agg(bin_flow)
+
+
+def random_points(rng, n_points):
+    # flows and densities on coarse grids, so that there are ties and bands
+    flows = rng.randint(0, 300, n_points) * 0.004
+    densities = rng.randint(0, rng.choice([3, 50, 1000]), n_points) * rng.choice([1e-4, 1e-3])
+    return densities, flows
+
+
+def test_calc_capacity_equals_reference():
+    rng = np.random.RandomState(0)
+    n_found = 0
+    for i in range(500):
+        densities, flows = random_points(rng, rng.randint(1, 200))
+        capacity = fd.calc_capacity(pd.Series(densities), pd.Series(flows))
+        assert capacity == reference_capacity(densities, flows)
+        n_found += capacity is not None
+    assert 0 < n_found < 500
+
+
+def test_calc_capacity_after_failed_bands():
+    # the first two bands have too few points. On arrays, the former version
+    # masked the remaining flows with a mask over all flows in the second
+    # pass, and raised IndexError
+    flows = np.array([1.0, 0.8, 0.5, 0.5, 0.5])
+    densities = np.array([0.01, 0.01, 0.01, 0.02, 0.03])
+    assert fd.calc_capacity(densities, flows) == 0.5
+    assert fd.calc_capacity(pd.Series(densities), pd.Series(flows)) == 0.5
+
+
+def test_calc_capacity_none():
+    flows = pd.Series([1.0, 0.8, 0.8, 0.8, 0.5])
+    densities = pd.Series([0.01, 0.02, 0.02, 0.02, 0.03])
+    assert fd.calc_capacity(densities, flows) is None
+    assert fd.calc_capacity(pd.Series([], dtype=np.float64), pd.Series([], dtype=np.float64)) is None
+
+
+def test_calc_cong_bins_equals_reference():
+    rng = np.random.RandomState(1)
+    for i in range(200):
+        densities, flows = random_points(rng, rng.randint(0, 150))
+        data = pd.DataFrame({'density': densities, 'flow': flows})
+        rho_crit, q_crit = (np.percentile(densities, 20) if len(densities) > 0 else 0.0, 0.9)
+        bin_densities, bin_flows = fd.calc_cong_bins(data, rho_crit, q_crit)
+        expected_densities, expected_flows = reference_cong_bins(data, rho_crit, q_crit)
+        np.testing.assert_array_equal(bin_densities.index.values, expected_densities.index.values)
+        # groupby means may be summed with compensation, within an ulp of in-order sums
+        np.testing.assert_allclose(bin_densities.values, expected_densities.values, rtol=1e-15)
+        np.testing.assert_array_equal(bin_flows.values, expected_flows.values)
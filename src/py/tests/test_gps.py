@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from proc import gps
+
+
+def random_fixes(road_section, n_fixes, seed=0):
+    """
+    :return: DataFrame of x, y and dir of fixes around road_section, most
+    within a few segment thresholds of it, with directions along, against
+    and across its segments
+    """
+    rng = np.random.RandomState(seed)
+    seg_idxs = rng.randint(0, len(road_section.seg_starts), n_fixes)
+    fracs = rng.uniform(-0.1, 1.1, n_fixes)
+    points = (road_section.seg_starts[seg_idxs] +
+              fracs[:, np.newaxis] * road_section.seg_vecs[seg_idxs] +
+              rng.normal(0.0, 12.0, (n_fixes, 2)))
+    dirs = road_section.seg_angles[seg_idxs] + rng.normal(0.0, 0.6, n_fixes)
+    dirs[rng.rand(n_fixes) < 0.2] += np.pi
+    return pd.DataFrame({'x': points[:, 0], 'y': points[:, 1], 'dir': dirs})
+
+
+def test_assign_segments_equals_rowwise(road_section):
+    fixes = random_fixes(road_section, 400)
+    dist_thresh, angle_thresh = (11.0, np.deg2rad(30.0))
+    expected = gps.assign_segments_rowwise(fixes, road_section, dist_thresh, angle_thresh)
+    assigned = gps.assign_segments(fixes, road_section, dist_thresh, angle_thresh, chunk_size=64)
+    assert assigned.dtype == gps.segment_dtype
+    assert np.any(expected.values >= 0) and np.any(expected.values < 0)
+    np.testing.assert_array_equal(assigned.values, expected.values)
+
+
+def test_assign_segments_beyond_grid_buffer(road_section):
+    fixes = random_fixes(road_section, 150, seed=1)
+    dist_thresh = road_section.get_segment_grid(0.0).buffer * 2.0
+    expected = gps.assign_segments_rowwise(fixes, road_section, dist_thresh, np.pi)
+    assigned = gps.assign_segments(fixes, road_section, dist_thresh, np.pi)
+    np.testing.assert_array_equal(assigned.values, expected.values)
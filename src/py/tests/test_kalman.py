@@ -0,0 +1,99 @@
+import numpy as np
+
+import proc.road
+from proc.estimator import RoadStateEstimator
+from proc.kalman import RoadKalmanEngine
+
+n_steps = 20
+no_detector_step = 7
+
+
+def dense_transition_mat(template, n_segments, outlet_terms, inlet_terms):
+    mat = template.copy()
+    mat[:n_segments, :n_segments] = np.diag(outlet_terms) + np.diag(inlet_terms, k=-1)
+    return mat
+
+
+def ramp_template(n_segments, on_ramps, off_ramps):
+    """
+    :return: transition matrix template of a section with a ramp state per
+    on and off ramp segment, in order of segment
+    """
+    ramps = sorted([(segment, 1.0) for segment in on_ramps] + [(segment, -1.0) for segment in off_ramps])
+    n_states = n_segments + len(ramps)
+    template = np.zeros((n_states, n_states))
+    for ramp_idx, (segment, sign) in enumerate(ramps):
+        template[segment, n_segments + ramp_idx] = sign
+    template[n_segments:, n_segments:] = np.identity(len(ramps))
+    return template
+
+
+def meas_mat(n_states, meas_idxs):
+    mat = np.zeros((len(meas_idxs), n_states))
+    mat[np.arange(len(meas_idxs)), meas_idxs] = 1.0
+    return mat
+
+
+def run_against_dense(template, state_to_meas_mat, measurement_covar, n_segments, seed):
+    """
+    Step a RoadKalmanEngine and the dense Kalman equations with the same
+    random terms and measurements, and compare them after every step
+    """
+    rng = np.random.RandomState(seed)
+    engine = RoadKalmanEngine(template, state_to_meas_mat, measurement_covar, n_segments)
+    n_states = len(template)
+    n_meas = len(state_to_meas_mat)
+    state = rng.uniform(0.0, 0.1, n_states)
+    noise = rng.normal(0.0, 0.01, (n_states, n_states))
+    error_covar = np.matmul(noise, noise.T) + np.diag(rng.uniform(1e-4, 1e-3, n_states))
+    dense_state = state.copy()
+    dense_covar = error_covar.copy()
+    for step in range(n_steps):
+        outlet_terms = 1.0 - rng.uniform(0.0, 0.5, n_segments)
+        inlet_terms = rng.uniform(0.0, 0.5, n_segments - 1)
+        process_vars = rng.uniform(1e-6, 1e-4, n_states)
+        if step == no_detector_step:
+            unknown = np.full(n_meas, np.nan)
+            meas = proc.road.calc_densities(unknown, unknown)
+        else:
+            meas = rng.uniform(0.0, 0.1, n_meas)
+
+        state = engine.predict_state(state, outlet_terms, inlet_terms)
+        engine.predict_covar(error_covar, outlet_terms, inlet_terms, process_vars)
+        transition_mat = dense_transition_mat(template, n_segments, outlet_terms, inlet_terms)
+        dense_state = np.matmul(transition_mat, dense_state)
+        dense_covar = (np.matmul(np.matmul(transition_mat, dense_covar), transition_mat.T) +
+                       np.diag(process_vars))
+        np.testing.assert_allclose(state, dense_state, rtol=1e-12, atol=1e-15)
+        np.testing.assert_allclose(error_covar, dense_covar, rtol=1e-12, atol=1e-15)
+
+        innov = engine.update(state, error_covar, meas)
+        h = state_to_meas_mat
+        innov_covar = np.matmul(np.matmul(h, dense_covar), h.T) + measurement_covar
+        gain = np.matmul(np.matmul(dense_covar, h.T), np.linalg.inv(innov_covar))
+        dense_innov = meas - np.matmul(h, dense_state)
+        dense_state = dense_state + np.matmul(gain, dense_innov)
+        dense_covar = np.matmul(np.identity(n_states) - np.matmul(gain, h), dense_covar)
+        np.testing.assert_allclose(innov, dense_innov, rtol=1e-10, atol=1e-14)
+        np.testing.assert_allclose(state, dense_state, rtol=1e-10, atol=1e-14)
+        np.testing.assert_allclose(error_covar, dense_covar, rtol=1e-10, atol=1e-14)
+        np.testing.assert_array_equal(error_covar, error_covar.T)
+
+
+def test_engine_equals_dense_road(synth_paths):
+    road_section = proc.road.RoadSection(synth_paths['road'], synth_paths['vdsdir'])
+    estimator = RoadStateEstimator(road_section, 5, 1211094000 + 8 * 3600)
+    assert road_section.n_ramps > 0
+    run_against_dense(estimator._transition_mat_template, estimator._state_to_meas_mat,
+                      estimator._measurement_covar, estimator.n_segments, 0)
+
+
+def test_engine_equals_dense_ramps():
+    template = ramp_template(12, [0, 3, 8], [5, 11])
+    run_against_dense(template, meas_mat(len(template), [2, 7, 11, 13]),
+                      np.diag([3e-4, 5e-4, 2e-4, 4e-4]), 12, 1)
+
+
+def test_engine_equals_dense_no_ramps():
+    template = ramp_template(8, [], [])
+    run_against_dense(template, meas_mat(8, [0, 4, 7]), np.diag([3.12e-4, 6.82e-4, 2.70e-4]), 8, 2)
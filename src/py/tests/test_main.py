@@ -0,0 +1,56 @@
+import os
+import shutil
+
+import bench.synthdata
+import main
+import proc.speedcube
+
+
+def copy_datadir(synth_paths, tmp_path, name):
+    datadir = str(tmp_path / name)
+    shutil.copytree(synth_paths['datadir'], datadir,
+                    ignore=shutil.ignore_patterns('*.cols', '*.pickle'))
+    return datadir
+
+
+def run_estimate(synth_paths, tmp_path, name, time_lims, jobs):
+    """
+    :return: dict of the contents of each output file of estimate, by file name
+    """
+    datadir = copy_datadir(synth_paths, tmp_path, 'cabs_' + name)
+    outputdir = str(tmp_path / name)
+    os.makedirs(outputdir)
+    main.estimate(main.args_setup(['estimate', datadir, synth_paths['road'],
+                                   synth_paths['vdsdir'], outputdir, '--jobs', str(jobs),
+                                   '--periods'] +
+                                  ['{}:{}'.format(*time_lim) for time_lim in time_lims]))
+    outputs = {}
+    for fname in os.listdir(outputdir):
+        with open(os.path.join(outputdir, fname), 'rb') as output_file:
+            outputs[fname] = output_file.read()
+    return outputs
+
+
+def test_parallel_equals_serial(synth_paths, tmp_path, monkeypatch):
+    day_start = bench.synthdata.default_start_time
+    # start times of other phases, so that each period has its own speed cube
+    time_lims = [(day_start + 7 * 3600, day_start + 7 * 3600 + 1800),
+                 (day_start + 17 * 3600 + 2, day_start + 17 * 3600 + 1802)]
+    serial = run_estimate(synth_paths, tmp_path, 'serial', time_lims, 1)
+    # aggregating a cube appends the pid of its process. Forked workers
+    # inherit the patch, and must memory-map the cubes built before the pool
+    pids_fname = str(tmp_path / 'aggregate_pids.txt')
+    aggregate = proc.speedcube.aggregate
+
+    def recording_aggregate(column_chunks, timestep, phase):
+        with open(pids_fname, 'a') as pids_file:
+            pids_file.write("{}\n".format(os.getpid()))
+        return aggregate(column_chunks, timestep, phase)
+
+    monkeypatch.setattr(proc.speedcube, 'aggregate', recording_aggregate)
+    parallel = run_estimate(synth_paths, tmp_path, 'parallel', time_lims, 2)
+    assert sorted(serial) == ['estimate_{}_{}.csv'.format(*time_lim) for time_lim in time_lims]
+    assert parallel == serial
+    with open(pids_fname) as pids_file:
+        pids = pids_file.read().split()
+    assert pids == [str(os.getpid())] * len(time_lims)
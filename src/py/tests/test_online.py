@@ -0,0 +1,100 @@
+import os
+import shutil
+import argparse
+import asyncio
+import numpy as np
+import pandas as pd
+
+import bench.synthdata
+import main
+import replay
+import proc.road
+import proc.online
+import proc.output
+
+timestep = 5
+lag = 600
+replay_speed = 20000.0  # times real time
+
+
+def run_offline(synth_paths, tmp_path, time_lim):
+    datadir = str(tmp_path / 'cabs')
+    shutil.copytree(synth_paths['datadir'], datadir,
+                    ignore=shutil.ignore_patterns('*.cols', '*.pickle'))
+    outputdir = str(tmp_path / 'offline')
+    os.makedirs(outputdir)
+    main.estimate(main.args_setup(['estimate', datadir, synth_paths['road'],
+                                   synth_paths['vdsdir'], outputdir,
+                                   '--periods', '{}:{}'.format(*time_lim)]))
+    return pd.read_csv(os.path.join(outputdir, 'estimate_{}_{}.csv'.format(*time_lim)))
+
+
+class BoundsCheck(object):
+    """
+    Feeds lines to an OnlineEstimator and records how many fixes and
+    detector samples it keeps
+    """
+    def __init__(self, online_estimator):
+        self.online_estimator = online_estimator
+        self.max_fixes = 0
+        self.max_samples = 0
+        self.n_stale = 0
+
+    def handle_line(self, line):
+        online_estimator = self.online_estimator
+        online_estimator.handle_line(line)
+        cab_data = online_estimator.cab_data
+        self.max_fixes = max(self.max_fixes, len(cab_data.times) + len(cab_data._pending))
+        self.max_samples = max(self.max_samples,
+                               max(len(times) for times, flows, speeds
+                                   in online_estimator.detector_meas._samples))
+        if online_estimator.estimator is not None and len(cab_data.times) > 0:
+            # fixes of iterations that already ran are dropped
+            self.n_stale += np.sum(cab_data.times <= online_estimator.estimator.time - timestep)
+
+
+def run_online(synth_paths, tmp_path, time_lim):
+    feed_args = argparse.Namespace(datadir=synth_paths['datadir'], vdsdir=synth_paths['vdsdir'],
+                                   road=synth_paths['road'], start=time_lim[0] - lag,
+                                   end=time_lim[1] + 2 * lag, tick=timestep)
+    times, lines = replay.feed_events(feed_args)
+    road_section = proc.road.RoadSection(synth_paths['road'], None)
+    fname = str(tmp_path / 'online.csv')
+    with proc.output.EstimateWriter(fname, len(road_section.segments.index),
+                                    road_section.n_ramps) as output_wr:
+        online_estimator = proc.online.OnlineEstimator(road_section, timestep,
+                                                       output_wr.write_row, time_lim[0], lag)
+        bounds = BoundsCheck(online_estimator)
+
+        async def drain():
+            pass
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(replay.replay(times, lines, bounds.handle_line, drain,
+                                                  replay_speed))
+        finally:
+            loop.close()
+    fix_times = np.array([time for time, line in zip(times, lines) if line.startswith('gps')])
+    return pd.read_csv(fname), bounds, fix_times
+
+
+def test_replay_equals_offline(synth_paths, tmp_path):
+    day_start = bench.synthdata.default_start_time
+    time_lim = (day_start + 7 * 3600, day_start + 8 * 3600)
+    offline = run_offline(synth_paths, tmp_path, time_lim)
+    online, bounds, fix_times = run_online(synth_paths, tmp_path, time_lim)
+    assert offline['time'].values[-1] == time_lim[1]
+    assert len(online.index) >= len(offline.index)
+    online = online.iloc[:len(offline.index)]
+    assert list(online.columns) == list(offline.columns)
+    np.testing.assert_array_equal(online.values, offline.values)
+    # only fixes and samples within the lag are kept: fixes are held from
+    # their arrival until lag seconds past their iteration, or until the
+    # first iteration runs lag seconds after the start of the replay
+    assert bounds.n_stale == 0
+    held_len = 2 * lag + timestep
+    max_in_window = np.max(np.searchsorted(fix_times, fix_times + held_len, side='right') -
+                           np.arange(len(fix_times)))
+    assert 0 < bounds.max_fixes <= max_in_window < len(fix_times) / 2
+    assert bounds.max_samples <= lag // 300 + 3
@@ -0,0 +1,40 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from proc.output import EstimateWriter
+
+
+class FailingWriter(object):
+    def writerows(self, rows):
+        raise ValueError("disk full")
+
+
+def write_rows(output_wr, n_rows):
+    for i in range(n_rows):
+        output_wr.write_row(i, np.full(3, i * 0.5), np.full(2, i * 2.0))
+
+
+def test_rows_written(tmp_path):
+    fname = str(tmp_path / 'estimate.csv')
+    with EstimateWriter(fname, 2, 1, block_rows=4) as output_wr:
+        write_rows(output_wr, 10)
+    written = pd.read_csv(fname)
+    assert list(written.columns) == output_wr.header
+    np.testing.assert_array_equal(written['time'].values, np.arange(10))
+    np.testing.assert_array_equal(written['speed_1'].values, np.arange(10) * 2.0)
+
+
+def test_writer_error_raised_on_close(tmp_path):
+    with pytest.raises(IOError):
+        with EstimateWriter(str(tmp_path / 'estimate.csv'), 2, 1, block_rows=1) as output_wr:
+            output_wr._output_wr = FailingWriter()
+            write_rows(output_wr, 3)
+
+
+def test_writer_error_does_not_replace_exception(tmp_path):
+    with pytest.raises(KeyError):
+        with EstimateWriter(str(tmp_path / 'estimate.csv'), 2, 1, block_rows=1) as output_wr:
+            output_wr._output_wr = FailingWriter()
+            write_rows(output_wr, 1)
+            raise KeyError('estimation failed')
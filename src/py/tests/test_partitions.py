@@ -0,0 +1,138 @@
+import os
+import shutil
+import numpy as np
+import pytest
+
+import bench.synthdata
+import proc.cabdata
+import proc.partitions
+import proc.road
+
+partition_len = 1800
+batch_rows = 2500  # cab lists of 1500 updates per cab give batches of one and two cabs
+gap_cab = 'cab00003'
+gap_lims = (bench.synthdata.default_start_time + 3 * 3600,
+            bench.synthdata.default_start_time + 5 * 3600)
+# longer than the gap, so that the first fix after it has a delta from the
+# fix before it, carried over the partitions the cab skips
+dtime_max = 3 * 3600
+compared_cols = ['time', 'occupancy', 'x', 'y', 'vx', 'vy', 'speed', 'dir', 'segment']
+
+
+@pytest.fixture(scope='module')
+def gapped_datadir(synth_paths, tmp_path_factory):
+    """
+    Copy of the synthetic traces in which one cab has no fixes for several
+    partitions
+    """
+    datadir = str(tmp_path_factory.mktemp('partitions') / 'cabs')
+    shutil.copytree(synth_paths['datadir'], datadir,
+                    ignore=shutil.ignore_patterns('*.cols', '*.pickle'))
+    fname = os.path.join(datadir, "new_{}.txt".format(gap_cab))
+    with open(fname, 'r') as fin:
+        lines = fin.readlines()
+    times = np.array([int(line.split()[3]) for line in lines])
+    kept = np.logical_or(times < gap_lims[0], times > gap_lims[1])
+    with open(fname, 'w') as fout:
+        fout.writelines(line for line, keep in zip(lines, kept) if keep)
+    cab_list = proc.cabdata.read_cab_list(os.path.join(datadir, "_cabs.txt"))
+    cab_list.loc[cab_list['id'] == gap_cab, 'updates'] = np.count_nonzero(kept)
+    proc.cabdata.write_cab_list(os.path.join(datadir, "_cabs.txt"), cab_list['id'],
+                                cab_list['updates'])
+    return datadir
+
+
+@pytest.fixture(scope='module')
+def single_and_partitioned(gapped_datadir, synth_paths):
+    """
+    :return: tuple (CabData of all traces in memory, PartitionedCabData of
+    partitions of the same traces)
+    """
+    road_section = proc.road.RoadSection(synth_paths['road'], None)
+    cab_data = proc.cabdata.CabData(gapped_datadir)
+    cab_data.calc_xy(*road_section.center)
+    cab_data.calc_deltas(dtime_max)
+    cab_data.assign_road_segments(road_section, 11.0, np.deg2rad(30.0))
+    proc.partitions.build_partitions(gapped_datadir, road_section, partition_len,
+                                     dtime_max=dtime_max, batch_rows=batch_rows)
+    return cab_data, proc.partitions.PartitionedCabData(gapped_datadir)
+
+
+def partition_cab_ids(partitioned, key):
+    """
+    :return: Categorical of the cab ids of the rows of a partition, whose
+    column reads as the codes of the save
+    """
+    return partitioned.partition(key).store.column('cab_id')
+
+
+def by_cab_and_time(values, categories=None):
+    cab_ids = np.asarray(values['cab_id'] if categories is None
+                         else categories[values['cab_id']]).astype(str)
+    order = np.lexsort((values['time'], cab_ids))
+    return cab_ids[order], {col: values[col][order] for col in compared_cols}
+
+
+def time_windows(times, n_windows, length, seed=0):
+    rng = np.random.RandomState(seed)
+    starts = rng.randint(times.min() - length, times.max() + 1, n_windows)
+    return [(int(start), int(start) + length - 1) for start in starts]
+
+
+def test_gap_skips_partitions(single_and_partitioned):
+    cab_data, partitioned = single_and_partitioned
+    skipped = range(gap_lims[0] // partition_len + 1, gap_lims[1] // partition_len)
+    assert len(skipped) > 1
+    for key in skipped:
+        cab_ids = partition_cab_ids(partitioned, key)
+        assert len(cab_ids) > 0 and gap_cab in cab_ids.categories and gap_cab not in set(cab_ids)
+    # the first fix after the gap has a delta from the last one before it
+    traces = cab_data.cab_traces
+    after_gap = np.flatnonzero((traces['cab_id'].values == gap_cab) &
+                               (traces['time'].values > gap_lims[1]))[0]
+    assert traces['time'].values[after_gap] - traces['time'].values[after_gap - 1] > 2 * 3600
+    assert not np.isnan(traces['vx'].values[after_gap])
+
+
+def test_columns_equal_single(single_and_partitioned):
+    cab_data, partitioned = single_and_partitioned
+    assert partitioned.n_rows() == cab_data.n_rows()
+    categories = partition_cab_ids(partitioned, partitioned.partitions['key'].values[0]).categories
+    times = cab_data.column('time')
+    for time_lims in [(int(times.min()), int(times.max()))] + time_windows(times, 20, 4000):
+        columns = compared_cols + ['cab_id']
+        cab_ids, values = by_cab_and_time(partitioned.columns_in_time_window(time_lims, columns),
+                                          categories)
+        expected_cab_ids, expected = by_cab_and_time(cab_data.columns_in_time_window(time_lims,
+                                                                                     columns))
+        np.testing.assert_array_equal(cab_ids, expected_cab_ids)
+        for col in compared_cols:
+            assert values[col].dtype == expected[col].dtype, col
+            np.testing.assert_array_equal(values[col], expected[col], err_msg=col)
+
+
+def test_avg_segment_speeds_equal_single(single_and_partitioned):
+    cab_data, partitioned = single_and_partitioned
+    times = cab_data.column('time')
+    n_assigned = 0
+    for time_lims in time_windows(times, 100, 300) + time_windows(times, 10, 5000, 1) + [None]:
+        speeds = partitioned.calc_avg_segment_speeds(None, time_lims)
+        expected = cab_data.calc_avg_segment_speeds(None, time_lims)
+        np.testing.assert_array_equal(speeds.index.values, expected.index.values)
+        np.testing.assert_array_equal(speeds.values, expected.values)
+        n_assigned += len(speeds.index)
+    assert n_assigned > 0
+
+
+def test_max_loaded_evicts(single_and_partitioned, gapped_datadir):
+    partitioned = proc.partitions.PartitionedCabData(gapped_datadir, max_loaded=2)
+    keys = partitioned.partitions['key'].values
+    for key in keys[:3]:
+        partitioned.partition(key)
+    assert list(partitioned._loaded) == list(keys[1:3])
+    partitioned.partition(keys[1])
+    partitioned.partition(keys[5])
+    assert list(partitioned._loaded) == [keys[1], keys[5]]
+    for chunk in partitioned.iter_columns(['time']):
+        assert len(partitioned._loaded) <= 2
+    assert list(partitioned._loaded) == list(keys[-2:])
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import proc.cabdata
+import proc.road
+
+dist_thresh = 11.0
+angle_thresh = np.deg2rad(30.0)
+
+
+def reversed_section(synth_paths, tmp_path):
+    """
+    :return: RoadSection of the synthetic road driven the other way
+    """
+    section = pd.read_csv(synth_paths['road']).iloc[::-1]
+    fname = str(tmp_path / 'road_reversed.csv')
+    section.to_csv(fname, index=False)
+    return proc.road.RoadSection(fname, None)
+
+
+def test_add_section_duplicate_name(road_section):
+    section_set = proc.road.SectionSet([road_section], road_section.center, ['road'])
+    seg_starts = section_set.seg_starts.copy()
+    with pytest.raises(ValueError):
+        section_set.add_section(road_section, 'road')
+    assert len(section_set) == 1
+    assert section_set.names == ['road']
+    np.testing.assert_array_equal(section_set.seg_starts, seg_starts)
+    assert section_set.add_section(road_section) == 1
+    assert section_set.names == ['road', '1']
+
+
+def test_assign_sections_equal_single(cab_data, road_section, synth_paths, tmp_path):
+    sections = [road_section, reversed_section(synth_paths, tmp_path)]
+    section_set = proc.road.SectionSet(sections[:1], road_section.center, ['road'])
+    cab_data.assign_sections(section_set, dist_thresh, angle_thresh)
+    section_set.add_section(sections[1], 'reversed')
+    section_ids = cab_data.assign_sections(section_set, dist_thresh, angle_thresh)
+    for section, section_id in zip(sections, section_ids):
+        cab_data.assign_road_segments(section, dist_thresh, angle_thresh)
+        expected = cab_data.column('segment')
+        np.testing.assert_array_equal(cab_data.section_segments(section_id), expected)
+        assert np.count_nonzero(expected >= 0) > 0
+
+
+def test_reprojection_drops_section_assignments(cab_data, road_section, tmp_path):
+    cab_data.save_cabtraces()
+    section_set = proc.road.SectionSet([road_section], road_section.center, ['road'])
+    cab_data.assign_sections(section_set, dist_thresh, angle_thresh)
+    assert len(cab_data.section_assignments()[1]) == 1
+    center = (road_section.center[0] + 0.002, road_section.center[1] - 0.003)
+    cab_data.calc_xy(*center)
+    assert cab_data.saved_at is None
+    assert cab_data.section_assignments()[1] == []
+    section_set = proc.road.SectionSet([road_section], center, ['road'])
+    cab_data.assign_sections(section_set, dist_thresh, angle_thresh)
+    assert len(cab_data.section_assignments()[1]) == 1
+    cab_data.calc_deltas()
+    assert cab_data.section_assignments()[1] == []
+    section_ids = cab_data.assign_sections(section_set, dist_thresh, angle_thresh)
+    # the same traces processed in the new frame from the start
+    expected = proc.cabdata.CabData(str(tmp_path / 'cabs'))
+    expected.calc_xy(*center)
+    expected.calc_deltas()
+    expected_ids = expected.assign_sections(section_set, dist_thresh, angle_thresh)
+    segments = cab_data.section_segments(section_ids[0])
+    np.testing.assert_array_equal(segments, expected.section_segments(expected_ids[0]))
+    assert np.count_nonzero(segments >= 0) > 0
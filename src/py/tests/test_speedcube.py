@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import proc.speedcube
+
+
+def bin_windows(cab_data, timestep, phase):
+    times = cab_data.column('time')
+    first_bin = (int(times.min()) - phase) // timestep - 1
+    last_bin = (int(times.max()) - phase) // timestep + 1
+    return [(k * timestep + phase, (k + 1) * timestep + phase - 1)
+            for k in range(first_bin, last_bin + 1)]
+
+
+def assert_speeds_equal(speeds, expected):
+    np.testing.assert_array_equal(speeds.index.values, expected.index.values)
+    np.testing.assert_array_equal(speeds.values, expected.values)
+
+
+def test_bins_equal_cab_data(cab_data):
+    timestep, phase = 5, proc.speedcube.estimator_phase(1211094000, 5)
+    cube = proc.speedcube.SpeedCube.build(cab_data, timestep, phase)
+    n_assigned = 0
+    for time_lims in bin_windows(cab_data, timestep, phase):
+        assert cube.covers(time_lims)
+        speeds = cube.calc_avg_segment_speeds(None, time_lims)
+        assert_speeds_equal(speeds, cab_data.calc_avg_segment_speeds(None, time_lims))
+        n_assigned += len(speeds.index)
+    assert n_assigned > 0
+
+
+def test_chunked_aggregate(cab_data):
+    timestep, phase = 30, 7
+    columns = next(cab_data.iter_columns(['time', 'segment', 'speed']))
+    splits = np.random.RandomState(0).randint(0, len(columns['time']), 40)
+    chunks = [{col: values[start:end] for col, values in columns.items()}
+              for start, end in zip(np.r_[0, np.sort(splits)], np.r_[np.sort(splits), len(columns['time'])])]
+    chunked = proc.speedcube.aggregate(chunks, timestep, phase)
+    whole = proc.speedcube.aggregate([columns], timestep, phase)
+    for col in proc.speedcube.cube_cols:
+        np.testing.assert_array_equal(chunked[col], whole[col])
+
+
+def test_other_windows_fall_back(cab_data):
+    cube = proc.speedcube.SpeedCube.build(cab_data, 5, 0)
+    times = cab_data.column('time')
+    for time_lims in [(int(times.min()) + 1, int(times.min()) + 300), None]:
+        assert not cube.covers(time_lims)
+        assert_speeds_equal(cube.calc_avg_segment_speeds(None, time_lims),
+                            cab_data.calc_avg_segment_speeds(None, time_lims))
+    detached = proc.speedcube.SpeedCube(5, 0, cube._cube)
+    with pytest.raises(ValueError):
+        detached.calc_avg_segment_speeds(None, (1, 10))
+
+
+def test_load_or_build_saved(cab_data):
+    cab_data.save_cabtraces()
+    built = proc.speedcube.load_or_build(cab_data, 5, 1)
+    loaded = proc.speedcube.load_or_build(cab_data, 5, 1)
+    assert isinstance(loaded.bins, np.memmap)
+    for time_lims in bin_windows(cab_data, 5, 1)[::7]:
+        assert_speeds_equal(loaded.calc_avg_segment_speeds(None, time_lims),
+                            built.calc_avg_segment_speeds(None, time_lims))
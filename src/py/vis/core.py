@@ -1,8 +1,17 @@
+import os
+import logging
+import multiprocessing
 from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from mpl_toolkits.basemap import Basemap
 import geotiler
 import numpy as np
 
+# cab_traces columns used in frames
+frame_cols = ['time', 'lat', 'long', 'vx', 'vy', 'speed', 'segment']
+frames_per_task = 50  # frames rendered by a worker per task
+
 
 def plot_timestamps(cab_traces, t1, t2):
     times = cab_traces['time'].between(t1, t2, inclusive=True)
@@ -21,15 +30,124 @@ def normalize_vel(velocity, vel_norm):
     return vx_norm, vy_norm
 
 
+class FrameRenderer(object):
+    """
+    Renders frames of cab positions over a fixed map. The map is drawn once
+    and saved as background; each frame restores it and draws only the cab
+    artists, whose data are updated in place (blitting). Uses its own Agg
+    canvas, so it needs no display
+    """
+    def __init__(self, mapimg, upper_coords, frame_data, capacity, figsize=(8, 8), dpi=100):
+        """
+        :param mapimg: map image, covering 0 to upper_coords in map x, y
+        :param frame_data: dict of arrays of cab trace rows in order of time,
+        as returned by MapPlotter.frame_data
+        :param capacity: most rows shown in a frame
+        """
+        self.frame_data = frame_data
+        self.capacity = max(capacity, 1)
+        self.fig = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_axes([0, 0, 1, 1])
+        self.ax.set_axis_off()
+        self.ax.imshow(mapimg, extent=[0, upper_coords[0], 0, upper_coords[1]])
+        self.ax.set_xlim([0, upper_coords[0]])
+        self.ax.set_ylim([0, upper_coords[1]])
+        # quivers keep their number of arrows: unused arrows are masked
+        no_arrows = np.ma.masked_all(self.capacity)
+        self.road_quiver = self.ax.quiver(np.zeros(self.capacity), np.zeros(self.capacity),
+                                          no_arrows, no_arrows, color='r', scale=0.05,
+                                          scale_units='dots', animated=True)
+        self.quiver = self.ax.quiver(np.zeros(self.capacity), np.zeros(self.capacity),
+                                     no_arrows, no_arrows, color='b', scale=0.05,
+                                     scale_units='dots', animated=True)
+        self.scatter = self.ax.scatter([], [], c='b', s=5, animated=True)
+        self.time_text = self.ax.text(0.01, 0.99, "", transform=self.ax.transAxes, va='top',
+                                      animated=True)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def _set_arrows(self, quiver, filt, rows):
+        n_arrows = np.count_nonzero(filt)
+        offsets = np.zeros((self.capacity, 2))
+        offsets[:n_arrows, 0] = self.frame_data['x'][rows][filt]
+        offsets[:n_arrows, 1] = self.frame_data['y'][rows][filt]
+        vx, vy = (np.ma.masked_all(self.capacity), np.ma.masked_all(self.capacity))
+        vx[:n_arrows] = self.frame_data['vx'][rows][filt]
+        vy[:n_arrows] = self.frame_data['vy'][rows][filt]
+        quiver.set_offsets(offsets)
+        quiver.set_UVC(np.ma.masked_invalid(vx), np.ma.masked_invalid(vy))
+
+    def render(self, times):
+        """
+        Draw the cabs seen between times, a tuple (start, end) both inclusive
+        """
+        data_times = self.frame_data['time']
+        rows = slice(np.searchsorted(data_times, times[0], side='left'),
+                     np.searchsorted(data_times, times[1], side='right'))
+        road_filt = self.frame_data['on_road'][rows]
+        nan_filt = np.logical_or(np.isnan(self.frame_data['vx'][rows]),
+                                 np.isnan(self.frame_data['vy'][rows]))
+        self._set_arrows(self.road_quiver, road_filt, rows)
+        off_road = np.invert(road_filt)
+        filt = np.logical_and(off_road, nan_filt)
+        self.scatter.set_offsets(np.column_stack((self.frame_data['x'][rows][filt],
+                                                  self.frame_data['y'][rows][filt])))
+        self._set_arrows(self.quiver, np.logical_and(off_road, np.invert(nan_filt)), rows)
+        self.time_text.set_text("{} - {}".format(*times))
+        self.canvas.restore_region(self.background)
+        for artist in (self.road_quiver, self.quiver, self.scatter, self.time_text):
+            self.ax.draw_artist(artist)
+
+    def save(self, fname):
+        """
+        Save the last rendered frame as an image
+        """
+        width, height = self.canvas.get_width_height()
+        img = np.frombuffer(self.canvas.buffer_rgba(), dtype=np.uint8).reshape(height, width, 4)
+        plt.imsave(fname, img)
+
+
+_frame_worker_data = {}
+
+
+def _init_frame_worker(renderer_args):
+    _frame_worker_data['renderer'] = FrameRenderer(*renderer_args)
+
+
+def _render_frames_in_worker(task):
+    """
+    :param task: tuple (list of frame time limits, list of frame file names)
+    """
+    renderer = _frame_worker_data['renderer']
+    for times, fname in zip(*task):
+        renderer.render(times)
+        renderer.save(fname)
+    return len(task[1])
+
+
 class MapPlotter(object):
-    def __init__(self, cab_traces, extents):
+    def __init__(self, cab_traces, extents, tile_cache=None, zoom=17):
+        """
+        :param cab_traces: DataFrame of cab traces, with velocities and
+        assigned segments
+        :param extents: gps.Extents of the map
+        :param tile_cache: vis.tiles.TileCache map tiles are read from, or None
+        to download every tile
+        :param zoom: zoom level of map tiles
+        """
+        self.logger = logging.getLogger("MapPlotter")
         self.extents = extents
+        self.tile_cache = tile_cache
+        self.zoom = zoom
         self._upper_coords = (None, None)
         self.mapimg = None
         self.bm = self.generate_map()
         self.cab_traces = cab_traces
+        self.map_artist = None
         self.scatter = None
         self.quiver = None
+        self.road_quiver = None
 
     def generate_map(self):
         extents = self.extents
@@ -39,15 +157,62 @@ class MapPlotter(object):
         bm.drawmapboundary()
         self._upper_coords = bm(extents.max['long'], extents.max['lat'])
         gt_map = geotiler.Map(extent=extents.to_tuple(),
-                              zoom=17)
-        self.mapimg = geotiler.render_map(gt_map)
+                              zoom=self.zoom)
+        downloader = self.tile_cache.downloader if self.tile_cache is not None else None
+        self.mapimg = geotiler.render_map(gt_map, downloader=downloader)
         return bm
 
+    def frame_data(self, time_lims=None):
+        """
+        :param time_lims: tuple (start, end) of times, both inclusive, or None
+        for all times
+        :return: dict of arrays of cab trace rows in order of time: time, map
+        x and y, normalized vx and vy, and on_road, True if on a segment
+        """
+        traces = self.cab_traces
+        if time_lims is not None:
+            traces = traces[traces['time'].between(time_lims[0], time_lims[1])]
+        traces = traces.iloc[np.argsort(traces['time'].values, kind='mergesort')]
+        x, y = self.bm(traces['long'].values, traces['lat'].values)
+        vx_norm, vy_norm = normalize_vel(traces[['vx', 'vy']], traces['speed'].copy())
+        return {'time': traces['time'].values, 'x': np.asarray(x), 'y': np.asarray(y),
+                'vx': vx_norm.values, 'vy': vy_norm.values,
+                'on_road': traces['segment'].values >= 0}
+
+    def render_frames(self, frame_times, window, outputdir, jobs=1, figsize=(8, 8), dpi=100):
+        """
+        Save a frame of the cabs seen in the window seconds up to each of
+        frame_times to outputdir, as frame_<number>.png
+        :param jobs: number of processes rendering frames
+        :return: list of frame file names
+        """
+        frame_lims = [(time - window + 1, time) for time in frame_times]
+        fnames = [os.path.join(outputdir, "frame_{:06d}.png".format(i)) for i in range(len(frame_lims))]
+        if len(frame_lims) == 0:
+            return fnames
+        os.makedirs(outputdir, exist_ok=True)
+        frame_data = self.frame_data((frame_lims[0][0], frame_lims[-1][1]))
+        starts = np.searchsorted(frame_data['time'], [lims[0] for lims in frame_lims], side='left')
+        ends = np.searchsorted(frame_data['time'], [lims[1] for lims in frame_lims], side='right')
+        renderer_args = (np.asarray(self.mapimg), self._upper_coords, frame_data,
+                         int(np.max(ends - starts)), figsize, dpi)
+        tasks = [(frame_lims[i:i + frames_per_task], fnames[i:i + frames_per_task])
+                 for i in range(0, len(frame_lims), frames_per_task)]
+        if jobs > 1:
+            with multiprocessing.Pool(processes=jobs, initializer=_init_frame_worker,
+                                      initargs=(renderer_args,)) as pool:
+                pool.map(_render_frames_in_worker, tasks, chunksize=1)
+        else:
+            _init_frame_worker(renderer_args)
+            for task in tasks:
+                _render_frames_in_worker(task)
+        self.logger.info("{} frames saved to {}".format(len(fnames), outputdir))
+        return fnames
+
     def plot_cabs_in_time(self, times):
-        if self.scatter is not None:
-            self.scatter.remove()
-        if self.quiver is not None:
-            self.quiver.remove()
+        for artist in (self.scatter, self.quiver, self.road_quiver):
+            if artist is not None:
+                artist.remove()
         rel_traces = self.cab_traces['time'].between(times[0], times[1], inclusive=True)
         rel_traces = self.cab_traces[rel_traces]
 
@@ -56,14 +221,17 @@ class MapPlotter(object):
         vx_norm, vy_norm = normalize_vel(rel_traces[['vx', 'vy']], rel_traces['speed'])
 
         road_filt = rel_traces['segment'] >= 0
-        plt.quiver(x[road_filt], y[road_filt], vx_norm[road_filt], vy_norm[road_filt],
-                   color='r', scale=0.05, scale_units='dots')
+        self.road_quiver = plt.quiver(x[road_filt], y[road_filt], vx_norm[road_filt],
+                                      vy_norm[road_filt], color='r', scale=0.05, scale_units='dots')
         road_filt = np.invert(road_filt)
         nan_filt = np.logical_or(np.isnan(vx_norm), np.isnan(vy_norm))
         filt = np.logical_and(road_filt, nan_filt)
-        plt.imshow(self.mapimg, extent=[0, self._upper_coords[0], 0, self._upper_coords[1]])
-        plt.xlim([0, self._upper_coords[0]])
-        plt.ylim([0, self._upper_coords[1]])
+        # drawn once per figure, rather than under every frame
+        if self.map_artist is None or self.map_artist.axes is not plt.gca():
+            self.map_artist = plt.imshow(self.mapimg, extent=[0, self._upper_coords[0],
+                                                              0, self._upper_coords[1]])
+            plt.xlim([0, self._upper_coords[0]])
+            plt.ylim([0, self._upper_coords[1]])
         self.scatter = plt.scatter(x[filt], y[filt], c='b', s=5)
         filt = np.logical_and(road_filt, np.invert(nan_filt))
         self.quiver = plt.quiver(x[filt], y[filt], vx_norm[filt], vy_norm[filt],
@@ -13,12 +13,24 @@ def plot_fd_triangle(fit, free=True):
         plt.plot(rho, fit['cong_fit'][0] * rho + fit['cong_fit'][1], **fd_plot_params)
 
 
-def plot_fd(rho, q, fit, title):
+def show_or_save(fname=None):
+    """
+    Show the current figure, or save it to fname and close it
+    """
+    if fname is None:
+        plt.show()
+    else:
+        plt.savefig(fname)
+        plt.close()
+
+
+def plot_fd(rho, q, fit, title, fname=None):
     """
 
     :param rho: segment densities
     :param q: segment flows
     :param fit:
+    :param fname: path the plot is saved to, or None to show it
     :return:
     """
     # font = {'fontname': 'Garamond', 'size': 14}
@@ -37,7 +49,7 @@ def plot_fd(rho, q, fit, title):
     plt.title(title)
     plt.xlim([0, 0.5])
     plt.ylim([0, 4])
-    plt.show()
+    show_or_save(fname)
 
 
 def plot_cong_bins(rho, q):
@@ -45,7 +57,7 @@ def plot_cong_bins(rho, q):
     #plt.show()
 
 
-def plot_test_data(data, fit, cong_rho, cong_q, title):
+def plot_test_data(data, fit, cong_rho, cong_q, title, fname=None):
     # don't use existing filter in fit dict: needs to be recalculated for test data!
     free_filt = data['density'] < fit['rho_crit']
     data_free = data[free_filt]
@@ -59,4 +71,4 @@ def plot_test_data(data, fit, cong_rho, cong_q, title):
     plt.title(title)
     plt.xlim([0, 0.5])
     plt.ylim([0, 4])
-    plt.show()
+    show_or_save(fname)
@@ -0,0 +1,110 @@
+import os
+import re
+import shutil
+import logging
+
+import geotiler.tile.io
+
+# tile URLs of geotiler's providers end in <zoom>/<x>/<y>.<extension>
+tile_url_re = re.compile(r"/(\d+)/(\d+)/(\d+)\.(\w+)(?:\?.*)?$")
+
+
+def _is_tile_path(rel_path):
+    return tile_url_re.search("/" + rel_path.replace(os.sep, "/")) is not None
+
+
+class TileCache(object):
+    """
+    Map tiles stored on disk in the <zoom>/<x>/<y>.<extension> layout of
+    slippy map tile directories. Used as the downloader of
+    geotiler.render_map, it serves tiles from disk and downloads and stores
+    only the missing ones, or none when offline
+    """
+    def __init__(self, dirname, offline=False):
+        """
+        :param dirname: path to the cache directory, created if missing
+        :param offline: if True, missing tiles are not downloaded and render
+        as geotiler's error tile
+        """
+        self.logger = logging.getLogger("TileCache")
+        self.dirname = dirname
+        self.offline = offline
+        self.n_hits = 0
+        self.n_misses = 0
+        os.makedirs(dirname, exist_ok=True)
+
+    def tile_path(self, url):
+        """
+        :return: path of the cached tile of url, or None if url is not a tile URL
+        """
+        match = tile_url_re.search(url)
+        if match is None:
+            return None
+        zoom, x, y, ext = match.groups()
+        return os.path.join(self.dirname, zoom, x, "{}.{}".format(y, ext))
+
+    def get(self, url):
+        """
+        :return: tile image data of url, or None if not cached
+        """
+        path = self.tile_path(url)
+        if path is None or not os.path.isfile(path):
+            return None
+        with open(path, 'rb') as fin:
+            return fin.read()
+
+    def set(self, url, data):
+        path = self.tile_path(url)
+        if path is None or data is None:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written under a temporary name, so that readers never see part of a tile
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, 'wb') as fout:
+            fout.write(data)
+        os.replace(tmp_path, path)
+
+    def populate(self, tile_dir):
+        """
+        Copy the tiles of a local tile directory, in the same layout, that
+        are not in the cache yet
+        :return: number of tiles copied
+        """
+        n_copied = 0
+        for parent, dirnames, fnames in os.walk(tile_dir):
+            rel_dir = os.path.relpath(parent, tile_dir)
+            for fname in fnames:
+                dest = os.path.join(self.dirname, rel_dir, fname)
+                if not _is_tile_path(os.path.join(rel_dir, fname)) or os.path.exists(dest):
+                    continue
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                shutil.copyfile(os.path.join(parent, fname), dest)
+                n_copied += 1
+        self.logger.info("{} tiles copied from {}".format(n_copied, tile_dir))
+        return n_copied
+
+    async def downloader(self, tiles, num_workers, **kwargs):
+        """
+        Asynchronous generator of tiles, in the form of geotiler's downloaders
+        :param tiles: tiles to fetch
+        :param num_workers: number of connections used to download missing tiles
+        """
+        missing = []
+        for tile in tiles:
+            data = self.get(tile.url)
+            if data is None:
+                missing.append(tile)
+            else:
+                self.n_hits += 1
+                yield tile._replace(img=data, error=None)
+        self.n_misses += len(missing)
+        if len(missing) == 0:
+            return
+        if self.offline:
+            self.logger.warning("{} tiles not in {}, rendered blank".format(len(missing), self.dirname))
+            for tile in missing:
+                yield tile._replace(img=None, error=ValueError("Tile not cached: {}".format(tile.url)))
+            return
+        async for tile in geotiler.tile.io.fetch_tiles(missing, num_workers, **kwargs):
+            self.set(tile.url, tile.img)
+            yield tile